@@ -787,21 +787,36 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 
 #define FAN_ENTRIES 256
 
+struct idx_entry {
+    struct sha sha;
+    uint32_t i;
+};
+
+static int _cmp_idx_entry(const void *x, const void *y)
+{
+    const struct idx_entry *e1 = x, *e2 = y;
+    const int c = _cmp_sha(&e1->sha, &e2->sha);
+    if (c)
+        return c;
+    // Keep duplicates in the order they were added
+    return (e1->i > e2->i) - (e1->i < e2->i);
+}
+
 static PyObject *write_idx(PyObject *self, PyObject *args)
 {
     char *filename = NULL;
-    PyObject *py_total, *idx = NULL;
-    PyObject *part;
+    PyObject *py_total;
     unsigned int total = 0;
     uint32_t count;
     int i;
     uint32_t *fan_ptr, *crc_ptr, *ofs_ptr;
     uint64_t *ofs64_ptr;
     struct sha *sha_ptr;
+    struct idx_entry *entries = NULL;
 
-    Py_buffer fmap;
-    if (!PyArg_ParseTuple(args, cstr_argf wbuf_argf "OO",
-                          &filename, &fmap, &idx, &py_total))
+    Py_buffer fmap, shas, crcs, offsets;
+    if (!PyArg_ParseTuple(args, cstr_argf wbuf_argf "y*y*y*O",
+                          &filename, &fmap, &shas, &crcs, &offsets, &py_total))
 	return NULL;
 
     PyObject *result = NULL;
@@ -809,13 +824,32 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     if (!bup_uint_from_py(&total, py_total, "total"))
         goto clean_and_return;
 
-    if (PyList_Size (idx) != FAN_ENTRIES) // Check for list of the right length.
+    if ((size_t) shas.len != total * sizeof(struct sha)
+        || (size_t) crcs.len != total * sizeof(uint32_t)
+        || (size_t) offsets.len != total * sizeof(uint64_t))
     {
-        result = PyErr_Format (PyExc_TypeError, "idx must contain %d entries",
-                               FAN_ENTRIES);
+        result = PyErr_Format(PyExc_ValueError,
+                              "sha, crc and offset buffers must hold %u entries",
+                              total);
         goto clean_and_return;
     }
 
+    // Sort (references to) the entries here, rather than keeping
+    // them sorted while the pack is written.
+    if (total && !(entries = checked_malloc(total, sizeof(struct idx_entry))))
+        goto clean_and_return;
+    const struct sha *shas_buf = shas.buf;
+    const uint32_t *crcs_buf = crcs.buf;
+    const uint64_t *offsets_buf = offsets.buf;
+    uint32_t j;
+    for (j = 0; j < total; ++j)
+    {
+        memcpy(&entries[j].sha, &shas_buf[j], sizeof(struct sha));
+        entries[j].i = j;
+    }
+    if (total)
+        qsort(entries, total, sizeof(struct idx_entry), _cmp_idx_entry);
+
     const char idx_header[] = "\377tOc\0\0\0\002";
     memcpy (fmap.buf, idx_header, sizeof(idx_header) - 1);
 
@@ -829,39 +863,12 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     uint32_t ofs64_count = 0;
     for (i = 0; i < FAN_ENTRIES; ++i)
     {
-	part = PyList_GET_ITEM(idx, i);
-	PyList_Sort(part);
-        uint32_t plen;
-        if (!INTEGRAL_ASSIGNMENT_FITS(&plen, PyList_GET_SIZE(part))
-            || UINT32_MAX - count < plen) {
-            PyErr_Format(PyExc_OverflowError, "too many objects in index part");
-            goto clean_and_return;
-        }
-        count += plen;
-	*fan_ptr++ = htonl(count);
-        uint32_t j;
-        for (j = 0; j < plen; ++j)
+        for (; count < total && entries[count].sha.bytes[0] == i; ++count)
 	{
-	    unsigned char *sha = NULL;
-	    Py_ssize_t sha_len = 0;
-            PyObject *crc_py, *ofs_py;
-	    unsigned int crc;
-            unsigned PY_LONG_LONG ofs_ull;
-	    uint64_t ofs;
-	    if (!PyArg_ParseTuple(PyList_GET_ITEM(part, j), rbuf_argf "OO",
-				  &sha, &sha_len, &crc_py, &ofs_py))
-                goto clean_and_return;
-            if(!bup_uint_from_py(&crc, crc_py, "crc"))
-                goto clean_and_return;
-            if(!bup_ullong_from_py(&ofs_ull, ofs_py, "ofs"))
-                goto clean_and_return;
-            assert(crc <= UINT32_MAX);
-            assert(ofs_ull <= UINT64_MAX);
-	    ofs = ofs_ull;
-	    if (sha_len != sizeof(struct sha))
-                goto clean_and_return;
-	    memcpy(sha_ptr++, sha, sizeof(struct sha));
-	    *crc_ptr++ = htonl(crc);
+            const uint32_t e = entries[count].i;
+	    uint64_t ofs = offsets_buf[e];
+	    memcpy(sha_ptr++, &entries[count].sha, sizeof(struct sha));
+	    *crc_ptr++ = htonl(crcs_buf[e]);
 	    if (ofs > 0x7fffffff)
 	    {
                 *ofs64_ptr++ = htonll(ofs);
@@ -869,7 +876,9 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
 	    }
 	    *ofs_ptr++ = htonl((uint32_t)ofs);
 	}
+	*fan_ptr++ = htonl(count);
     }
+    assert(count == total);
 
     int rc = msync(fmap.buf, fmap.len, MS_ASYNC);
     if (rc != 0)
@@ -881,7 +890,98 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     result = PyLong_FromUnsignedLong(count);
 
  clean_and_return:
+    free(entries);
     PyBuffer_Release(&fmap);
+    PyBuffer_Release(&shas);
+    PyBuffer_Release(&crcs);
+    PyBuffer_Release(&offsets);
+    return result;
+}
+
+
+static inline uint32_t _be32_at(const unsigned char *p)
+{
+    uint32_t v;
+    memcpy(&v, p, sizeof(v));
+    return ntohl(v);
+}
+
+static PyObject *find_sha(PyObject *self, PyObject *args)
+{
+    Py_buffer map;
+    unsigned char *sha = NULL;
+    Py_ssize_t sha_len = 0, fanout_ofs = 0, sha_ofs = 0, stride = 0, nsha = 0;
+    int bits = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf rbuf_argf "ninnn",
+                          &map, &sha, &sha_len, &fanout_ofs, &bits,
+                          &sha_ofs, &stride, &nsha))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (sha_len != 20)
+    {
+        PyErr_Format(PyExc_ValueError, "sha must be 20 bytes, not %zd", sha_len);
+        goto clean_and_return;
+    }
+    if (bits < 0 || bits > 31 || fanout_ofs < 0 || sha_ofs < 0 || stride < 20
+        || nsha < 0 || map.len < fanout_ofs + ((Py_ssize_t) 4 << bits)
+        || (nsha && (nsha - 1 > (PY_SSIZE_T_MAX - sha_ofs - 20) / stride
+                     || map.len < sha_ofs + stride * (nsha - 1) + 20)))
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid sha table layout");
+        goto clean_and_return;
+    }
+
+    const unsigned char *buf = map.buf;
+    const unsigned char *fanout = buf + fanout_ofs;
+    const uint32_t hashv = _be32_at(sha);
+    const uint32_t bucket = bits ? hashv >> (32 - bits) : 0;
+    uint64_t start = bucket ? _be32_at(fanout + 4 * (bucket - 1)) : 0;
+    uint64_t end = _be32_at(fanout + 4 * bucket);
+    // The (first words of the) shas at start and end, for interpolation
+    uint64_t startv = (uint64_t) bucket << (32 - bits);
+    uint64_t endv = (uint64_t) (bucket + 1) << (32 - bits);
+    int steps = 1; // the fanout lookup
+
+    if (end > (uint64_t) nsha || start > end)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid sha table fanout");
+        goto clean_and_return;
+    }
+
+    while (start < end)
+    {
+        uint64_t mid;
+        steps++;
+        // The shas are uniformly distributed, so interpolate, unless
+        // the first words don't allow that (bisect then).
+        if (startv < hashv && hashv < endv)
+            mid = start + (hashv - startv) * (end - start - 1) / (endv - startv);
+        else
+            mid = start + (end - start) / 2;
+        const unsigned char *v = buf + sha_ofs + mid * stride;
+        const int c = memcmp(v, sha, 20);
+        if (c < 0)
+        {
+            start = mid + 1;
+            startv = _be32_at(v);
+        }
+        else if (c > 0)
+        {
+            end = mid;
+            endv = _be32_at(v);
+        }
+        else
+        {
+            result = Py_BuildValue("ni", (Py_ssize_t) mid, steps);
+            goto clean_and_return;
+        }
+    }
+    result = Py_BuildValue("Oi", Py_None, steps);
+
+ clean_and_return:
+    PyBuffer_Release(&map);
     return result;
 }
 
@@ -2002,8 +2102,12 @@ static PyMethodDef helper_methods[] = {
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
+    { "find_sha", find_sha, METH_VARARGS,
+      "find_sha(map, sha, fanout_ofs, bits, sha_ofs, stride, nsha)\n\n"
+      "Search the sorted sha table in map for sha, and return its index"
+      " (or None if it's not there) and the number of steps taken." },
     { "write_idx", write_idx, METH_VARARGS,
-	"Write a PackIdxV2 file from an idx list of lists of tuples" },
+	"Write a PackIdxV2 file from buffers of shas, crcs and offsets" },
     { "write_random", write_random, METH_VARARGS,
 	"Write random bytes to the given file descriptor" },
     { "random_sha", random_sha, METH_VARARGS,
@@ -0,0 +1,3 @@
+commit='bcd2ad0407f832586d8f9a6c93e2ffe4ec3ab966'
+date='2026-10-19 10:46:21 +0000'
+modified=True
@@ -1,20 +1,45 @@
 
 from binascii import hexlify, unhexlify
-import os, re, struct, sys, time, zlib
-import socket, shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Thread
+import asyncio, os, re, struct, sys, time, zlib
+import socket, shutil, tempfile
 
-from bup import git, ssh, vfs, vint, protocol, path, repo
+from bup import bloom, git, ssh, vfs, vint, protocol, path, repo
 from bup.compat import pending_raise
-from bup.helpers import (Conn, atomically_replaced_file, chunkyreader, debug1,
-                         debug2, linereader, lines_until_sentinel,
-                         mkdirp, nullcontext_if_not, progress, qprogress, DemuxConn)
+from bup.helpers import (OBJECT_EXISTS, Conn, NotOk, atomically_replaced_file,
+                         chunkyreader, debug1, debug2, log,
+                         linereader, lines_until_sentinel,
+                         mkdirp, unlink, nullcontext_if_not, progress, qprogress, DemuxConn)
 from bup.io import path_msg
-from bup.vint import read_vint, read_vuint, read_bvec, write_bvec
+from bup.vint import read_vint, read_vuint, read_bvec, write_bvec, write_vuint
 
 
 class ClientError(git.GitError):
     pass
 
+class ConnectionLost(ClientError):
+    """The connection to the server failed, as opposed to the server
+    reporting an error."""
+    pass
+
+
+# Limits for the objects PackWriter_Remote holds back until it has
+# asked the server which of them it's missing.
+missing_objects_batch = 4096
+missing_objects_batch_bytes = 16 << 20
+
+# The number of cat-stream requests the client would like to have in
+# flight (the server may grant fewer).
+cat_stream_window = 256
+
+# How often, and after how long (doubling each time) to try to
+# reconnect to resume sending objects after losing the connection.
+reconnect_attempts = 5
+reconnect_delay = 2
+
 
 def _raw_write_bwlimit(f, buf, bwcount, bwtime, bwlimit):
     if not bwlimit:
@@ -39,44 +64,248 @@ def _raw_write_bwlimit(f, buf, bwcount, bwtime, bwlimit):
         return (bwcount, bwtime)
 
 
+class _CatStream:
+    """The client side of a cat-stream command.  It keeps requesting
+    refs within the limits granted by the server, and reads the
+    results in order.  If another command is started on the client,
+    suspend() ends the command, keeping the outstanding results, and
+    the stream resumes with a new command for the remaining refs
+    when more results are needed.
+
+    """
+    def __init__(self, client, refs, include_data, window):
+        self._client = client
+        self._refs = iter(refs)
+        self._next_ref = None
+        self._include_data = include_data
+        self._window = window
+        self._active = False
+        self._in_flight = deque()  # sizes of the outstanding requests
+        self._in_flight_bytes = 0
+        self._results = deque()  # results read by suspend()
+
+    def __iter__(self):
+        return self
+
+    def _start(self):
+        c = self._client
+        c.check_busy()
+        c._busy = b'cat-stream'
+        c._preempt = self.suspend
+        c.conn.write(b'cat-stream\n')
+        vint.send(c.conn, 'VV', self._window, 1 if self._include_data else 0)
+        self._max_requests, self._max_bytes = vint.recv(c.conn, 'VV')
+        self._active = True
+
+    def _request_more(self):
+        conn = self._client.conn
+        while True:
+            if self._next_ref is None:
+                self._next_ref = next(self._refs, None)
+                # Producing the ref may have suspended us
+                if self._next_ref is None or not self._active:
+                    return
+            ref = self._next_ref
+            assert ref
+            size = len(ref) + 10  # upper bound, including the vuint
+            if self._in_flight:
+                if len(self._in_flight) >= self._max_requests:
+                    return
+                if self._in_flight_bytes + size > self._max_bytes:
+                    return
+            write_bvec(conn, ref)
+            self._in_flight.append(size)
+            self._in_flight_bytes += size
+            self._next_ref = None
+
+    def _read_result(self):
+        conn = self._client.conn
+        self._in_flight_bytes -= self._in_flight.popleft()
+        info = conn.readline()
+        if info == b'missing\n':
+            return None, None, None, None
+        if not (info and info.endswith(b'\n')):
+            raise ClientError('Hit EOF while looking for object info: %r'
+                              % info)
+        oidx, typ, size = info[:-1].split(b' ')
+        size = int(size)
+        data = None
+        if self._include_data:
+            data = b''.join(chunkyreader(conn, size))
+        return oidx, typ, size, data
+
+    def _end(self, keep):
+        write_bvec(self._client.conn, b'')
+        while self._in_flight:
+            result = self._read_result()
+            if keep:
+                self._results.append(result)
+        self._active = False
+        not_ok = self._client.check_ok()
+        if not_ok:
+            raise not_ok
+        self._client._not_busy()
+
+    def suspend(self):
+        assert self._active
+        self._end(keep=True)
+
+    def __next__(self):
+        try:
+            while True:
+                if self._results:
+                    return self._results.popleft()
+                if self._active:
+                    self._request_more()
+                    if not self._active:
+                        continue
+                    if self._in_flight:
+                        return self._read_result()
+                    self._end(keep=False)
+                    raise StopIteration()
+                if self._next_ref is None:
+                    self._next_ref = next(self._refs, None)
+                    if self._next_ref is None:
+                        raise StopIteration()
+                    continue
+                self._start()
+        except StopIteration:
+            raise
+        except BaseException:
+            # The connection's state is unknown, leave the client busy
+            self._active = False
+            self._client._preempt = None
+            raise
+
+    def close(self):
+        if self._active:
+            self._end(keep=False)
+
+
+# The requests and the responses of the commands that Client and
+# AsyncClient share.  The requests are written as they'd be sent
+# directly, and the responses are read up to (but not including)
+# the final ok or error.
+
+def _send_read_ref(conn, refname):
+    conn.write(b'read-ref %s\n' % refname)
+
+def _recv_read_ref(conn):
+    r = conn.readline().strip()
+    if not r:
+        return None   # nonexistent ref
+    assert(len(r) == 40)   # hexified sha
+    return unhexlify(r)
+
+def _send_cat(conn, ref):
+    conn.write(b'cat-batch\n')
+    # FIXME: do we want (only) binary protocol?
+    assert ref
+    assert b'\n' not in ref
+    conn.write(ref)
+    conn.write(b'\n')
+    # protocol supports multiple refs, end of refs:
+    conn.write(b'\n')
+
+def _recv_cat(conn):
+    info = conn.readline()
+    if info == b'missing\n':
+        yield None, None, None
+        return
+    if not (info and info.endswith(b'\n')):
+        raise ClientError('Hit EOF while looking for object info: %r'
+                          % info)
+    oidx, oid_t, size = info.split(b' ')
+    size = int(size)
+    cr = chunkyreader(conn, size)
+    yield oidx, oid_t, size
+    yield from cr
+    detritus = next(cr, None)
+    if detritus:
+        raise ClientError('unexpected leftover data ' + repr(detritus))
+
+def _send_refs(conn, patterns, limit_to_heads, limit_to_tags):
+    conn.write(b'refs %d %d\n' % (1 if limit_to_heads else 0,
+                                  1 if limit_to_tags else 0))
+    for pattern in patterns:
+        assert b'\n' not in pattern
+        conn.write(pattern)
+        conn.write(b'\n')
+    conn.write(b'\n')
+
+def _recv_refs(conn):
+    for line in lines_until_sentinel(conn, b'\n', ClientError):
+        line = line[:-1]
+        oidx, name = line.split(b' ')
+        if len(oidx) != 40:
+            raise ClientError('Invalid object fingerprint in %r' % line)
+        if not name:
+            raise ClientError('Invalid reference name in %r' % line)
+        yield name, unhexlify(oidx)
+
+def _send_rev_list(conn, refs, format):
+    if format:
+        assert b'\n' not in format
+    if isinstance(refs, bytes):
+        refs = (refs,)
+    for ref in refs:
+        assert ref
+        assert b'\n' not in ref
+    conn.write(b'rev-list\n')
+    conn.write(b'\n')
+    if format:
+        conn.write(format)
+    conn.write(b'\n')
+    for ref in refs:
+        conn.write(ref)
+        conn.write(b'\n')
+    conn.write(b'\n')
+
+def _recv_rev_list(conn, parse, format):
+    if not format:
+        for line in lines_until_sentinel(conn, b'\n', ClientError):
+            line = line.strip()
+            assert len(line) == 40
+            yield line
+    else:
+        for line in lines_until_sentinel(conn, b'\n', ClientError):
+            if not line.startswith(b'commit '):
+                raise ClientError('unexpected line ' + repr(line))
+            cmt_oidx = line[7:].strip()
+            assert len(cmt_oidx) == 40
+            yield cmt_oidx, parse(conn)
+
+def _send_resolve(conn, path, parent, want_meta, follow):
+    conn.write(b'resolve %d\n' % ((1 if want_meta else 0)
+                                  | (2 if follow else 0)
+                                  | (4 if parent else 0)))
+    if parent:
+        protocol.write_resolution(conn, parent)
+    write_bvec(conn, path)
+
+def _recv_resolve(conn):
+    """Return the resolution, or the vfs.IOError the server reported."""
+    success = ord(conn.read(1))
+    assert success in (0, 1)
+    if success:
+        return protocol.read_resolution(conn)
+    return protocol.read_ioerror(conn)
+
+
 class Client:
     def __init__(self, remote, create=False):
         self.closed = False
         self._busy = self.conn = None
-        self.sock = self.p = self.pout = self.pin = None
+        self._preempt = None
+        self._objects_session = None
+        self._dumb_server = False
+        self._bloom = None
+        self.sock = self.sockw = self.p = self.pout = self.pin = None
         try:
             (self.protocol, self.host, self.port, self.dir) = repo.parse_remote(remote)
-
-            if self.protocol == b'bup-rev':
-                self.pout = os.fdopen(3, 'rb')
-                self.pin = os.fdopen(4, 'wb')
-                self.conn = Conn(self.pout, self.pin)
-                sys.stdin.close()
-            elif self.protocol in (b'ssh', b'file'):
-                try:
-                    # FIXME: ssh and file shouldn't use the same module
-                    self.p = ssh.connect(self.host, self.port, b'server')
-                    self.pout = self.p.stdout
-                    self.pin = self.p.stdin
-                    self.conn = Conn(self.pout, self.pin)
-                except OSError as e:
-                    raise ClientError('connect: %s' % e) from e
-            elif self.protocol == b'bup':
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((self.host,
-                                   1982 if self.port is None else int(self.port)))
-                self.sockw = self.sock.makefile('wb')
-                self.conn = DemuxConn(self.sock.fileno(), self.sockw)
-            self._available_commands = self._get_available_commands()
             if self.dir:
                 self.dir = re.sub(br'[\r\n]', b' ', self.dir)
-                if create:
-                    self._require_command(b'init-dir')
-                    self.conn.write(b'init-dir %s\n' % self.dir)
-                else:
-                    self._require_command(b'set-dir')
-                    self.conn.write(b'set-dir %s\n' % self.dir)
-                self.check_ok()
+            self._connect(create)
 
             # Set up the index-cache directory, prefer using the repo-id
             # if the remote repo has one (that can be accessed)
@@ -100,45 +329,104 @@ class Client:
             with pending_raise(ex):
                 self.close()
 
+    def _connect(self, create=False):
+        self._walk_have = None  # the walk-objects have-set the server has
+        if self.protocol == b'bup-rev':
+            self.pout = os.fdopen(3, 'rb')
+            self.pin = os.fdopen(4, 'wb')
+            self.conn = Conn(self.pout, self.pin)
+            sys.stdin.close()
+        elif self.protocol in (b'ssh', b'file'):
+            try:
+                # FIXME: ssh and file shouldn't use the same module
+                self.p = ssh.connect(self.host, self.port, b'server')
+                self.pout = self.p.stdout
+                self.pin = self.p.stdin
+                self.conn = Conn(self.pout, self.pin)
+            except OSError as e:
+                raise ConnectionLost('connect: %s' % e) from e
+        elif self.protocol == b'bup':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.connect((self.host,
+                               1982 if self.port is None else int(self.port)))
+            self.sockw = self.sock.makefile('wb')
+            self.conn = DemuxConn(self.sock.fileno(), self.sockw)
+        self._available_commands = self._get_available_commands()
+        if self.dir:
+            if create:
+                self._require_command(b'init-dir')
+                self.conn.write(b'init-dir %s\n' % self.dir)
+            else:
+                self._require_command(b'set-dir')
+                self.conn.write(b'set-dir %s\n' % self.dir)
+            self.check_ok()
+
+    def can_reconnect(self):
+        # bup-rev connections are set up by the other side
+        return self.protocol != b'bup-rev'
+
+    def reconnect(self):
+        """Drop the current connection, e.g. after it failed, and
+        connect to the server again, abandoning any command in
+        progress."""
+        assert self.can_reconnect()
+        if self.p and self.p.poll() is None:
+            # e.g. ssh may take a long time to notice a dead link
+            self.p.kill()
+        try:
+            self._disconnect()
+        except (ClientError, OSError) as ex:
+            debug1('client: error while disconnecting: %s\n' % ex)
+        self._busy = self._preempt = None
+        self._connect()
+
     def close(self):
         if self.closed:
             return
         self.closed = True
+        if self._bloom:
+            self._bloom.close()
+            self._bloom = None
         try:
+            if self.conn and self._busy and self._preempt:
+                self._preempt()
             if self.conn and not self._busy:
                 self.conn.write(b'quit\n')
+        finally:
+            self._disconnect()
+
+    def _disconnect(self):
+        try:
+            if self.pin:
+                self.pin.close()
         finally:
             try:
-                if self.pin:
-                    self.pin.close()
+                self.pin = None
+                if self.sock and self.sockw:
+                    self.sockw.close()
+                    self.sock.shutdown(socket.SHUT_WR)
             finally:
                 try:
-                    self.pin = None
-                    if self.sock and self.sockw:
-                        self.sockw.close()
-                        self.sock.shutdown(socket.SHUT_WR)
+                    if self.conn:
+                        self.conn.close()
                 finally:
                     try:
-                        if self.conn:
-                            self.conn.close()
+                        self.conn = None
+                        if self.pout:
+                            self.pout.close()
                     finally:
                         try:
-                            self.conn = None
-                            if self.pout:
-                                self.pout.close()
+                            self.pout = None
+                            if self.sock:
+                                self.sock.close()
                         finally:
-                            try:
-                                self.pout = None
-                                if self.sock:
-                                    self.sock.close()
-                            finally:
-                                self.sock = None
-                                if self.p:
-                                    self.p.wait()
-                                    rv = self.p.wait()
-                                    if rv:
-                                        raise ClientError('server tunnel returned exit code %d' % rv)
-                                self.p = None
+                            self.sock = self.sockw = None
+                            p, self.p = self.p, None
+                            if p:
+                                p.wait()
+                                rv = p.wait()
+                                if rv:
+                                    raise ClientError('server tunnel returned exit code %d' % rv)
 
     def __del__(self):
         assert self.closed
@@ -154,14 +442,38 @@ class Client:
         if self.p:
             rv = self.p.poll()
             if rv != None:
-                raise ClientError('server exited unexpectedly with code %r'
-                                  % rv)
+                err = self.server_error()
+                if err:
+                    raise ClientError('server: %s' % err.decode('utf-8',
+                                                                'replace'))
+                raise ConnectionLost('server exited unexpectedly with code %r'
+                                     % rv)
         try:
             return self.conn.check_ok()
+        except EOFError as e:
+            raise ConnectionLost(e) from e
         except Exception as e:
             raise ClientError(e) from e
 
+    def server_error(self):
+        """Return the error the server reported before the connection
+        failed, if any, discarding anything else it sent."""
+        try:
+            while self.conn and self.conn.has_input():
+                line = self.conn.readline()
+                if not line:
+                    break
+                if line.startswith(b'error '):
+                    return line[6:].rstrip(b'\n')
+        except (OSError, ValueError):
+            pass
+        return None
+
     def check_busy(self):
+        if self._busy and self._preempt:
+            # The current command (e.g. a cat-stream) can be finished
+            # early and picked up again later.
+            self._preempt()
         if self._busy:
             raise ClientError('already busy with command %r' % self._busy)
 
@@ -171,6 +483,7 @@ class Client:
 
     def _not_busy(self):
         self._busy = None
+        self._preempt = None
 
     def _get_available_commands(self):
         self.check_busy()
@@ -235,6 +548,7 @@ class Client:
             if load:
                 # If the server requests that we load an idx and we don't
                 # already have a copy of it, it is needed
+                self._dumb_server = True
                 needed.add(idx)
             # Any idx that the server has heard of is proven not extra
             extra.discard(idx)
@@ -276,10 +590,65 @@ class Client:
         with atomically_replaced_file(fn, 'wb') as f:
             self.send_index(name, f, lambda size: None)
 
+    def sync_bloom(self):
+        """Bring the cached copy of the server's bloom filter up to
+        date (downloading only what it lacks if possible) and return
+        it (opened), or None if the server doesn't have one."""
+        self._require_command(b'send-bloom')
+        self.check_busy()
+        mkdirp(self.cachedir)
+        fn = os.path.join(self.cachedir, b'server.bloom')
+        bits = k = 0
+        names = []
+        if os.path.exists(fn):
+            with bloom.ShaBloom(fn) as b:
+                if b.valid():
+                    bits, k, names = b.bits, b.k, b.idxnames
+        self._busy = b'send-bloom'
+        conn = self.conn
+        conn.write(b'send-bloom\n')
+        vint.send(conn, 'VV', bits, k)
+        for name in names:
+            write_bvec(conn, name)
+        write_bvec(conn, b'')
+        kind = read_vuint(conn)
+        if kind == 0:
+            unlink(fn)
+        else:
+            if kind == 1:
+                n = read_vuint(conn)
+                debug1('client: receiving bloom filter (%d bytes)\n' % n)
+                with atomically_replaced_file(fn, 'wb') as f:
+                    for blob in chunkyreader(conn, n):
+                        f.write(blob)
+            elif kind != 2:
+                raise ClientError('unexpected send-bloom response %d' % kind)
+            with bloom.ShaBloom(fn, readwrite=True, expected=1) as b:
+                while True:
+                    name = read_bvec(conn)
+                    if not name:
+                        break
+                    debug1('client: adding %s to bloom filter\n'
+                           % path_msg(name))
+                    b.add(read_bvec(conn))
+                    b.idxnames.append(name)
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        if kind == 0:
+            return None
+        return bloom.ShaBloom(fn)
+
     def _make_objcache(self, repo_dir):
         return git.PackIdxList(self.cachedir)
 
-    def _suggest_packs(self):
+    def _receive_suggestions(self):
+        """Suspend receive-objects-v2 if it's active, handle the index
+        suggestions (and finished packs) the server reports, and
+        return the suspended command (if any) and the last idx
+        received."""
         ob = self._busy
         if ob:
             assert(ob == b'receive-objects-v2')
@@ -299,32 +668,118 @@ class Client:
                 debug1('client: completed writing pack, idx: %s\n'
                        % git.shorten_hash(line).decode('ascii'))
                 suggested.append(line)
-        self.check_ok()
+        not_ok = self.check_ok()
+        if not_ok:
+            raise ClientError('server: %s' % not_ok)
         if ob:
             self._busy = None
         idx = None
         for idx in suggested:
             self.sync_index(idx)
-        git.auto_midx(self.cachedir)
+        if suggested:
+            git.auto_midx(self.cachedir)
+        return ob, idx
+
+    def _receive_objects(self):
+        self._busy = b'receive-objects-v2'
+        if self._objects_session:
+            self.conn.write(b'receive-objects-v2 %s\n' % self._objects_session)
+        else:
+            self.conn.write(b'receive-objects-v2\n')
+
+    def _suggest_packs(self):
+        ob, idx = self._receive_suggestions()
         if ob:
-            self._busy = ob
-            self.conn.write(b'%s\n' % ob)
+            self._receive_objects()
         return idx
 
+    def resume_objects(self):
+        """Reconnect to the server, and return the number of objects
+        of the current receive-objects-v2 session that it has stored."""
+        assert self._objects_session
+        self.reconnect()
+        self._require_command(b'resume-objects')
+        self.conn.write(b'resume-objects %s\n' % self._objects_session)
+        line = self.conn.readline()
+        if not line:
+            raise ConnectionLost('resume-objects: unexpected EOF')
+        count = int(line)
+        self.check_ok()
+        return self.conn, count
+
+    def missing_objects(self, oids):
+        """Return a list of booleans indicating which of the oids are
+        missing from the remote repository."""
+        self._require_command(b'missing-objects')
+        if not oids:
+            return []
+        ob = None
+        if self._busy:
+            ob, _ = self._receive_suggestions()
+        self.check_busy()
+        self._busy = b'missing-objects'
+        conn = self.conn
+        conn.write(b'missing-objects\n')
+        missing = []
+        batch = protocol.MISSING_OBJECTS_MAX_BATCH
+        for start in range(0, len(oids), batch):
+            some = oids[start:start + batch]
+            conn.write(struct.pack('!I', len(some)))
+            for oid in some:
+                assert len(oid) == 20
+                conn.write(oid)
+            bits = conn.read((len(some) + 7) // 8)
+            if len(bits) != (len(some) + 7) // 8:
+                not_ok = self.check_ok()
+                if not_ok:
+                    raise ClientError('server: %s' % not_ok)
+                raise ConnectionLost('missing-objects: unexpected EOF')
+            missing.extend(bool(bits[i >> 3] & (1 << (i & 7)))
+                           for i in range(len(some)))
+        conn.write(b'\0\0\0\0')
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        if ob:
+            self._receive_objects()
+        return missing
+
     def new_packwriter(self, compression_level=None,
                        max_pack_size=None, max_pack_objects=None,
                        objcache_maker=None, run_midx=True,
-                       bwlimit=None):
+                       bwlimit=None, ask_missing=False):
+        """Return a PackWriter_Remote for the repository.  If
+        ask_missing is true (and the server supports it), objects the
+        server might already have are held back until it has been
+        asked about them, instead of relying on it to suggest idxs.
+
+        """
         self._require_command(b'receive-objects-v2')
         self.check_busy()
-        def _set_busy():
-            self._busy = b'receive-objects-v2'
-            self.conn.write(b'receive-objects-v2\n')
+        self._objects_session = resume_objects = None
+        if b'resume-objects' in self._available_commands \
+           and self.can_reconnect():
+            self._objects_session = hexlify(os.urandom(16))
+            resume_objects = self.resume_objects
         objcache_maker = objcache_maker or self._make_objcache
+        missing_objects = None
+        # A dumb server wants us to know everything from its idxs
+        if ask_missing and not self._dumb_server \
+           and b'missing-objects' in self._available_commands:
+            missing_objects = self.missing_objects
+            if not self._bloom \
+               and b'send-bloom' in self._available_commands:
+                self._bloom = self.sync_bloom()
         return PackWriter_Remote(self.conn,
                                  objcache_maker = objcache_maker,
                                  suggest_packs = self._suggest_packs,
-                                 onopen = _set_busy,
+                                 missing_objects = missing_objects,
+                                 bloom = self._bloom,
+                                 resume_objects = resume_objects,
+                                 server_error = self.server_error,
+                                 onopen = self._receive_objects,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
                                  compression_level=compression_level,
@@ -335,14 +790,10 @@ class Client:
     def read_ref(self, refname):
         self._require_command(b'read-ref')
         self.check_busy()
-        self.conn.write(b'read-ref %s\n' % refname)
-        r = self.conn.readline().strip()
+        _send_read_ref(self.conn, refname)
+        r = _recv_read_ref(self.conn)
         self.check_ok()
-        if r:
-            assert(len(r) == 40)   # hexified sha
-            return unhexlify(r)
-        else:
-            return None   # nonexistent ref
+        return r
 
     def update_ref(self, refname, newval, oldval):
         self._require_command(b'update-ref')
@@ -379,31 +830,9 @@ class Client:
         self._require_command(b'cat-batch')
         self.check_busy()
         self._busy = b'cat-batch'
-        conn = self.conn
-        conn.write(b'cat-batch\n')
-        # FIXME: do we want (only) binary protocol?
-        assert ref
-        assert b'\n' not in ref
-        conn.write(ref)
-        conn.write(b'\n')
-        # protocol supports multiple refs, end of refs:
-        conn.write(b'\n')
+        _send_cat(self.conn, ref)
         try:
-            info = conn.readline()
-            if info == b'missing\n':
-                yield None, None, None
-                return
-            if not (info and info.endswith(b'\n')):
-                raise ClientError('Hit EOF while looking for object info: %r'
-                                  % info)
-            oidx, oid_t, size = info.split(b' ')
-            size = int(size)
-            cr = chunkyreader(conn, size)
-            yield oidx, oid_t, size
-            yield from cr
-            detritus = next(cr, None)
-            if detritus:
-                raise ClientError('unexpected leftover data ' + repr(detritus))
+            yield from _recv_cat(self.conn)
         finally:
             # FIXME: confusing
             not_ok = self.check_ok()
@@ -411,27 +840,87 @@ class Client:
                 raise not_ok
             self._not_busy()
 
+    def cat_stream(self, refs, include_data=True, window=cat_stream_window):
+        """Yield (oidx, type, size, data) for each of the refs, or
+        (None, None, None, None) if the ref doesn't exist.  The data
+        is None unless include_data is true.  Up to window requests
+        are kept in flight, so the refs are consumed ahead of the
+        results.  Other commands may be issued between results.
+
+        """
+        self._require_command(b'cat-stream')
+        stream = _CatStream(self, refs, include_data, window)
+        try:
+            yield from stream
+        finally:
+            stream.close()
+
+    def walk_objects(self, oids, have=None):
+        """Have the server walk the objects reachable from the given
+        (binary) oids, and yield (kind, oid, type, data, metadata) for
+        each of them that the have bloom filter (a bloom.ShaBloom)
+        doesn't appear to contain, and (kind, oid, None, None, None)
+        for the ones it does, or that are missing, where the kind is
+        protocol.WALK_OBJECT, WALK_HAVE, or WALK_MISSING.  See
+        protocol.Server.walk_objects().  Objects yielded earlier on
+        this connection are reported like the ones the filter contains.
+
+        """
+        self._require_command(b'walk-objects')
+        self.check_busy()
+        self._busy = b'walk-objects'
+        conn = self.conn
+        conn.write(b'walk-objects\n')
+        have_id = None
+        if have and have.valid():
+            have_id = (have.name, have.bits, have.k, have.entries,
+                       tuple(have.idxnames))
+        if not have_id:
+            write_vuint(conn, 0)
+        elif have_id == self._walk_have:
+            write_vuint(conn, 2)
+        else:
+            write_vuint(conn, 1)
+            write_bvec(conn, memoryview(have.map)[:16 + 2**have.bits])
+        self._walk_have = have_id
+        for oid in oids:
+            assert len(oid) == 20
+            write_bvec(conn, oid)
+        write_bvec(conn, b'')
+        while True:
+            kind = read_vuint(conn)
+            if kind == protocol.WALK_END:
+                break
+            if kind == protocol.WALK_OBJECT:
+                metadata = read_vuint(conn)
+            elif kind not in (protocol.WALK_HAVE, protocol.WALK_MISSING):
+                raise ClientError('unexpected walk-objects record %d' % kind)
+            oid = conn.read(20)
+            if len(oid) != 20:
+                raise ClientError('walk-objects: unexpected EOF')
+            if kind != protocol.WALK_OBJECT:
+                yield kind, oid, None, None, None
+                continue
+            it = git._decode_packobj(read_bvec(conn))
+            typ, size = next(it)
+            data = b''.join(it)
+            if len(data) != size or git.calc_hash(typ, data) != oid:
+                raise ClientError('walk-objects: corrupt object %s'
+                                  % hexlify(oid).decode('ascii'))
+            yield kind, oid, typ, data, bool(metadata)
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         patterns = patterns or tuple()
         self._require_command(b'refs')
         self.check_busy()
         self._busy = b'refs'
-        conn = self.conn
-        conn.write(b'refs %d %d\n' % (1 if limit_to_heads else 0,
-                                      1 if limit_to_tags else 0))
-        for pattern in patterns:
-            assert b'\n' not in pattern
-            conn.write(pattern)
-            conn.write(b'\n')
-        conn.write(b'\n')
-        for line in lines_until_sentinel(conn, b'\n', ClientError):
-            line = line[:-1]
-            oidx, name = line.split(b' ')
-            if len(oidx) != 40:
-                raise ClientError('Invalid object fingerprint in %r' % line)
-            if not name:
-                raise ClientError('Invalid reference name in %r' % line)
-            yield name, unhexlify(oidx)
+        _send_refs(self.conn, patterns, limit_to_heads, limit_to_tags)
+        yield from _recv_refs(self.conn)
         # FIXME: confusing
         not_ok = self.check_ok()
         if not_ok:
@@ -448,35 +937,11 @@ class Client:
         """
         self._require_command(b'rev-list')
         if format:
-            assert b'\n' not in format
             assert parse
-        for ref in refs:
-            assert ref
-            assert b'\n' not in ref
         self.check_busy()
         self._busy = b'rev-list'
-        conn = self.conn
-        conn.write(b'rev-list\n')
-        conn.write(b'\n')
-        if format:
-            conn.write(format)
-        conn.write(b'\n')
-        for ref in refs:
-            conn.write(ref)
-            conn.write(b'\n')
-        conn.write(b'\n')
-        if not format:
-            for line in lines_until_sentinel(conn, b'\n', ClientError):
-                line = line.strip()
-                assert len(line) == 40
-                yield line
-        else:
-            for line in lines_until_sentinel(conn, b'\n', ClientError):
-                if not line.startswith(b'commit '):
-                    raise ClientError('unexpected line ' + repr(line))
-                cmt_oidx = line[7:].strip()
-                assert len(cmt_oidx) == 40
-                yield cmt_oidx, parse(conn)
+        _send_rev_list(self.conn, refs, format)
+        yield from _recv_rev_list(self.conn, parse, format)
         # FIXME: confusing
         not_ok = self.check_ok()
         if not_ok:
@@ -487,19 +952,8 @@ class Client:
         self._require_command(b'resolve')
         self.check_busy()
         self._busy = b'resolve'
-        conn = self.conn
-        conn.write(b'resolve %d\n' % ((1 if want_meta else 0)
-                                      | (2 if follow else 0)
-                                      | (4 if parent else 0)))
-        if parent:
-            protocol.write_resolution(conn, parent)
-        write_bvec(conn, path)
-        success = ord(conn.read(1))
-        assert success in (0, 1)
-        if success:
-            result = protocol.read_resolution(conn)
-        else:
-            result = protocol.read_ioerror(conn)
+        _send_resolve(self.conn, path, parent, want_meta, follow)
+        result = _recv_resolve(self.conn)
         # FIXME: confusing
         not_ok = self.check_ok()
         if not_ok:
@@ -509,6 +963,37 @@ class Client:
             raise result
         return result
 
+    def diff(self, ref1, ref2, recursive=False):
+        """Yield (status, path, isdir) for the differences between the
+        directories ref1 and ref2, as computed by the server (see
+        vfs.diff())."""
+        self._require_command(b'diff')
+        self.check_busy()
+        self._busy = b'diff'
+        conn = self.conn
+        conn.write(b'diff %d\n' % (1 if recursive else 0))
+        write_bvec(conn, ref1)
+        write_bvec(conn, ref2)
+        error = None
+        while True:
+            kind = read_vuint(conn)
+            if kind == protocol.DIFF_END:
+                break
+            if kind == protocol.DIFF_ERROR:
+                error = protocol.read_ioerror(conn)
+                break
+            if kind != protocol.DIFF_ENTRY:
+                raise ClientError('unexpected diff record kind %d' % kind)
+            status, path, isdir = vint.recv(conn, 'ssV')
+            yield status, path, bool(isdir)
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        if error:
+            raise error
+
     def config_get(self, name, opttype=None):
         assert isinstance(name, bytes)
         name = name.lower() # git is case insensitive here
@@ -530,15 +1015,15 @@ class Client:
             val = read_vint(conn)
         elif kind == 4:
             val = read_bvec(conn)
-        elif kind == 5:
-            raise PermissionError(f'config-get does not allow remote access to {name}')
-        else:
+        elif kind != 5:
             raise TypeError(f'Unrecognized result type {kind}')
         # FIXME: confusing
         not_ok = self.check_ok()
         if not_ok:
             raise not_ok
         self._not_busy()
+        if kind == 5:
+            raise PermissionError(f'config-get does not allow remote access to {name}')
         return val
 
     def config_write(self, name, value):
@@ -594,8 +1079,286 @@ class Client:
         self._not_busy()
 
 
+class _Response(BytesIO):
+    """A multiplexed response, read like the connection it came over."""
+    def check_ok(self):
+        for line in linereader(self):
+            if not line:
+                continue
+            if line == b'ok':
+                return None
+            if line.startswith(b'error '):
+                return NotOk(line[6:])
+            raise ClientError('expected "ok", got %r' % line)
+        raise ClientError('multiplexed response ended without "ok"')
+
+
+class AsyncClient:
+    """Send the requests of any number of concurrent tasks over a
+    Client's connection at once, via the server's multiplex command,
+    which tags each request and its response with an id.  It must be
+    created in the event loop it's used from, and the Client is busy
+    until it's closed.  A thread each does the connection's blocking
+    reads and writes, so that they hold up neither the event loop nor
+    each other.
+
+    """
+    def __init__(self, client):
+        self.closed = True  # until we're open
+        client._require_command(b'multiplex')
+        client.check_busy()
+        self._client = client
+        self._conn = client.conn
+        # Bypass the conn, whose writes might read (see DemuxConn)
+        self._outp = client.conn.outp
+        self._loop = asyncio.get_running_loop()
+        self._next_id = 1
+        self._pending = {}  # id -> (future, chunks received)
+        self._reader = ThreadPoolExecutor(1, 'bup-async-client-reader')
+        self._writer = ThreadPoolExecutor(1, 'bup-async-client-writer')
+        client._busy = b'multiplex'
+        self._write(b'multiplex\n')
+        self._receiving = self._loop.create_task(self._receive())
+        self.closed = False
+
+    def __del__(self):
+        assert self.closed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            await self.close()
+
+    async def close(self):
+        """Wait for the outstanding requests, and make the Client
+        available again."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self._receiving.done():
+                await self._loop.run_in_executor(self._writer, self._write,
+                                                 b'\0')
+            await self._receiving
+            not_ok = await self._loop.run_in_executor(self._reader,
+                                                      self._client.check_ok)
+            if not_ok:
+                raise not_ok
+            self._client._not_busy()
+        finally:
+            self._reader.shutdown()
+            self._writer.shutdown()
+
+    def _write(self, data):
+        self._outp.write(data)
+        self._outp.flush()
+
+    def _read_response_chunk(self):
+        req_id = read_vuint(self._conn)
+        if not req_id:
+            return 0, None
+        return req_id, read_bvec(self._conn)
+
+    async def _receive(self):
+        try:
+            while True:
+                req_id, chunk = \
+                    await self._loop.run_in_executor(self._reader,
+                                                     self._read_response_chunk)
+                if not req_id:
+                    break
+                response, chunks = self._pending[req_id]
+                if chunk:
+                    chunks.append(chunk)
+                    continue
+                del self._pending[req_id]
+                if not response.done():  # e.g. cancelled
+                    response.set_result(b''.join(chunks))
+            if self._pending:
+                # the server gave up, e.g. because a request failed
+                not_ok = await self._loop.run_in_executor(self._reader,
+                                                          self._client.check_ok)
+                raise ClientError('multiplex ended with %d unanswered'
+                                  ' requests: %s'
+                                  % (len(self._pending), not_ok))
+        except BaseException as ex:
+            for response, _ in self._pending.values():
+                if not response.done():
+                    response.set_exception(ClientError('multiplex failed: %s'
+                                                       % ex))
+            self._pending.clear()
+            raise
+
+    async def _request(self, cmd, send, recv):
+        if self.closed or self._receiving.done():
+            raise ClientError('multiplexed connection is closed')
+        self._client._require_command(cmd)
+        request = BytesIO()
+        send(request)
+        line, _, body = request.getvalue().partition(b'\n')
+        req_id = self._next_id
+        self._next_id += 1
+        frame = BytesIO()
+        write_vuint(frame, req_id)
+        write_bvec(frame, line)
+        write_bvec(frame, body)
+        response = self._loop.create_future()
+        self._pending[req_id] = (response, [])
+        await self._loop.run_in_executor(self._writer, self._write,
+                                         frame.getvalue())
+        response = _Response(await response)
+        result = recv(response)
+        not_ok = response.check_ok()
+        if not_ok:
+            raise not_ok
+        return result
+
+    async def read_ref(self, refname):
+        return await self._request(b'read-ref',
+                                   lambda conn: _send_read_ref(conn, refname),
+                                   _recv_read_ref)
+
+    async def cat(self, ref):
+        """Return (oidx, type, size, data) for the ref, or (None,
+        None, None, None) if it doesn't exist."""
+        def recv(conn):
+            it = _recv_cat(conn)
+            oidx, typ, size = next(it)
+            if not oidx:
+                return None, None, None, None
+            return oidx, typ, size, b''.join(it)
+        return await self._request(b'cat-batch',
+                                   lambda conn: _send_cat(conn, ref), recv)
+
+    async def refs(self, patterns=None, limit_to_heads=False,
+                   limit_to_tags=False):
+        """Return a list of the (name, oid) pairs Client.refs() yields."""
+        return await self._request(b'refs',
+                                   lambda conn: _send_refs(conn, patterns or (),
+                                                           limit_to_heads,
+                                                           limit_to_tags),
+                                   lambda conn: list(_recv_refs(conn)))
+
+    async def rev_list(self, refs, parse=None, format=None):
+        """Return a list of what Client.rev_list() yields."""
+        if format:
+            assert parse
+        return await self._request(b'rev-list',
+                                   lambda conn: _send_rev_list(conn, refs,
+                                                               format),
+                                   lambda conn: list(_recv_rev_list(conn, parse,
+                                                                    format)))
+
+    async def resolve(self, path, parent=None, want_meta=True, follow=True):
+        result = await self._request(b'resolve',
+                                     lambda conn: _send_resolve(conn, path,
+                                                                parent,
+                                                                want_meta,
+                                                                follow),
+                                     _recv_resolve)
+        if isinstance(result, vfs.IOError):
+            raise result
+        return result
+
+
+class MultiplexingClient:
+    """Provide an AsyncClient's requests to synchronous code: run its
+    event loop in a thread, and offer Client's interface for them
+    (blocking for each result), along with submit() to have any
+    number of them in flight at once.
+
+    """
+    def __init__(self, client):
+        self.closed = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever,
+                              name='bup-multiplexing-client', daemon=True)
+        self._thread.start()
+        try:
+            self.async_client = self._run(self._open(client))
+        except BaseException as ex:
+            with pending_raise(ex):
+                self._stop()
+
+    @staticmethod
+    async def _open(client):
+        return AsyncClient(client)
+
+    def _stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._run(self.async_client.close())
+        finally:
+            self._stop()
+
+    def __del__(self):
+        assert self.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def submit(self, name, *args, **kwargs):
+        """Start the AsyncClient's name request, and return a
+        concurrent.futures.Future for its result."""
+        coroutine = getattr(self.async_client, name)(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def read_ref(self, refname):
+        return self._run(self.async_client.read_ref(refname))
+
+    def cat(self, ref):
+        oidx, typ, size, data = self._run(self.async_client.cat(ref))
+        yield oidx, typ, size
+        if data:
+            yield data
+
+    def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
+        yield from self._run(self.async_client.refs(patterns, limit_to_heads,
+                                                    limit_to_tags))
+
+    def rev_list(self, refs, parse=None, format=None):
+        yield from self._run(self.async_client.rev_list(refs, parse, format))
+
+    def resolve(self, path, parent=None, want_meta=True, follow=True):
+        return self._run(self.async_client.resolve(path, parent, want_meta,
+                                                   follow))
+
+
 # FIXME: disentangle this (stop inheriting) from PackWriter
 class PackWriter_Remote(git.PackWriter):
+    """Writes objects to a remote repository.
+
+    If missing_objects is provided, new objects that aren't in the
+    local object cache are held back and only sent (in batches) after
+    missing_objects() has confirmed that the server doesn't already
+    have them, so existing data doesn't have to cross the wire (and
+    the server won't have to suggest idxs to download).  If a bloom
+    filter for the server's objects is provided too, only those it
+    might contain are held back, the others are sent immediately.
+
+    If resume_objects is provided, the objects sent since the server
+    last finished a pack are kept in a temporary file, and when the
+    connection is lost, resume_objects() is called to reconnect and
+    to find out how many of the objects the server stored, and the
+    rest are sent again.
+
+    """
 
     def __new__(cls, *args, **kwargs):
         result = super().__new__(cls)
@@ -605,6 +1368,8 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
+                 missing_objects=None, bloom=None,
+                 resume_objects=None, server_error=None,
                  compression_level=None,
                  max_pack_size=None,
                  max_pack_objects=None,
@@ -614,7 +1379,8 @@ class PackWriter_Remote(git.PackWriter):
                                 compression_level=compression_level,
                                 max_pack_size=max_pack_size,
                                 max_pack_objects=max_pack_objects,
-                                run_midx=run_midx)
+                                run_midx=run_midx,
+                                write_behind=False, group_sync=False)
         self.remote_closed = False
         self.file = conn
         self.filename = b'remote socket'
@@ -622,6 +1388,17 @@ class PackWriter_Remote(git.PackWriter):
         self.onopen = onopen
         self.onclose = onclose
         self.ensure_busy = ensure_busy
+        self.missing_objects = missing_objects
+        self.bloom = bloom
+        self.resume_objects = resume_objects
+        self.server_error = server_error
+        self._sent = 0  # objects sent in the session
+        self._spool = None
+        self._spool_base = 0  # objects sent before the spooled ones
+        self._spool_ends = []
+        self._pending = []
+        self._pending_ids = set()
+        self._pending_size = 0
         self._packopen = False
         self._bwcount = 0
         self._bwtime = time.time()
@@ -634,25 +1411,138 @@ class PackWriter_Remote(git.PackWriter):
             self.onopen()
             self._packopen = True
 
+    def exists(self, id, want_source=False):
+        if not want_source and id in self._pending_ids:
+            return OBJECT_EXISTS
+        return super().exists(id, want_source=want_source)
+
+    def maybe_write(self, type, content):
+        if not self.missing_objects:
+            return super().maybe_write(type, content)
+        sha = git.calc_hash(type, content)
+        if self.exists(sha):
+            return sha
+        if self.bloom and not self.bloom.exists(sha):
+            # the server can't have it, no need to ask
+            self.just_write(sha, type, content)
+        else:
+            self._pending.append((sha, type, content))
+            self._pending_ids.add(sha)
+            self._pending_size += len(content)
+            if len(self._pending) >= missing_objects_batch \
+               or self._pending_size >= missing_objects_batch_bytes:
+                self._write_pending()
+        return sha
+
+    def _write_pending(self):
+        pending = self._pending
+        if not pending:
+            return
+        # Reset first, just_write() may call breakpoint(), i.e. _end()
+        self._pending = []
+        self._pending_ids = set()
+        self._pending_size = 0
+        oids = [x[0] for x in pending]
+        while True:
+            try:
+                missing = self.missing_objects(oids)
+                break
+            except (ConnectionLost, OSError) as ex:
+                self._resume(ex)
+        for (sha, type, content), send in zip(pending, missing):
+            self._require_objcache()
+            if send:
+                self.just_write(sha, type, content)
+            else:
+                self.objcache.add(sha)
+
     def _end(self):
         # Called by other PackWriter methods like breakpoint().
         # Must not close the connection (self.file)
+        if self.file:
+            self._write_pending()
         self.objcache, objcache = None, self.objcache
         with nullcontext_if_not(objcache):
             if not (self._packopen and self.file):
                 return None
-            self.file.write(b'\0\0\0\0')
-            self._packopen = False
-            self.onclose() # Unbusy
+            idx = None
+            while self._packopen:
+                try:
+                    self.file.write(b'\0\0\0\0')
+                    self._packopen = False
+                    self.onclose() # Unbusy
+                    idx = self.suggest_packs() # Returns last idx received
+                except (ConnectionLost, OSError) as ex:
+                    # If the server stored everything, there's nothing
+                    # left to finish.
+                    self._resume(ex)
+            self._reset_spool()
             if objcache is not None:
                 objcache.close()
-            return self.suggest_packs() # Returns last idx received
+            return idx
+
+    def _reset_spool(self):
+        self._spool_base = self._sent
+        self._spool_ends = []
+        if self._spool:
+            self._spool.seek(0)
+            self._spool.truncate()
+
+    def _resume(self, ex):
+        """Reconnect after losing the connection (i.e. ex), and send
+        the objects the server doesn't have yet again.  If the server
+        reported an error before, raise that instead."""
+        err = self.server_error and self.server_error()
+        if err:
+            raise ClientError('server: %s'
+                              % err.decode('utf-8', 'replace')) from ex
+        if not self.resume_objects:
+            raise ex
+        for attempt in range(reconnect_attempts):
+            delay = reconnect_delay * 2 ** attempt
+            log('client: lost connection (%s), reconnecting in %ds\n'
+                % (ex, delay))
+            time.sleep(delay)
+            try:
+                self.file, count = self.resume_objects()
+            except (ConnectionLost, OSError) as e:
+                ex = e
+                continue
+            self._packopen = False
+            skip = count - self._spool_base
+            if not 0 <= skip <= len(self._spool_ends):
+                raise ClientError('cannot resume from %d of %d objects'
+                                  % (count, self._sent)) from ex
+            debug1('client: resuming after %d of %d objects\n'
+                   % (count, self._sent))
+            if skip == len(self._spool_ends):
+                return
+            try:
+                self._open()
+                start = self._spool_ends[skip - 1] if skip else 0
+                self._spool.seek(start)
+                for buf in chunkyreader(self._spool,
+                                        self._spool_ends[-1] - start):
+                    (self._bwcount, self._bwtime) = _raw_write_bwlimit(
+                        self.file, buf, self._bwcount, self._bwtime,
+                        self._bwlimit)
+                return
+            except (ConnectionLost, OSError) as e:
+                ex = e
+            finally:
+                self._spool.seek(0, os.SEEK_END)
+        raise ClientError('cannot resume sending objects: %s' % ex) from ex
 
     def close(self):
         # Called by inherited __exit__
         self.remote_closed = True
-        id = self._end()
-        self.file = None
+        try:
+            id = self._end()
+        finally:
+            self.file = None
+            if self._spool:
+                self._spool.close()
+                self._spool = None
         super().close()
         return id
 
@@ -668,25 +1558,39 @@ class PackWriter_Remote(git.PackWriter):
         if not self._packopen:
             self._open()
         self.ensure_busy()
-        data = b''.join(datalist)
-        assert(data)
+        datalist = tuple(datalist)
+        size = crc = 0
+        for data in datalist:
+            size += len(data)
+            crc = zlib.crc32(data, crc)
+        assert(size)
         assert(sha)
-        crc = zlib.crc32(data) & 0xffffffff
-        outbuf = b''.join((struct.pack('!I', len(data) + 20 + 4),
+        outbuf = b''.join((struct.pack('!I', size + 20 + 4),
                            sha,
                            struct.pack('!I', crc),
-                           data))
+                           *datalist))
+        if self.resume_objects:
+            if not self._spool:
+                self._spool = tempfile.TemporaryFile()
+            self._spool.write(outbuf)
+            self._spool_ends.append(self._spool.tell())
+        self._sent += 1
         try:
             (self._bwcount, self._bwtime) = _raw_write_bwlimit(
                     self.file, outbuf, self._bwcount, self._bwtime, self._bwlimit)
         except IOError as e:
-            raise ClientError(e) from e
-        self.outbytes += len(data)
+            if not self.resume_objects:
+                raise ClientError(e) from e
+            self._resume(e)
+        self.outbytes += size
         self.count += 1
 
         if self.file.has_input():
             self.objcache.close_temps()
-            self.suggest_packs()
+            try:
+                self.suggest_packs()
+            except (ConnectionLost, OSError) as ex:
+                self._resume(ex)
             self.objcache.refresh()
 
         return sha, crc
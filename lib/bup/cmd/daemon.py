@@ -1,23 +1,355 @@
+import fcntl, getopt, os, socket, subprocess, sys, select, time
+import shutil, signal, tempfile, traceback
 
-import fcntl, getopt, os, socket, subprocess, sys, select
-
-from bup import options, path
-from bup.helpers import log, debug1
+from bup import git, options, path, protocol
+from bup.helpers import Conn, MuxWriter, log, debug1
+from bup.repo import LocalRepo
+import bup.cmd.server
 
 
 optspec = """
 bup daemon [options...] -- [bup-server options...]
 --
-l,listen  ip address to listen on, defaults to *
-p,port    port to listen on, defaults to 1982
+l,listen=  ip address to listen on, defaults to *
+p,port=    port to listen on, defaults to 1982
+w,workers=  serve connections from this many pre-forked workers
+max-writers=  maximum number of workers writing at the same time
 """
 
+
+class _KeptObjcache:
+    """Give a PackWriter the worker's PackIdxList without letting it
+    close the list when it's done with it."""
+    def __init__(self, idxlist):
+        self._idxlist = idxlist
+
+    def __getattr__(self, name):
+        return getattr(self._idxlist, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+
+def _repo_stamp(repo_dir):
+    result = []
+    for name in (b'config', b'bup-dumb-server'):
+        try:
+            st = os.stat(os.path.join(repo_dir, name))
+            result.append((st.st_ino, st.st_mtime_ns))
+        except FileNotFoundError:
+            result.append(None)
+    return result
+
+
+class _WriterSlots:
+    """Limit the number of workers writing at the same time to
+    count, by having each writer hold an flock() on one of count
+    files, so that the kernel releases the slot of a worker that dies
+    (e.g. is killed) while writing.  A slot is taken by a worker
+    (i.e. after the fork), since the lock belongs to the open file.
+
+    """
+    def __init__(self, count):
+        self._dir = tempfile.mkdtemp(prefix=b'bup-daemon-')
+        self._paths = [os.path.join(self._dir, b'writer-%d' % i)
+                       for i in range(count)]
+        for slot in self._paths:
+            open(slot, 'wb').close()
+        self._held = None
+
+    def _take_free_slot(self):
+        for slot in self._paths:
+            f = open(slot, 'rb')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            self._held = f
+            return True
+        return False
+
+    def acquire(self, block=True):
+        assert self._held is None
+        while not self._take_free_slot():
+            if not block:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def release(self):
+        self._held, f = None, self._held
+        f.close()  # releases the lock
+
+    def remove(self):
+        shutil.rmtree(self._dir)
+
+
+class _WorkerRepo(LocalRepo):
+    """A LocalRepo that a worker keeps between connections, along
+    with its configuration and the PackIdxList (i.e. the idx, midx,
+    and bloom mmaps) for its objects.  It limits the number of
+    concurrent writers via the writer slots, and serializes ref
+    updates across workers.
+
+    """
+    def __init__(self, repo_dir, writers):
+        self._config = {}
+        self._idxlist = None
+        self._writers = writers
+        self._writing = False
+        self.stamp = _repo_stamp(repo_dir)
+        super().__init__(repo_dir, server=True)
+        if self.objcache_maker is None:  # i.e. not a dumb server
+            self.objcache_maker = self._objcache
+
+    def reopen(self):
+        self.closed = False
+
+    def dispose(self):
+        try:
+            if not self.closed:
+                self.close()
+        finally:
+            if self._idxlist:
+                self._idxlist, idxlist = None, self._idxlist
+                idxlist.close()
+
+    def config_get(self, name, opttype=None):
+        key = (name.lower(), opttype)
+        if key not in self._config:
+            self._config[key] = super().config_get(name, opttype=opttype)
+        return self._config[key]
+
+    def _objcache(self, repo_dir):
+        if self._idxlist is None:
+            self._idxlist = \
+                git.PackIdxList(self.packdir(),
+                                max_open=self.config_get(b'bup.pack.max-open-idxs',
+                                                         opttype='int'),
+                                max_mapped=self.config_get(b'bup.pack.max-mapped-idxs',
+                                                           opttype='int'))
+        else:
+            self._idxlist.refresh()
+        return _KeptObjcache(self._idxlist)
+
+    def _ensure_packwriter(self):
+        if not self._packwriter and not self._writing and self._writers:
+            if not self._writers.acquire(block=False):
+                debug1('bup daemon: waiting for other writers\n')
+                self._writers.acquire()
+            self._writing = True
+        super()._ensure_packwriter()
+
+    def _done_writing(self):
+        if self._writing:
+            self._writing = False
+            self._writers.release()
+
+    def finish_writing(self):
+        try:
+            return super().finish_writing()
+        finally:
+            self._done_writing()
+
+    def abort_writing(self):
+        try:
+            super().abort_writing()
+        finally:
+            self._done_writing()
+
+    def _locked_refs(self):
+        f = open(os.path.join(self.repo_dir, b'bup-refs.lock'), 'ab')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f  # closing it releases the lock
+
+    def update_ref(self, refname, newval, oldval):
+        self.finish_writing()
+        with self._locked_refs():
+            return super().update_ref(refname, newval, oldval)
+
+    def delete_ref(self, refname, oldval=None):
+        with self._locked_refs():
+            return super().delete_ref(refname, oldval)
+
+
+class _WorkerRepos:
+    """The backend for the protocol.Server instances of a worker,
+    keeps the last repository used open for the next connection,
+    unless its configuration changed."""
+    def __init__(self, force_repo, writers):
+        self.force_repo = force_repo
+        self.writers = writers
+        self.repo = None
+
+    def create(self, repo_dir):
+        LocalRepo.create(repo_dir)
+
+    def __call__(self, repo_dir, server):
+        assert server
+        if self.force_repo:
+            repo_dir = None
+        repo_dir = os.path.realpath(repo_dir or git.guess_repo())
+        repo = self.repo
+        if repo and (repo.repo_dir != repo_dir
+                     or repo.stamp != _repo_stamp(repo_dir)):
+            self.discard()
+        if self.repo:
+            self.repo.reopen()
+        else:
+            self.repo = _WorkerRepo(repo_dir, self.writers)
+        return self.repo
+
+    def discard(self):
+        self.repo, repo = None, self.repo
+        if repo:
+            repo.dispose()
+
+
+def _serve_connection(sock, repos, mode):
+    sock.setblocking(True)
+    try:
+        with sock.makefile('rb') as inp, MuxWriter(sock.fileno()) as out:
+            try:
+                with Conn(inp, out) as conn, \
+                     protocol.Server(conn, repos, mode=mode) as server:
+                    server.handle()
+            except Exception as ex:
+                # The state of the repo is unknown, don't reuse it
+                try:
+                    repos.discard()
+                except Exception:
+                    pass
+                if isinstance(ex, ConnectionError):
+                    raise
+                msg = traceback.format_exc().encode(errors='backslashreplace')
+                log(msg.decode(errors='replace'))
+                out.write_stderr(msg)
+    except ConnectionError as ex:
+        debug1('bup daemon: worker %d lost connection: %s\n'
+               % (os.getpid(), ex))
+
+
+def _worker(socks, repos, mode):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        while True:
+            rl, _, _ = select.select(socks, [], [])
+            for l in rl:
+                try:
+                    s, src = l.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue  # another worker got it
+                with s:
+                    debug1('bup daemon: worker %d serving %s\n'
+                           % (os.getpid(), src))
+                    _serve_connection(s, repos, mode)
+    finally:
+        try:
+            repos.discard()
+        finally:
+            git.close_catpipes()
+
+
+def _start_worker(socks, repos, mode):
+    pid = os.fork()
+    if pid:
+        return pid
+    rc = 1
+    try:
+        _worker(socks, repos, mode)
+    except KeyboardInterrupt:
+        rc = 130
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(rc)
+
+
+def _run_workers(socks, count, max_writers, server_args):
+    so = options.Options(bup.cmd.server.optspec)
+    sopt, sflags, sextra = so.parse_bytes(server_args)
+    if sextra:
+        so.fatal('no arguments expected')
+    if sopt.mode is not None \
+       and sopt.mode not in ('unrestricted', 'append', 'read-append', 'read'):
+        so.fatal('invalid mode')
+    writers = _WriterSlots(max_writers) if max_writers else None
+    for s in socks:
+        s.setblocking(False)
+    repos = _WorkerRepos(sopt.force_repo, writers)
+    workers = {}
+    # Make sure the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while len(workers) < count:
+                workers[_start_worker(socks, repos, sopt.mode)] = time.time()
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            if status:
+                log('bup daemon: worker %d exited with status %d\n'
+                    % (pid, status))
+                if time.time() - started < 1:
+                    time.sleep(1)  # don't restart failing workers too fast
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        if writers:
+            writers.remove()
+
+
+def _run_subprocesses(socks, server_args):
+    while True:
+        [rl,wl,xl] = select.select(socks, [], [], 60)
+        for l in rl:
+            s, src = l.accept()
+            try:
+                log("Socket accepted connection from %s\n" % (src,))
+                fd1 = os.dup(s.fileno())
+                fd2 = os.dup(s.fileno())
+                s.close()
+                sp = subprocess.Popen([path.exe(), 'mux', '--',
+                                       path.exe(), 'server']
+                                      + server_args, stdin=fd1, stdout=fd2)
+            finally:
+                os.close(fd1)
+                os.close(fd2)
+
+
 def main(argv):
     o = options.Options(optspec, optfunc=getopt.getopt)
     opt, flags, extra = o.parse_bytes(argv[1:])
 
     host = opt.listen
+    if isinstance(host, bytes):
+        host = host.decode('ascii')
     port = opt.port and int(opt.port) or 1982
+    workers = int(opt.workers or 0)
+    max_writers = int(opt.max_writers or 0)
+    if workers < 0 or max_writers < 0:
+        o.fatal('--workers and --max-writers must not be negative')
+    if max_writers and not workers:
+        o.fatal('--max-writers requires --workers')
     socks = []
     e = None
     for res in socket.getaddrinfo(host, port, socket.AF_UNSPEC,
@@ -34,7 +366,7 @@ def main(argv):
                 log("bup daemon: listening on %s:%s\n" % sa[:2])
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind(sa)
-            s.listen(1)
+            s.listen(max(1, workers))
             fcntl.fcntl(s.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
         except socket.error as e:
             s.close()
@@ -46,21 +378,10 @@ def main(argv):
         sys.exit(1)
 
     try:
-        while True:
-            [rl,wl,xl] = select.select(socks, [], [], 60)
-            for l in rl:
-                s, src = l.accept()
-                try:
-                    log("Socket accepted connection from %s\n" % (src,))
-                    fd1 = os.dup(s.fileno())
-                    fd2 = os.dup(s.fileno())
-                    s.close()
-                    sp = subprocess.Popen([path.exe(), 'mux', '--',
-                                           path.exe(), 'server']
-                                          + extra, stdin=fd1, stdout=fd2)
-                finally:
-                    os.close(fd1)
-                    os.close(fd2)
+        if workers:
+            _run_workers(socks, workers, max_writers, extra)
+        else:
+            _run_subprocesses(socks, extra)
     finally:
         for l in socks:
             l.shutdown(socket.SHUT_RDWR)
@@ -1,14 +1,17 @@
 
 
 from bup import options
-from bup.gc import bup_gc
+from bup.compat import argv_bytes
+from bup.gc import bup_gc, bup_gc_encrypted
 from bup.helpers import die_if_errors
-from bup.repo import LocalRepo
+from bup.repo import LocalRepo, make_repo
+from bup.repo.encrypted import EncryptedRepo
 
 
 optspec = """
 bup gc [options...]
 --
+r,remote=      config:///path/to/repo.conf of an encrypted repository
 v,verbose      increase log output (can be used more than once)
 threshold=     only rewrite a packfile if it's over this percent garbage [10]
 #,compress=    set compression level to # (0-9, 9 is highest) [1]
@@ -37,10 +40,20 @@ def main(argv):
         if opt.threshold < 0 or opt.threshold > 100:
             o.fatal('threshold must be an integer percentage value')
 
-    with LocalRepo() as repo:
-        bup_gc(repo, threshold=opt.threshold,
-               compression=opt.compress,
-               verbosity=opt.verbose,
-               ignore_missing=opt.ignore_missing)
+    if opt.remote:
+        with make_repo(argv_bytes(opt.remote)) as repo:
+            if not isinstance(repo, EncryptedRepo):
+                o.fatal('only encrypted repositories can be collected remotely')
+            if repo.readkey is None:
+                o.fatal('collecting garbage requires the readkey')
+            bup_gc_encrypted(repo, threshold=opt.threshold,
+                             verbosity=opt.verbose,
+                             ignore_missing=opt.ignore_missing)
+    else:
+        with LocalRepo() as repo:
+            bup_gc(repo, threshold=opt.threshold,
+                   compression=opt.compress,
+                   verbosity=opt.verbose,
+                   ignore_missing=opt.ignore_missing)
 
     die_if_errors()
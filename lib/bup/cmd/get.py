@@ -1,10 +1,10 @@
 
 from binascii import hexlify, unhexlify
 from collections import namedtuple
-from stat import S_ISDIR, S_ISLNK
+from stat import S_ISDIR
 import os, sys, textwrap, time
 
-from bup import compat, git, vfs, repo
+from bup import compat, git, protocol, vfs, repo
 from bup.compat import (
     argv_bytes,
     bytes_from_byte,
@@ -13,10 +13,10 @@ from bup.compat import (
 )
 from bup.git import MissingObject, parse_commit
 from bup.helpers import debug1, log, note_error, saved_errors
-from bup.helpers import hostname, tty_width
+from bup.helpers import hostname, nullcontext_if_not, tty_width
 from bup.io import path_msg
 from bup.pwdgrp import userfullname, username
-from bup.repo import LocalRepo
+from bup.repo import LocalRepo, RemoteRepo
 
 argspec = (
     "usage: bup get [-s source] [-r remote] (<--ff|--append|...> REF [DEST])...",
@@ -33,7 +33,7 @@ argspec = (
        'increase log output (can be specified more than once)'),
       ('-q, --quiet', "don't show progress meter"),
       ('-s SOURCE, --source SOURCE',
-       'path to the source repository (defaults to BUP_DIR)'),
+       'path or URL of the source repository (defaults to BUP_DIR)'),
       ('-r REMOTE, --remote REMOTE',
        'hostname:/path/to/repo of remote destination repository'),
       ('-t --print-trees', 'output a tree id for each ref set'),
@@ -123,6 +123,8 @@ def parse_args(args):
     opt.compress = None
     opt.ignore_missing = False
     opt.source = opt.remote = None
+    opt.walk_on_source = False
+    opt.dest_bloom = None
     opt.target_specs = []
 
     remaining = args[1:]  # Skip argv[0]
@@ -188,7 +190,33 @@ def parse_args(args):
 
 # FIXME: walk_object in in git.py doesn't support opt.verbose.  Do we
 # need to adjust for that here?
+def get_walked_item(hash, src_repo, dest_repo, opt):
+    # Have the (remote) source walk the graph and send everything the
+    # destination's bloom filter (if any) says it lacks in one go.
+    # Whatever the filter claims the destination has comes back as a
+    # WALK_HAVE, and is fetched in another round if that turns out to
+    # be a false positive.
+    roots = [unhexlify(hash)]
+    while roots:
+        maybe_have = []
+        for kind, oid, typ, data, metadata \
+                in src_repo.walk_objects(roots, have=opt.dest_bloom):
+            if kind == protocol.WALK_HAVE:
+                maybe_have.append(oid)
+            elif kind == protocol.WALK_MISSING:
+                if not opt.ignore_missing:
+                    raise MissingObject(oid)
+                note_error(f'skipping missing source object {oid.hex()}\n')
+            elif not dest_repo.exists(oid):
+                dest_repo.just_write(oid, typ, data, metadata=metadata)
+        roots = [oid for oid in maybe_have if not dest_repo.exists(oid)]
+
+
 def get_random_item(name, hash, src_repo, dest_repo, opt):
+    if opt.walk_on_source:
+        if dest_repo.exists(unhexlify(hash)):
+            return
+        return get_walked_item(hash, src_repo, dest_repo, opt)
     def already_seen(oid):
         return dest_repo.exists(unhexlify(oid))
     for item in src_repo.walk_object(hash, stop_at=already_seen,
@@ -200,14 +228,8 @@ def get_random_item(name, hash, src_repo, dest_repo, opt):
             continue
         # already_seen ensures that dest_repo.exists(id) is false.
         # Otherwise, just_write() would fail.
-        metadata = False
-        if item.type in (b'tree', b'commit'):
-            metadata = True
-        elif (item.type == b'blob' and
-              ((item.mode is not None and S_ISLNK(item.mode)) or
-               (item.path and item.path[-1] == b'.bupm'))):
-            metadata = True
-        dest_repo.just_write(item.oid, item.type, item.data, metadata=metadata)
+        dest_repo.just_write(item.oid, item.type, item.data,
+                             metadata=git.walk_item_is_metadata(item))
 
 
 def append_commit(name, hash, parent, src_repo, dest_repo, opt):
@@ -403,7 +425,8 @@ def handle_ff(item, src_repo, dest_repo, opt):
     assert item.src.type in ('branch', 'save', 'commit')
     src_oidx = hexlify(item.src.hash)
     dest_oidx = hexlify(item.dest.hash) if item.dest.hash else None
-    if not dest_oidx or dest_oidx in src_repo.rev_list(src_oidx):
+    # Finish the rev-list, the source may be remote
+    if not dest_oidx or dest_oidx in tuple(src_repo.rev_list(src_oidx)):
         # Can fast forward.
         get_random_item(item.spec.src, src_oidx, src_repo, dest_repo, opt)
         commit_items = parse_commit(src_repo.get_data(src_oidx, b'commit'))
@@ -616,6 +639,25 @@ def log_item(name, type, opt, tree=None, commit=None, tag=None):
                 last = '/'
         log('%s%s\n' % (path_msg(name), last))
 
+def open_source(source):
+    if source and repo.is_url(source):
+        return repo.make_repo(source)
+    return LocalRepo(repo_dir=source)
+
+
+def can_walk_objects(src_repo):
+    return isinstance(src_repo, RemoteRepo) and src_repo.can_walk_objects()
+
+
+def open_dest_bloom(src_repo, dest_repo):
+    if not can_walk_objects(src_repo):
+        return None
+    try:
+        return dest_repo.open_bloom()
+    except NotImplementedError:
+        return None
+
+
 def main(argv):
     is_reverse = environ.get(b'BUP_SERVER_REVERSE')
     opt = parse_args(argv)
@@ -624,7 +666,11 @@ def main(argv):
     dest_repo = repo.from_opts(opt)
 
     with dest_repo as dest_repo:
-        with LocalRepo(repo_dir=opt.source) as src_repo:
+        with open_source(opt.source) as src_repo, \
+             nullcontext_if_not(open_dest_bloom(src_repo, dest_repo)) \
+             as dest_bloom:
+            opt.walk_on_source = can_walk_objects(src_repo)
+            opt.dest_bloom = dest_bloom
             # Resolve and validate all sources and destinations,
             # implicit or explicit, and do it up-front, so we can
             # fail before we start writing (for any obviously
@@ -10,7 +10,8 @@ from bup.compat import argv_bytes, environ
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE, GIT_MODE_SYMLINK
 from bup.helpers import (add_error, grafted_path_components, handle_ctrl_c,
                          hostname, istty2, log, parse_date_or_fatal, parse_num,
-                         path_components, ProgressBar, resolve_parent,
+                         path_components, period_as_secs, ProgressBar,
+                         resolve_parent,
                          saved_errors, stripped_path_components,
                          valid_save_name)
 from bup.io import byte_stream, path_msg
@@ -30,6 +31,7 @@ v,verbose  increase log output (can be used more than once)
 q,quiet    don't show progress meter
 smaller=   only back up files smaller than n bytes
 bwlimit=   maximum bytes/sec to transmit to server
+checkpoint= finish the current pack and update the index every period (e.g. 15min)
 f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
 strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
@@ -68,6 +70,14 @@ def opts_from_cmdline(argv):
     opt.progress = (istty2 and not opt.quiet)
     opt.smaller = parse_num(opt.smaller or 0)
 
+    if opt.checkpoint:
+        secs = period_as_secs(argv_bytes(opt.checkpoint))
+        if secs is None or secs == float('inf'):
+            o.fatal('invalid checkpoint period %r' % opt.checkpoint)
+        opt.checkpoint = secs
+    else:
+        opt.checkpoint = None
+
     if opt.strip and opt.strip_path:
         o.fatal("--strip is incompatible with --strip-path")
 
@@ -127,8 +137,24 @@ def save_tree(opt, reader, hlink_db, msr, repo, blobbits):
     _nonlocal['count'] = 0
     _nonlocal['subcount'] = 0
     _nonlocal['lastremain'] = None
+    _nonlocal['lastcheckpoint'] = time.time()
     pb = None
 
+    def maybe_checkpoint():
+        # Make everything written so far durable so that a save that
+        # is interrupted can be resumed: finishing the pack commits
+        # the objects, and the index entries that have already been
+        # validated (ent.repack()) will then be skipped by the next
+        # save via already_saved().
+        if opt.checkpoint is None:
+            return
+        now = time.time()
+        if now - _nonlocal['lastcheckpoint'] < opt.checkpoint:
+            return
+        repo.finish_writing()
+        reader.save()
+        _nonlocal['lastcheckpoint'] = time.time()
+
     def progress_report(file, n):
         _nonlocal['subcount'] += n
         cc = _nonlocal['count'] + _nonlocal['subcount']
@@ -217,6 +243,7 @@ def save_tree(opt, reader, hlink_db, msr, repo, blobbits):
       pb = _pb
       for transname, ent in reader.filter(opt.sources,
                                           wantrecurse=wantrecurse_during):
+        maybe_checkpoint()
         (dir, file) = os.path.split(ent.name)
         exists = (ent.flags & index.IX_EXISTS)
         already_saved_oid = already_saved(ent)
@@ -359,6 +386,7 @@ def save_tree(opt, reader, hlink_db, msr, repo, blobbits):
                     meta.size = 0
                     def write_data(data):
                         meta.size += len(data)
+                        maybe_checkpoint()
                         return repo.write_data(data)
                     before_saving_regular_file(ent.name)
                     with hashsplit.open_noatime(ent.name) as f:
@@ -121,9 +121,13 @@ def report_live_item(n, total, ref_name, ref_id, item, verbosity):
 
 
 def find_live_objects(repo, existing_count, idx_list, refs=None,
-                      verbosity=0, count_missing=False):
-    pack_dir = repo.packdir()
-    ffd, bloom_filename = tempfile.mkstemp(b'.bloom', b'tmp-gc-', pack_dir)
+                      verbosity=0, count_missing=False, tmpdir=None,
+                      meta_blobs=None):
+    """Add the oid of every live blob that counts as metadata (see
+    git.walk_item_is_metadata()) to meta_blobs if it's not None."""
+    if tmpdir is None:
+        tmpdir = repo.packdir()
+    ffd, bloom_filename = tempfile.mkstemp(b'.bloom', b'tmp-gc-', tmpdir)
     os.close(ffd)
     # FIXME: allow selection of k?
     # FIXME: support ephemeral bloom filters (i.e. *never* written to disk)
@@ -159,6 +163,9 @@ def find_live_objects(repo, existing_count, idx_list, refs=None,
                     if verbosity and not live_blobs.exists(item.oid):
                         approx_live_count += 1
                     live_blobs.add(item.oid)
+                    if meta_blobs is not None \
+                       and git.walk_item_is_metadata(item):
+                        meta_blobs.add(item.oid)
         maybe_close_bloom.pop_all()
         if count_missing:
             return live_blobs, live_trees, missing
@@ -274,6 +281,128 @@ def sweep(repo, live_objects, live_trees, existing_count, threshold,
                / float(existing_count) * 100))
 
 
+def sweep_encrypted(repo, live_objects, live_trees, meta_blobs,
+                    existing_count, threshold, verbosity):
+    """Like sweep(), but for an encrypted repository.  The object types
+    come from the (cached) idxes, which store them in place of the
+    crc, the live objects of the packs being rewritten are fetched
+    in batches, and the superseded packs are only removed, all at
+    once, after the new packs have been stored.  The live objects
+    of metadata packs, and the live meta_blobs, are rewritten to
+    metadata packs."""
+    stale_idxes = []
+    collect_count = 0
+    try:
+        for idx_name in glob.glob(os.path.join(repo.cachedir, b'pack-*.idx')):
+            if verbosity:
+                qprogress('preserving live data (%d%% complete)\r'
+                          % ((float(collect_count) / existing_count) * 100))
+            must_rewrite = False
+            # Trees and commits are only in metadata packs (see
+            # bup.separatemeta), and the rest of such a pack's objects
+            # must stay with them.
+            is_meta_pack = False
+            live_in_this_pack = []
+            with git.open_idx(idx_name) as idx:
+                idx_count = len(idx)
+                for sha in idx:
+                    crc = idx.exists(sha, want_offset=True, want_crc=True).crc
+                    typ = git._typermap[crc]
+                    if typ != b'blob':
+                        is_meta_pack = True
+                        is_live = sha in live_trees
+                        if not is_live:
+                            must_rewrite = True
+                    else:
+                        is_live = live_objects.exists(sha)
+                    if is_live:
+                        live_in_this_pack.append((sha, typ))
+
+            collect_count += len(live_in_this_pack)
+            if not live_in_this_pack:
+                if verbosity:
+                    log('deleting %s\n' % path_msg(basename(idx_name)))
+                    reprogress()
+                stale_idxes.append(basename(idx_name))
+                continue
+
+            live_frac = len(live_in_this_pack) / float(idx_count)
+            if not must_rewrite and live_frac > ((100 - threshold) / 100.0):
+                if verbosity:
+                    keep_path = path_msg(basename(idx_name))
+                    log(f'keeping {keep_path} ({live_frac * 100}% live)\n')
+                    reprogress()
+                continue
+
+            if verbosity:
+                rw_path = path_msg(basename(idx_name))
+                log(f'rewriting {rw_path} ({live_frac * 100:.2}% live)\n')
+                reprogress()
+            objects = repo.get_many(hexlify(sha) for sha, typ in live_in_this_pack)
+            for (sha, typ), (oidx, got_typ, _, data) in zip(live_in_this_pack,
+                                                           objects):
+                assert got_typ == typ
+                repo.rewrite(sha, typ, data,
+                             metadata=is_meta_pack or sha in meta_blobs)
+            stale_idxes.append(basename(idx_name))
+
+        if verbosity:
+            progress('preserving live data (%d%% complete)\n'
+                     % ((float(collect_count) / existing_count) * 100))
+        repo.finish_writing()
+    except BaseException as ex:
+        with pending_raise(ex):
+            repo.abort_writing()
+
+    if stale_idxes:
+        if verbosity:
+            log('removing %d packs\n' % len(stale_idxes))
+        repo.remove_packs(stale_idxes)
+
+    if verbosity:
+        log('discarded %d%% of objects\n'
+            % ((existing_count - count_objects(repo.cachedir, verbosity))
+               / float(existing_count) * 100))
+
+
+def bup_gc_encrypted(repo, threshold=10, verbosity=0, ignore_missing=False):
+    # everything below relies on the idx cache being complete
+    repo.sync_indexes()
+    existing_count = count_objects(repo.cachedir, verbosity)
+    if verbosity:
+        log('found %d objects\n' % existing_count)
+        reprogress()
+    if not existing_count:
+        if verbosity:
+            log('nothing to collect\n')
+        return
+    meta_blobs = set()
+    try:
+        found = find_live_objects(repo, existing_count,
+                                  repo.idxlist if ignore_missing else None,
+                                  verbosity=verbosity,
+                                  count_missing=ignore_missing,
+                                  tmpdir=repo.cachedir,
+                                  meta_blobs=meta_blobs)
+        live_objects, live_trees = found[:2]
+        if verbosity:
+            log('expecting to retain about %.2f%% unnecessary objects\n'
+                % live_objects.pfalse_positive())
+            reprogress()
+    except MissingObject as ex:
+        log('bup: missing object %r \n' % hexstr(ex.oid))
+        sys.exit(EXIT_FAILURE)
+    with live_objects:
+        try:
+            if verbosity: log('removing unreachable data\n')
+            sweep_encrypted(repo, live_objects, live_trees, meta_blobs,
+                            existing_count, threshold, verbosity)
+        except BaseException as ex:
+            log('WARNING: Collection interrupted.  Run gc (again) to completion before\n'
+                'WARNING: adding any new data to the repository (e.g. via save or get).\n')
+            raise ex
+
+
 def bup_gc(repo, threshold=10, compression=1, verbosity=0, ignore_missing=False):
     repodir = os.path.join(repo.packdir(), b'..', b'..')
     existing_count = count_objects(repo.packdir(), verbosity)
@@ -9,7 +9,9 @@ from binascii import hexlify, unhexlify
 from collections import namedtuple
 from contextlib import ExitStack
 from itertools import islice
+from queue import Queue
 from shutil import rmtree
+from threading import Thread
 
 from bup import _helpers, hashsplit, path, midx, bloom, xstat
 from bup.compat import (bytes_from_byte, bytes_from_uint,
@@ -441,22 +443,11 @@ class PackIdx:
         global _total_searches, _total_steps
         _total_searches += 1
         assert(len(hash) == 20)
-        b1 = hash[0]
-        start = self.fanout[b1-1] # range -1..254
-        end = self.fanout[b1] # range 0..255
-        want = hash
-        _total_steps += 1  # lookup table is a step
-        while start < end:
-            _total_steps += 1
-            mid = start + (end - start) // 2
-            v = self._idx_to_hash(mid)
-            if v < want:
-                start = mid+1
-            elif v > want:
-                end = mid
-            else: # got it!
-                return mid
-        return None
+        idx, steps = _helpers.find_sha(self.map, hash, self.fanout_ofs, 8,
+                                       self.sha_table_ofs, self.sha_stride,
+                                       self.nsha)
+        _total_steps += steps
+        return idx
 
 
 class PackIdxV1(PackIdx):
@@ -472,6 +463,10 @@ class PackIdxV1(PackIdx):
         self.fanout.append(0)  # entry "-1"
         self.nsha = self.fanout[255]
         self.sha_ofs = 256 * 4
+        self.fanout_ofs = 0
+        # each entry is a 4-byte offset followed by the sha
+        self.sha_table_ofs = self.sha_ofs + 4
+        self.sha_stride = 24
         # Avoid slicing shatable for individual hashes (very high overhead)
         assert self.nsha
         self.shatable = \
@@ -537,6 +532,9 @@ class PackIdxV2(PackIdx):
         self.fanout.append(0)
         self.nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
+        self.fanout_ofs = 8
+        self.sha_table_ofs = self.sha_ofs
+        self.sha_stride = 20
         self.crctable_ofs = self.sha_ofs + self.nsha * 20
         self.ofstable_ofs = self.crctable_ofs + self.nsha * 4
         self.ofs64table_ofs = self.ofstable_ofs + self.nsha * 4
@@ -603,9 +601,84 @@ class PackIdxV2(PackIdx):
         assert self.closed
 
 
+class _LazyPackIdx:
+    """A pack idx in a PackIdxList that's only opened when it's
+    actually needed, and may be closed again by the list at any time
+    to stay within its limits."""
+    def __init__(self, filename, idxlist):
+        self.name = filename
+        self.idxnames = [filename]
+        self._idxlist = idxlist
+        self._idx = None
+        with open(filename, 'rb') as f:
+            version = _idx_version(filename, f.read(8))
+            f.seek(8 + 255 * 4 if version == 2 else 255 * 4)
+            count = f.read(4)
+            if len(count) != 4:
+                raise GitError('%s: truncated idx file' % path_msg(filename))
+            self.nsha = struct.unpack('!I', count)[0]
+            self.size = os.fstat(f.fileno()).st_size
+
+    def _get(self):
+        if self._idx is None:
+            self._idxlist._make_room(self)
+            self._idx = open_idx(self.name)
+        self._idxlist._used(self)
+        return self._idx
+
+    def _unmap(self):
+        self._idx, idx = None, self._idx
+        if idx:
+            idx.close()
+
+    def exists(self, hash, want_source=False, want_offset=False,
+               want_crc=False):
+        return self._get().exists(hash, want_source=want_source,
+                                  want_offset=want_offset, want_crc=want_crc)
+
+    def find_offset(self, hash):
+        return self._get().find_offset(hash)
+
+    def __len__(self):
+        return self.nsha
+
+    def __iter__(self):
+        # Use a separate map so the list can't close it underneath us
+        with open_idx(self.name) as idx:
+            yield from idx
+
+    def close(self):
+        self._idxlist._forget(self)
+        self._unmap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+
+# Defaults for the number and total size of the idx files a
+# PackIdxList keeps open at the same time.  Each one needs a file
+# descriptor and (address space for) a mapping.
+max_open_idxs = 256
+max_mapped_idxs = 1 << 30
+
+
 _mpi_count = 0
 class PackIdxList:
-    def __init__(self, dir, ignore_midx=False):
+    """The objects in all the pack idx (and midx) files in dir.
+
+    Plain idx files are only opened when they have to be searched,
+    i.e. when an object isn't found in the midx files and isn't ruled
+    out by the bloom filter, and no more than max_open of them
+    (together no larger than max_mapped bytes) are kept open, closing
+    the least recently used ones first.
+
+    """
+    def __init__(self, dir, ignore_midx=False, max_open=None,
+                 max_mapped=None):
         global _mpi_count
         # Q: was this also intended to prevent opening multiple repos?
         assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
@@ -614,6 +687,10 @@ class PackIdxList:
         self.dir = dir
         self.also = set()
         self.packs = []
+        self.max_open = max_open or max_open_idxs
+        self.max_mapped = max_mapped or max_mapped_idxs
+        self._mapped_idxs = {} # in least recently used order
+        self._mapped_size = 0
         self.do_bloom = False
         self.bloom = None
         self.ignore_midx = ignore_midx
@@ -656,6 +733,24 @@ class PackIdxList:
     def __len__(self):
         return sum(len(pack) for pack in self.packs)
 
+    def _make_room(self, ix):
+        mapped = self._mapped_idxs
+        while mapped and (len(mapped) >= self.max_open
+                          or self._mapped_size + ix.size > self.max_mapped):
+            lru = next(iter(mapped))
+            self._forget(lru)
+            lru._unmap()
+
+    def _used(self, ix):
+        mapped = self._mapped_idxs
+        if mapped.pop(ix, None) is None:
+            self._mapped_size += ix.size
+        mapped[ix] = True
+
+    def _forget(self, ix):
+        if self._mapped_idxs.pop(ix, None):
+            self._mapped_size -= ix.size
+
     def exists(self, hash, want_source=False, want_offset=False, want_crc=False):
         """Return an ObjectLocation if the object exists in this
            index, otherwise None."""
@@ -669,9 +764,8 @@ class PackIdxList:
             else:
                 _total_searches -= 1  # was counted by bloom
                 return None
-        for i in range(len(self.packs)):
-            p = self.packs[i]
-            get_src = want_source
+        packs = self.packs
+        for i, p in enumerate(packs):
             if isinstance(p, midx.PackMidx):
                 get_src = want_source or want_offset or want_crc
                 # cannot retrieve directly, look up in src idx
@@ -684,8 +778,11 @@ class PackIdxList:
             _total_searches -= 1  # will be incremented by sub-pack
             ret = p.exists(hash, want_source=get_src, want_offset=get_ofs, want_crc=get_crc)
             if ret:
-                # reorder so most recently used packs are searched first
-                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                # Search the pack that had the object first next time;
+                # swapping it with the current first one is enough for
+                # that, and avoids rearranging the whole list.
+                if i:
+                    packs[0], packs[i] = p, packs[0]
                 if (want_offset and ret.offset is None) or (want_crc and ret.crc is None):
                     with open_idx(os.path.join(self.dir, ret.pack)) as np:
                         ret = np.exists(hash, want_source=want_source,
@@ -771,7 +868,7 @@ class PackIdxList:
                     any_needed = False
                     for sub in ix.idxnames:
                         found = d.get(os.path.join(self.dir, sub))
-                        if not found or isinstance(found, PackIdx):
+                        if not found or not isinstance(found, midx.PackMidx):
                             # doesn't exist, or exists but not in a midx
                             any_needed = True
                             break
@@ -787,7 +884,7 @@ class PackIdxList:
             for full in glob.glob(os.path.join(self.dir, b'*.idx')):
                 if not d.get(full):
                     try:
-                        ix = open_idx(full)
+                        ix = _LazyPackIdx(full, self)
                     except GitError as e:
                         add_error(e)
                         continue
@@ -822,27 +919,29 @@ class PackIdxList:
         self.also.add(hash)
 
 
+def _idx_version(filename, header):
+    if header[0:4] == b'\377tOc':
+        version = struct.unpack('!I', header[4:8])[0]
+        if version == 2:
+            return 2
+        raise GitError('%s: expected idx file version 2, got %d'
+                       % (path_msg(filename), version))
+    elif len(header) == 8 and header[0:4] < b'\377tOc':
+        return 1
+    raise GitError('%s: unrecognized idx file header' % path_msg(filename))
+
+
 def open_idx(filename):
     if not filename.endswith(b'.idx'): # why is this enforced *here*?
         raise GitError('pack idx filenames must end with .idx')
     f = open(filename, 'rb')
     with ExitStack() as contexts:
         contexts.enter_context(f)
-        header = f.read(8)
-        if header[0:4] == b'\377tOc':
-            version = struct.unpack('!I', header[4:8])[0]
-            if version == 2:
-                contexts.pop_all()
-                return PackIdxV2(filename, f)
-            else:
-                raise GitError('%s: expected idx file version 2, got %d'
-                               % (path_msg(filename), version))
-        elif len(header) == 8 and header[0:4] < b'\377tOc':
-            contexts.pop_all()
-            return PackIdxV1(filename, f)
-        else:
-            raise GitError('%s: unrecognized idx file header'
-                           % path_msg(filename))
+        version = _idx_version(filename, f.read(8))
+        contexts.pop_all()
+        if version == 2:
+            return PackIdxV2(filename, f)
+        return PackIdxV1(filename, f)
 
 
 def open_object_idx(filename):
@@ -888,16 +987,102 @@ def create_commit_blob(tree, parent,
     return b'\n'.join(l)
 
 def _make_objcache(repo_dir):
-    return PackIdxList(repo(b'objects/pack', repo_dir=repo_dir))
+    max_open = git_config_get(b'bup.pack.max-open-idxs',
+                              repo_dir=repo_dir, opttype='int')
+    max_mapped = git_config_get(b'bup.pack.max-mapped-idxs',
+                                repo_dir=repo_dir, opttype='int')
+    return PackIdxList(repo(b'objects/pack', repo_dir=repo_dir),
+                       max_open=max_open, max_mapped=max_mapped)
 
 # bup-gc assumes that it can disable all PackWriter activities
 # (bloom/midx/cache) via the constructor and close() arguments.
 
+class _WriteBehind:
+    """Write to a file from a separate thread.
+
+    Data is collected in a buffer that is handed to the thread once it
+    reaches bufsize, so the caller can fill the next buffer while the
+    previous one is being written.  At most one further buffer can be
+    waiting, after that write() blocks.  An error in the thread is
+    raised by the next write() or by close().
+
+    """
+    def __init__(self, f, bufsize=1024 * 1024):
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = []
+        self.buflen = 0
+        self.discard = False
+        self.ex = None
+        self.queue = Queue(maxsize=1)
+        self.thread = Thread(target=self._run, name='bup-pack-writer',
+                             daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            # Once something failed, drop everything, a gap in the
+            # pack would be worse.
+            if self.ex or self.discard:
+                continue
+            try:
+                self.f.write(data)
+            except BaseException as ex:
+                self.ex = ex
+
+    def _check(self):
+        if self.ex:
+            raise self.ex
+
+    def _hand_over(self):
+        if self.buf:
+            self.queue.put(b''.join(self.buf))
+            self.buf = []
+            self.buflen = 0
+
+    def write(self, data):
+        self._check()
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.bufsize:
+            self._hand_over()
+
+    def close(self, discard=False):
+        """Wait until everything has been written (or just stop if
+        discard is true), and raise any error the thread encountered
+        unless discarding."""
+        if not self.thread:
+            return
+        self.discard = discard
+        if not discard:
+            self._hand_over()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if not discard:
+            self._check()
+
+
+_UnpublishedPack = namedtuple('_UnpublishedPack', ['tmpdir', 'nameprefix', 'idx'])
+
+
 class PackWriter:
-    """Writes Git objects inside a pack file."""
+    """Writes Git objects inside a pack file.
+
+    If write_behind is true, the pack data is written by a separate
+    thread.  If group_sync is true, finished packs aren't synced and
+    moved into the repository until close(), so several packs share
+    one round of syncing at the end.  Both default to the
+    bup.pack.write-behind and bup.pack.group-sync settings.
+
+    """
     def __init__(self, objcache_maker=None, compression_level=None,
                  run_midx=True, on_pack_finish=None,
-                 max_pack_size=None, max_pack_objects=None, repo_dir=None):
+                 max_pack_size=None, max_pack_objects=None, repo_dir=None,
+                 write_behind=None, group_sync=None):
         self.closed = False
         # In the case of a PackWriter_Remote instance we shouldn't _require_ a
         # local repo (hence guess_repo()), but for backward compatibility reasons
@@ -907,6 +1092,7 @@ class PackWriter:
         self.parentfd = None
         self.count = 0
         self.outbytes = 0
+        self.filepos = 0
         self.tmpdir = None
         self.idx = None
         self.objcache_maker = objcache_maker or _make_objcache
@@ -927,6 +1113,18 @@ class PackWriter:
         # cache memory usage is about 83 bytes per object
         self.max_pack_objects = max_pack_objects if max_pack_objects \
                                 else max(1, self.max_pack_size // 5000)
+        if write_behind is None:
+            write_behind = git_config_get(b'bup.pack.write-behind',
+                                          repo_dir=self.repo_dir,
+                                          opttype='bool')
+        self.write_behind = bool(write_behind)
+        if group_sync is None:
+            group_sync = git_config_get(b'bup.pack.group-sync',
+                                        repo_dir=self.repo_dir,
+                                        opttype='bool')
+        self.group_sync = bool(group_sync)
+        self._writer = None
+        self._unpublished = []
 
     def __enter__(self):
         return self
@@ -944,7 +1142,10 @@ class PackWriter:
                 self.parentfd = err_stack.enter_context(finalized(os.open(objdir, os.O_RDONLY),
                                                                   lambda x: os.close(x)))
                 self.file.write(b'PACK\0\0\0\2\0\0\0\0')
+                self.filepos = 12
                 self.idx = PackIdxV2Writer()
+                if self.write_behind:
+                    self._writer = _WriteBehind(self.file)
                 err_stack.pop_all()
 
     def _raw_write(self, datalist, sha):
@@ -957,11 +1158,15 @@ class PackWriter:
         # but that's okay because we'll flush it in _end().
         oneblob = b''.join(datalist)
         try:
-            f.write(oneblob)
+            if self._writer:
+                self._writer.write(oneblob)
+            else:
+                f.write(oneblob)
         except IOError as e:
             raise GitError(e) from e
         nw = len(oneblob)
         crc = zlib.crc32(oneblob) & 0xffffffff
+        self.filepos += nw
         self._update_idx(sha, crc, nw)
         self.outbytes += nw
         self.count += 1
@@ -970,7 +1175,7 @@ class PackWriter:
     def _update_idx(self, sha, crc, size):
         assert(sha)
         if self.idx:
-            self.idx.add(sha, crc, self.file.tell() - size)
+            self.idx.add(sha, crc, self.filepos - size)
 
     def _write(self, sha, type, content):
         if verbose:
@@ -994,13 +1199,26 @@ class PackWriter:
     def exists(self, id, want_source=False):
         """Return non-empty if an object is found in the object cache."""
         self._require_objcache()
-        return self.objcache.exists(id, want_source=want_source)
+        # The pack that's being written, and packs that haven't been
+        # published yet (see group_sync) can't be named as the source,
+        # nobody else can see them.
+        if not want_source and self.idx and self.idx.exists(id):
+            return OBJECT_EXISTS
+        ret = self.objcache.exists(id, want_source=want_source)
+        if ret or want_source:
+            return ret
+        for pack in self._unpublished:
+            ret = pack.idx.exists(id)
+            if ret:
+                return ret
+        return None
 
     def just_write(self, sha, type, content):
         """Write an object to the pack file without checking for duplication."""
         self._write(sha, type, content)
-        # If nothing else, gc doesn't have/want an objcache
-        if self.objcache is not None:
+        # If nothing else, gc doesn't have/want an objcache, and a
+        # local pack's idx writer already knows about the object.
+        if self.objcache is not None and self.idx is None:
             self.objcache.add(sha)
 
     def maybe_write(self, type, content):
@@ -1038,10 +1256,13 @@ class PackWriter:
         self.parentfd, pfd, = None, self.parentfd
         self.file, f = None, self.file
         self.idx, idx = None, self.idx
+        self._writer, writer = None, self._writer
         try:
             with nullcontext_if_not(self.objcache), \
                  finalized(pfd, lambda x: x is not None and os.close(x)), \
                  nullcontext_if_not(f):
+                if writer:
+                    writer.close(discard=abort)
                 if abort or not f:
                     return None
 
@@ -1059,14 +1280,23 @@ class PackWriter:
                 packbin = sum.digest()
                 f.write(packbin)
                 f.flush()
-                fdatasync(f.fileno())
+                if not self.group_sync:
+                    fdatasync(f.fileno())
                 f.close()
 
-                idx.write(tmpdir + b'/idx', packbin)
+                idx.write(tmpdir + b'/pack.idx', packbin,
+                          sync=not self.group_sync)
                 nameprefix = os.path.join(self.repo_dir,
                                           b'objects/pack/pack-' +  hexlify(packbin))
+                if self.group_sync:
+                    # Keep the pack where it is until close(), see _publish()
+                    self._unpublished.append(
+                        _UnpublishedPack(tmpdir, nameprefix,
+                                         open_idx(tmpdir + b'/pack.idx')))
+                    tmpdir = None
+                    return nameprefix
                 os.rename(tmpdir + b'/pack', nameprefix + b'.pack')
-                os.rename(tmpdir + b'/idx', nameprefix + b'.idx')
+                os.rename(tmpdir + b'/pack.idx', nameprefix + b'.idx')
                 os.fsync(pfd)
                 if self.on_pack_finish:
                     self.on_pack_finish(nameprefix)
@@ -1079,10 +1309,52 @@ class PackWriter:
             # Must be last -- some of the code above depends on it
             self.objcache = None
 
+    def _publish(self):
+        # With group_sync, finished packs stay in their temporary
+        # directories until the writer is closed (i.e. before any refs
+        # can point to their content).  Then all of them are synced
+        # in one go and only after that moved into place, so that an
+        # idx can never be visible without its complete pack.
+        pending, self._unpublished = self._unpublished, []
+        if not pending:
+            return
+        packdir = os.path.join(self.repo_dir, b'objects/pack')
+        try:
+            for pack in pending:
+                pack.idx.close()
+                for name in (b'/pack', b'/pack.idx'):
+                    with finalized(os.open(pack.tmpdir + name, os.O_RDWR),
+                                   lambda x: os.close(x)) as fd:
+                        fdatasync(fd)
+            for pack in pending:
+                os.rename(pack.tmpdir + b'/pack', pack.nameprefix + b'.pack')
+                os.rename(pack.tmpdir + b'/pack.idx',
+                          pack.nameprefix + b'.idx')
+            with finalized(os.open(packdir, os.O_RDONLY),
+                           lambda x: os.close(x)) as fd:
+                os.fsync(fd)
+            if self.on_pack_finish:
+                for pack in pending:
+                    self.on_pack_finish(pack.nameprefix)
+            if self.run_midx:
+                auto_midx(packdir)
+        finally:
+            self._discard_unpublished(pending)
+
+    def _discard_unpublished(self, pending=None):
+        if pending is None:
+            pending, self._unpublished = self._unpublished, []
+        for pack in pending:
+            pack.idx.close()
+            rmtree(pack.tmpdir, ignore_errors=True)
+
     def abort(self):
         """Remove the pack file from disk."""
         self.closed = True
-        self._end(abort=True)
+        try:
+            self._end(abort=True)
+        finally:
+            self._discard_unpublished()
 
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
@@ -1093,62 +1365,106 @@ class PackWriter:
     def close(self):
         """Close the pack file and move it to its definitive path."""
         self.closed = True
-        return self._end()
+        try:
+            id = self._end()
+        except BaseException as ex:
+            with pending_raise(ex):
+                self._discard_unpublished()
+        self._publish()
+        return id
 
     def __del__(self):
         assert self.closed
 
 
 class PackIdxV2Writer:
+    """Collect the entries for the idx of a pack that's being written.
+
+    The entries are kept in flat arrays in the order they're added
+    (plus a small hash table for exists()), about 45 bytes per object,
+    and they're only sorted by _helpers.write_idx() in write().
+
+    """
     def __init__(self):
-        self.idx = list(list() for i in range(256))
         self.count = 0
+        self.shas = bytearray()
+        self.crcs = array('I')
+        self.offsets = array('Q')
+        assert self.crcs.itemsize == 4 and self.offsets.itemsize == 8
+        # open addressing, entry number + 1 for each used slot
+        self._table = array('I', bytes(4 * 1024))
+        self._mask = 1023
+
+    def _slot(self, sha):
+        table, mask, shas = self._table, self._mask, self.shas
+        i = hash(sha) & mask
+        while True:
+            n = table[i]
+            if not n or shas[(n - 1) * 20 : n * 20] == sha:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        size = len(self._table) * 2
+        self._table = array('I', bytes(4 * size))
+        self._mask = size - 1
+        for n in range(1, self.count + 1):
+            i = self._slot(bytes(self.shas[(n - 1) * 20 : n * 20]))
+            if not self._table[i]:
+                self._table[i] = n
 
     def add(self, sha, crc, offs):
         assert(sha)
+        assert len(sha) == 20
+        self.shas += sha
+        self.crcs.append(crc)
+        self.offsets.append(offs)
         self.count += 1
-        self.idx[sha[0]].append((sha, crc, offs))
+        i = self._slot(sha)
+        if not self._table[i]:
+            self._table[i] = self.count
+        if self.count * 2 > len(self._table):
+            self._grow()
+
+    def exists(self, sha):
+        """Return true if sha has been added."""
+        return self._table[self._slot(sha)] != 0
+
+    def __iter__(self):
+        for n in range(self.count):
+            yield bytes(self.shas[n * 20 : (n + 1) * 20])
 
-    def write(self, filename, packbin):
+    def write(self, filename, packbin, sync=True):
         ofs64_count = 0
-        for section in self.idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
+        for offs in self.offsets:
+            if offs >= 2**31:
+                ofs64_count += 1
 
         # Length: header + fan-out + shas-and-crcs + overflow-offsets
         index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
         idx_map = None
+        idx_sum = Sha1()
         idx_f = open(filename, 'w+b')
         try:
             idx_f.truncate(index_len)
-            fdatasync(idx_f.fileno())
             idx_map = mmap_readwrite(idx_f, close=False)
             try:
-                count = _helpers.write_idx(filename, idx_map, self.idx,
+                count = _helpers.write_idx(filename, idx_map, self.shas,
+                                           self.crcs, self.offsets,
                                            self.count)
                 assert(count == self.count)
-                idx_map.flush()
+                # Everything but the trailer is in the map, so there's
+                # no need to read the file back to checksum it.
+                idx_sum.update(idx_map)
             finally:
                 idx_map.close()
-        finally:
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
-        try:
+            idx_sum.update(packbin)
+            idx_f.seek(0, os.SEEK_END)
             idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            for b in chunkyreader(idx_f, 20 * self.count):
-                idx_sum.update(b)
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
             idx_f.write(idx_sum.digest())
-            fdatasync(idx_f.fileno())
+            idx_f.flush()
+            if sync:
+                fdatasync(idx_f.fileno())
         finally:
             idx_f.close()
 
@@ -1475,13 +1791,13 @@ class CatPipe:
         if len(info) != 3 or len(info[0]) != 40:
             raise GitError('expected object (id, type, size), got %r' % info)
         oidx, typ, size = info
+        size = int(size)
 
         if not include_data:
             self.inprogress = None
             yield oidx, typ, size
             return
 
-        size = int(size)
         try:
             it = chunkyreader(p.stdout, size)
             yield oidx, typ, size
@@ -1541,6 +1857,16 @@ class WalkItem:
         self.chunk_path = chunk_path
         self.data = data
 
+def walk_item_is_metadata(item):
+    """Return true if the WalkItem's object counts as metadata (see
+    just_write()), i.e. if it's a commit, a tree, a symlink target, or
+    a .bupm."""
+    if item.type in (b'tree', b'commit'):
+        return True
+    return (item.type == b'blob'
+            and ((item.mode is not None and stat.S_ISLNK(item.mode))
+                 or (item.path and item.path[-1] == b'.bupm')))
+
 def walk_object(repo, oidx, *, stop_at=None, include_data=None,
                 oid_exists=None):
     """Yield everything reachable from oidx via get_ref (which must
@@ -9,7 +9,7 @@ from subprocess import PIPE, Popen
 from tempfile import mkdtemp
 from shutil import rmtree
 import sys, os, subprocess, errno, select, mmap, stat, re, struct
-import hashlib, heapq, math, operator, time
+import hashlib, heapq, math, operator, threading, time
 from math import ceil
 from contextlib import contextmanager
 
@@ -624,10 +624,23 @@ class NotOk(Exception):
     pass
 
 
+# The initial size of the connections' input buffers
+CONN_BUFFER_SIZE = 256 * 1024
+
 class BaseConn:
+    """A connection that reads its input in large chunks into a
+    reusable buffer (or straight into the caller's for large reads),
+    so that the many small reads of the protocol don't need a system
+    call (or a new bytes object) each.  Subclasses provide the raw
+    input via _raw_readinto().
+
+    """
     def __init__(self, outp):
         self._base_closed = False
         self.outp = outp
+        self._ibuf = bytearray(CONN_BUFFER_SIZE)
+        self._iview = memoryview(self._ibuf)
+        self._istart = self._iend = 0
 
     def close(self):
         self._base_closed = True
@@ -642,16 +655,99 @@ class BaseConn:
     def __del__(self):
         assert self._base_closed
 
+    def _raw_readinto(self, view):
+        """Read at most len(view) bytes of input into view, blocking
+        until at least one is available, and return the number read,
+        or 0 at EOF."""
+        raise NotImplementedError("Subclasses must implement _raw_readinto")
+
+    def _buffered(self):
+        return self._iend - self._istart
+
+    def _fill(self):
+        """Read more input into the buffer, making room for it if
+        needed, and return false at EOF."""
+        start, end = self._istart, self._iend
+        if start == end:
+            self._istart = self._iend = start = end = 0
+        elif end == len(self._ibuf):
+            n = end - start
+            if start:
+                self._ibuf[:n] = self._iview[start:end]
+            else:  # a very long line
+                self._iview.release()
+                self._ibuf += bytes(len(self._ibuf))
+                self._iview = memoryview(self._ibuf)
+            self._istart, self._iend = start, end = 0, n
+        n = self._raw_readinto(self._iview[end:])
+        if not n:
+            return False
+        self._iend += n
+        return True
+
+    def _readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        size = len(view)
+        pos = min(size, self._buffered())
+        if pos:
+            view[:pos] = self._iview[self._istart:self._istart + pos]
+            self._istart += pos
+        while pos < size:
+            if size - pos >= len(self._ibuf) // 2:
+                # Don't bother copying via the buffer
+                n = self._raw_readinto(view[pos:])
+                if not n:
+                    break
+            else:
+                if not self._fill():
+                    break
+                n = min(size - pos, self._buffered())
+                view[pos:pos + n] = self._iview[self._istart:self._istart + n]
+                self._istart += n
+            pos += n
+        return pos
+
+    def readinto(self, buf):
+        """Read len(buf) bytes from the input stream into buf (a
+        writable bytes-like object), and return the number read,
+        which is only smaller at EOF."""
+        self.outp.flush()
+        return self._readinto(buf)
+
     def _read(self, size):
-        raise NotImplementedError("Subclasses must implement _read")
+        start = self._istart
+        end = start + size
+        if end <= self._iend:
+            self._istart = end
+            return self._iview[start:end].tobytes()
+        buf = bytearray(size)
+        n = self._readinto(buf)
+        if n < size:
+            del buf[n:]
+        return bytes(buf)
 
     def read(self, size):
         """Read 'size' bytes from input stream."""
         self.outp.flush()
+        # The common case, inline
+        start = self._istart
+        end = start + size
+        if end <= self._iend:
+            self._istart = end
+            return self._iview[start:end].tobytes()
         return self._read(size)
 
     def _readline(self):
-        raise NotImplementedError("Subclasses must implement _readline")
+        scanned = 0
+        while True:
+            i = self._ibuf.find(b'\n', self._istart + scanned, self._iend)
+            if i >= 0:
+                start, self._istart = self._istart, i + 1
+                return self._iview[start:i + 1].tobytes()
+            scanned = self._buffered()
+            if not self._fill():
+                start, self._istart = self._istart, self._iend
+                return self._iview[start:self._iend].tobytes()
 
     def readline(self):
         """Read from input stream until a newline is found."""
@@ -690,7 +786,7 @@ class BaseConn:
                 return NotOk(rl[6:])
             else:
                 onempty(rl)
-        raise Exception('server exited unexpectedly; see errors above')
+        raise EOFError('server exited unexpectedly; see errors above')
 
     def drain_and_check_ok(self):
         """Remove all data for the current command from input stream."""
@@ -709,14 +805,16 @@ class Conn(BaseConn):
     def __init__(self, inp, outp):
         BaseConn.__init__(self, outp)
         self.inp = inp
+        # Read what's available (without waiting for the rest), and
+        # into our buffer directly, if the stream can
+        self._inp_readinto = getattr(inp, 'readinto1', None) or inp.readinto
 
-    def _read(self, size):
-        return self.inp.read(size)
-
-    def _readline(self):
-        return self.inp.readline()
+    def _raw_readinto(self, view):
+        return self._inp_readinto(view) or 0
 
     def has_input(self):
+        if self._buffered():
+            return True
         [rl, wl, xl] = select.select([self.inp.fileno()], [], [], 0)
         if rl:
             assert(rl[0] == self.inp.fileno())
@@ -725,16 +823,6 @@ class Conn(BaseConn):
             return None
 
 
-def checked_reader(fd, n):
-    while n > 0:
-        rl, _, _ = select.select([fd], [], [])
-        assert(rl[0] == fd)
-        buf = os.read(fd, n)
-        if not buf: raise Exception("Unexpected EOF reading %d more bytes" % n)
-        yield buf
-        n -= len(buf)
-
-
 MAX_PACKET = 128 * 1024
 def mux(p, outfd, outr, errr):
     try:
@@ -754,6 +842,62 @@ def mux(p, outfd, outr, errr):
         os.write(outfd, struct.pack('!IB', 0, 3))
 
 
+class MuxWriter:
+    """Write to outfd as mux() does, for a command running in this
+    process (rather than a subprocess), so that DemuxConn can read
+    it.  Data written via write() is sent as (buffered) stdout
+    packets, and close() marks the end of the stream.  Like a
+    buffered file, it may be used by several threads, e.g. when the
+    server writes from one thread while reading (and so flushing)
+    in another.
+
+    """
+    def __init__(self, outfd):
+        self.outfd = outfd
+        self.buf = bytearray()
+        self.closed = False
+        self._lock = threading.RLock()
+        os.write(outfd, b'BUPMUX')
+
+    def _send(self, data, fdw):
+        for i in range(0, len(data), MAX_PACKET):
+            buf = data[i:i + MAX_PACKET]
+            os.writev(self.outfd, (struct.pack('!IB', len(buf), fdw), buf))
+
+    def write(self, data):
+        with self._lock:
+            self.buf += data
+            if len(self.buf) >= MAX_PACKET:
+                self.flush()
+
+    def write_stderr(self, data):
+        with self._lock:
+            self.flush()
+            self._send(data, 2)
+
+    def flush(self):
+        with self._lock:
+            buf, self.buf = self.buf, bytearray()
+            self._send(buf, 1)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.flush()
+            finally:
+                os.write(self.outfd, struct.pack('!IB', 0, 3))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+
 class DemuxConn(BaseConn):
     """A helper class for bup's client-server protocol."""
     def __init__(self, infd, outp):
@@ -794,86 +938,69 @@ class DemuxConn(BaseConn):
             stderr.write(b)  # pre-mux log messages
             stderr.flush()
         self.infd = infd
-        self.reader = None
-        self.buf = None
+        self._packet = 0  # stdout data left in the current packet
+        self._header = bytearray(5)
         self.closed = False
 
     def write(self, data):
-        self._load_buf(0)
+        self.has_input()  # e.g. handle any stderr packets
         BaseConn.write(self, data)
 
-    def _next_packet(self, timeout):
-        if self.closed: return False
-        rl, wl, xl = select.select([self.infd], [], [], timeout)
-        if not rl: return False
-        assert(rl[0] == self.infd)
-        ns = b''.join(checked_reader(self.infd, 5))
-        n, fdw = struct.unpack('!IB', ns)
-        if n > MAX_PACKET:
-            # assume that something went wrong and print stuff
-            ns += os.read(self.infd, 1024)
-            stderr = byte_stream(sys.stderr)
-            stderr.write(ns)
-            stderr.flush()
-            raise Exception("Connection broken")
-        if fdw == 1:
-            self.reader = checked_reader(self.infd, n)
-        elif fdw == 2:
-            for buf in checked_reader(self.infd, n):
+    def _read_exactly(self, view):
+        pos = 0
+        while pos < len(view):
+            n = os.readv(self.infd, (view[pos:],))
+            if not n:
+                raise Exception("Unexpected EOF reading %d more bytes"
+                                % (len(view) - pos))
+            pos += n
+
+    def _next_packet(self, block):
+        """Handle packets until there's stdout data to read, and
+        return true, or false if the stream ended, or there's nothing
+        to read now (unless block is true)."""
+        while not self._packet:
+            if self.closed:
+                return False
+            if not block:
+                rl, wl, xl = select.select([self.infd], [], [], 0)
+                if not rl:
+                    return False
+            self._read_exactly(memoryview(self._header))
+            n, fdw = struct.unpack('!IB', self._header)
+            if n > MAX_PACKET:
+                # assume that something went wrong and print stuff
+                stderr = byte_stream(sys.stderr)
+                stderr.write(bytes(self._header) + os.read(self.infd, 1024))
+                stderr.flush()
+                raise Exception("Connection broken")
+            if fdw == 1:
+                self._packet = n
+            elif fdw == 2:
+                buf = bytearray(n)
+                self._read_exactly(memoryview(buf))
                 byte_stream(sys.stderr).write(buf)
-        elif fdw == 3:
-            self.closed = True
-            debug2("DemuxConn: marked closed\n")
+            elif fdw == 3:
+                self.closed = True
+                debug2("DemuxConn: marked closed\n")
         return True
 
-    def _load_buf(self, timeout):
-        if self.buf is not None:
-            return True
-        while not self.closed:
-            while not self.reader:
-                if not self._next_packet(timeout):
-                    return False
-            try:
-                self.buf = next(self.reader)
-                return True
-            except StopIteration:
-                self.reader = None
-        return False
-
-    def _read_parts(self, ix_fn):
-        while self._load_buf(None):
-            assert(self.buf is not None)
-            i = ix_fn(self.buf)
-            if i is None or i == len(self.buf):
-                yv = self.buf
-                self.buf = None
-            else:
-                yv = self.buf[:i]
-                self.buf = self.buf[i:]
-            yield yv
-            if i is not None:
-                break
-
-    def _readline(self):
-        def find_eol(buf):
-            try:
-                return buf.index(b'\n')+1
-            except ValueError:
-                return None
-        return b''.join(self._read_parts(find_eol))
-
-    def _read(self, size):
-        csize = [size]
-        def until_size(buf): # Closes on csize
-            if len(buf) < csize[0]:
-                csize[0] -= len(buf)
-                return None
-            else:
-                return csize[0]
-        return b''.join(self._read_parts(until_size))
+    def _raw_readinto(self, view):
+        if not self._next_packet(True):
+            return 0
+        n = os.readv(self.infd, (view[:self._packet],))
+        if not n:
+            raise Exception("Unexpected EOF reading %d more bytes"
+                            % self._packet)
+        self._packet -= n
+        return n
 
     def has_input(self):
-        return self._load_buf(0)
+        if self._buffered():
+            return True
+        if not self._next_packet(False):
+            return False
+        return self._fill()
 
 
 def linereader(f):
@@ -118,7 +118,9 @@ def opts_from_cmdline(args, onabort=None, pwd=b'/'):
     ret.remote = opt.remote
     return ret
 
-def show_paths(repo, opt, paths, out, pwd, should_columnate, prefix=b''):
+def show_paths(repo, opt, paths, out, pwd, should_columnate, prefix=b'',
+               known=None):
+    # known may be the resolution (or vfs.IOError) of the only path
     def item_line(item, name):
         return item_info(item, prefix + name,
                          show_hash=opt.hash,
@@ -140,7 +142,11 @@ def show_paths(repo, opt, paths, out, pwd, should_columnate, prefix=b''):
             if last_n > 0:
                 out.write(b'%s:\n' % printpath)
 
-            if opt.directory:
+            if known is not None:
+                if isinstance(known, vfs.IOError):
+                    raise known
+                resolved = known
+            elif opt.directory:
                 resolved = vfs.resolve(repo, path, follow=False)
             else:
                 resolved = vfs.try_resolve(repo, path, want_meta=want_meta)
@@ -158,7 +164,18 @@ def show_paths(repo, opt, paths, out, pwd, should_columnate, prefix=b''):
                     # Match non-bup "ls -a ... /".
                     parent = resolved[-2] if len(resolved) > 1 else resolved[0]
                     items = chain(items, ((b'..', parent[1]),))
-                for sub_name, sub_item in sorted(items, key=lambda x: x[0]):
+                items = sorted(items, key=lambda x: x[0])
+                subdirs = {}
+                if opt.recursive:
+                    # Resolve the subdirectories (which aren't links)
+                    # all at once, e.g. concurrently for remote repos.
+                    names = [name for name, item in items
+                             if S_ISDIR(vfs.item_mode(item))
+                             and name not in (b'.', b'..')]
+                    subdirs = dict(zip(names, repo.resolve_many(
+                        [path + b'/' + name for name in names],
+                        want_meta=want_meta, follow=False)))
+                for sub_name, sub_item in items:
                     if opt.show_hidden != 'all' and sub_name == b'.':
                         continue
                     if sub_name.startswith(b'.') and \
@@ -182,7 +199,8 @@ def show_paths(repo, opt, paths, out, pwd, should_columnate, prefix=b''):
                     # recurse into subdirectories (apart from . and .., of course)
                     if opt.recursive and S_ISDIR(vfs.item_mode(sub_item)) and sub_name not in (b'.', b'..'):
                         show_paths(repo, opt, [path + b'/' + sub_name], out, pwd,
-                                   should_columnate, prefix=prefix + sub_name + b'/')
+                                   should_columnate, prefix=prefix + sub_name + b'/',
+                                   known=subdirs.get(sub_name))
             else:
                 if opt.long_listing:
                     leaf_item = vfs.augment_item_meta(repo, leaf_item,
@@ -113,37 +113,14 @@ class PackMidx:
         assert want_crc == False, "returning CRC is not supported in midx"
         global _total_searches, _total_steps
         _total_searches += 1
-        want = hash
-        el = extract_bits(want, self.bits)
-        if el:
-            start = self._fanget(el-1)
-            startv = el << (32-self.bits)
-        else:
-            start = 0
-            startv = 0
-        end = self._fanget(el)
-        endv = (el+1) << (32-self.bits)
-        _total_steps += 1   # lookup table is a step
-        hashv = _helpers.firstword(hash)
-        #print '(%08x) %08x %08x %08x' % (extract_bits(want, 32), startv, hashv, endv)
-        while start < end:
-            _total_steps += 1
-            #print '! %08x %08x %08x   %d - %d' % (startv, hashv, endv, start, end)
-            mid = start + (hashv - startv) * (end - start - 1) // (endv - startv)
-            #print '  %08x %08x %08x   %d %d %d' % (startv, hashv, endv, start, mid, end)
-            v = self._get(mid)
-            #print '    %08x' % self._num(v)
-            if v < want:
-                start = mid+1
-                startv = _helpers.firstword(v)
-            elif v > want:
-                end = mid
-                endv = _helpers.firstword(v)
-            else: # got it!
-                if want_source:
-                    return ObjectLocation(self._get_idxname(mid), None, None)
-                return OBJECT_EXISTS
-        return None
+        mid, steps = _helpers.find_sha(self.map, hash, self.fanout_ofs,
+                                       self.bits, self.sha_ofs, 20, self.nsha)
+        _total_steps += steps
+        if mid is None:
+            return None
+        if want_source:
+            return ObjectLocation(self._get_idxname(mid), None, None)
+        return OBJECT_EXISTS
 
     def __iter__(self):
         start = self.sha_ofs
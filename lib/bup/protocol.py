@@ -1,14 +1,20 @@
 
-import os, struct
 from binascii import hexlify, unhexlify
+from io import BytesIO
+from queue import Queue
+from threading import Lock, Thread
+import os, re, struct, tempfile, time
 
-from bup import git, vfs, vint
+from bup import bloom, git, vfs, vint
 from bup.compat import hexstr
 from bup.io import path_msg
 from bup.vint import read_bvec, write_bvec
 from bup.vint import read_vint, write_vint
 from bup.vint import read_vuint, write_vuint
-from bup.helpers import (debug1, debug2, linereader, lines_until_sentinel, log, pending_raise)
+from bup.helpers import (BaseConn,
+                         atomically_replaced_file, chunkyreader, debug1,
+                         debug2, linereader, lines_until_sentinel, log,
+                         mkdirp, mmap_read, pending_raise)
 from bup.vint import write_vuint
 from bup.vfs import Item, Chunky, RevList, Root, Tags, Commit, FakeLink
 from bup.metadata import Metadata
@@ -132,26 +138,190 @@ PERMITTED_CONFIG_KEYS = (
     b'pack.packsizelimit',
 )
 
+# The most cat-stream requests a client may have outstanding, and
+# their maximum total size.  The latter stays well below the usual
+# pipe and socket buffer sizes, so that the client can always write
+# its requests without waiting for us to read them, even while we're
+# blocked writing results it hasn't read yet.
+CAT_STREAM_MAX_REQUESTS = 1024
+CAT_STREAM_MAX_REQUEST_BYTES = 16 * 1024
+
+# The most object ids a client may ask about in one missing-objects
+# batch.
+MISSING_OBJECTS_MAX_BATCH = 64 * 1024
+
+# How long to keep the state of receive-objects-v2 sessions that
+# nobody resumed.
+OBJECTS_SESSION_EXPIRY = 7 * 24 * 60 * 60
+
+_objects_session_rx = re.compile(br'[0-9a-f]{32}')
+
+# receive-objects-v2 hands the objects it reads to the thread that
+# stores them in batches of up to this many bytes, and reads at most
+# this many batches ahead of it.
+RECEIVE_BATCH_BYTES = 1024 * 1024
+RECEIVE_QUEUE_BATCHES = 8
+
+# The commands a client may send via multiplex, the (maximum) size
+# of the chunks their output is sent in, and how many of them are run
+# at once.
+MULTIPLEX_COMMANDS = frozenset([b'cat-batch', b'read-ref', b'refs',
+                                b'rev-list', b'resolve'])
+MULTIPLEX_CHUNK_SIZE = 64 * 1024
+MULTIPLEX_WORKERS = 4
+
+# The kinds of diff records
+DIFF_END = 0
+DIFF_ENTRY = 1
+DIFF_ERROR = 2
+
+# The kinds of walk-objects records
+WALK_END = 0
+WALK_OBJECT = 1
+WALK_HAVE = 2
+WALK_MISSING = 3
+
+# The size (2^bits bytes) of the bloom filter of the objects sent by
+# walk-objects on a connection, and how many it may hold before it's
+# cleared, to keep the false positive rate reasonable.
+WALK_SENT_BITS = 22
+WALK_SENT_MAX = (8 << WALK_SENT_BITS) // bloom.MAX_BITS_EACH
+
+class _ObjectStorer:
+    """Store the objects receive-objects-v2 reads on a separate
+    thread, so that reading them from the connection and writing them
+    to the repository (including the existence checks) overlap.  The
+    batches of objects are handed over via a bounded queue.  While
+    the storer is busy, only it may write to the connection (e.g. to
+    suggest idxs), so the reader has to sync() before responding.
+    Once storing fails, the rest is dropped, and the error is raised
+    by the next put() or sync().
+
+    """
+    def __init__(self, store):
+        self._store = store
+        self.suggested = set()
+        self._ex = None
+        self._queue = Queue(maxsize=RECEIVE_QUEUE_BATCHES)
+        self._thread = Thread(target=self._run, name='bup-object-storer',
+                              daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                if not self._ex:
+                    self._store(batch, self)
+            except BaseException as ex:
+                self._ex = ex
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._ex:
+            raise self._ex
+
+    def put(self, batch):
+        self._check()
+        if batch:
+            self._queue.put(batch)
+
+    def sync(self):
+        """Wait until everything's been stored."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class _MultiplexedRequest:
+    """The connection a command run via multiplex sees: it reads
+    the request's body, and what it writes is sent to the client as
+    it's produced, in chunks of at most MULTIPLEX_CHUNK_SIZE tagged
+    with the request's id, followed by an empty one.  Each chunk is
+    written (and flushed) while holding the lock, so that requests
+    can run in parallel, and dropped once any of them has failed.
+
+    """
+    def __init__(self, conn, lock, failed, req_id, body):
+        self._conn = conn
+        self._lock = lock
+        self._failed = failed
+        self._id = req_id
+        body = BytesIO(body)
+        self.read = body.read
+        self.readline = body.readline
+        self._out = bytearray()
+
+    def write(self, data):
+        data = memoryview(data)
+        if self._out:
+            n = MULTIPLEX_CHUNK_SIZE - len(self._out)
+            self._out += data[:n]
+            data = data[n:]
+            if len(self._out) < MULTIPLEX_CHUNK_SIZE:
+                return
+            self._send(self._out)
+            self._out = bytearray()
+        while len(data) >= MULTIPLEX_CHUNK_SIZE:
+            self._send(data[:MULTIPLEX_CHUNK_SIZE])
+            data = data[MULTIPLEX_CHUNK_SIZE:]
+        self._out += data
+
+    ok = BaseConn.ok
+    error = BaseConn.error
+
+    def _send(self, chunk):
+        with self._lock:
+            if self._failed:
+                return
+            write_vuint(self._conn, self._id)
+            write_bvec(self._conn, chunk)
+            self._conn.outp.flush()
+
+    def finish(self):
+        if self._out:
+            self._send(self._out)
+            self._out = bytearray()
+        self._send(b'')
+
+
 class Server:
     def __init__(self, conn, backend, mode=None):
         self.conn = conn
         self._backend = backend
+        self._mode = mode
         self._only_ff_updates = mode is not None and mode != 'unrestricted'
         self._commands = self._get_commands(mode or 'unrestricted')
         self.suspended = False
         self.repo = None
         self.dumb_server_mode = True
+        self._objects_session = None
+        self._objects_count = 0
+        self._walk_have = None
+        self._walk_sent = None
+        self._walk_sent_count = 0
 
     def _get_commands(self, mode):
         # always allow these - even if set-dir may actually be
         # a no-op (if --force-repo is given)
         permitted = set([b'quit', b'help', b'set-dir', b'list-indexes',
-                         b'send-index', b'config-get', b'config-list'])
+                         b'send-index', b'send-bloom', b'config-get',
+                         b'config-list', b'multiplex'])
 
-        read_cmds = set([b'read-ref', b'join', b'cat-batch',
-                         b'refs', b'rev-list', b'resolve'])
-        append_cmds = set([b'receive-objects-v2', b'read-ref', b'update-ref',
-                           b'init-dir'])
+        read_cmds = set([b'read-ref', b'join', b'cat-batch', b'cat-stream',
+                         b'walk-objects', b'refs', b'rev-list', b'resolve',
+                         b'diff'])
+        append_cmds = set([b'receive-objects-v2', b'missing-objects',
+                           b'resume-objects',
+                           b'read-ref', b'update-ref', b'init-dir'])
 
         if mode == 'unrestricted':
             permitted = None # all commands permitted
@@ -191,6 +361,7 @@ class Server:
             self.repo.close()
             self.repo = None
             self.suspended = False
+            self._objects_session = None
         if not self.repo:
             self.repo = self._backend(repo_dir, server=True)
             msgdir = path_msg(self.repo.repo_dir)
@@ -232,26 +403,172 @@ class Server:
         self.repo.send_index(name, self.conn, self._send_size)
         self.conn.ok()
 
-    def _check(self, expected, actual, msg):
-        if expected != actual:
-            self.repo.abort_writing()
-            raise Exception(msg % (expected, actual))
+    @_command
+    def send_bloom(self, junk):
+        """Send what the client needs to have a bloom filter for all
+        of the repository's indexes.
+
+        The client sends the bits and k of its copy (zero if it has
+        none) and the names of the idxs it covers (terminated by an
+        empty name).  The response is 0 if there's no bloom filter
+        here, otherwise 1 followed by a full copy of ours (when the
+        client's can't be updated, or the update would be larger), or
+        2 if the client's copy can be kept.  Then, for each idx that's
+        covered by neither, its name and its oids follow, terminated by
+        an empty name.
+
+        """
+        self.init_session()
+        conn = self.conn
+        have_bits, have_k = vint.recv(conn, 'VV')
+        have = set()
+        while True:
+            name = read_bvec(conn)
+            if not name:
+                break
+            have.add(name)
+        b = self.repo.open_bloom()
+        if not b:
+            write_vuint(conn, 0)
+            conn.ok()
+            return
+        with b:
+            indexes = set(self.repo.list_indexes())
+            missing = []
+            full = True
+            if (have_bits, have_k) == (b.bits, b.k) and have <= indexes:
+                budget = 2**b.bits
+                for name in indexes - have:
+                    oids = self.repo.index_oids(name)
+                    budget -= len(oids)
+                    if budget < 0:
+                        break
+                    missing.append((name, oids))
+                else:
+                    full = False
+            if full:
+                write_vuint(conn, 1)
+                write_vuint(conn, len(b.map))
+                conn.write(b.map)
+                missing = [(name, None)
+                           for name in indexes.difference(b.idxnames)]
+            else:
+                write_vuint(conn, 2)
+        for name, oids in missing:
+            write_bvec(conn, name)
+            write_bvec(conn, oids or self.repo.index_oids(name))
+        write_bvec(conn, b'')
+        conn.ok()
+
+    def _objects_session_path(self, session):
+        if not _objects_session_rx.fullmatch(session):
+            raise Exception('invalid objects session %r' % session)
+        return os.path.join(self.repo.repo_dir, b'bup-sessions', session)
+
+    def _objects_session_count(self, session):
+        try:
+            with open(self._objects_session_path(session), 'rb') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _save_objects_session(self):
+        """Record how many objects of the session have been received,
+        after they've been written to a finished pack (or found to
+        exist already)."""
+        session = self._objects_session
+        if not session:
+            return
+        path = self._objects_session_path(session)
+        # another server may have been (still) receiving the session
+        count = max(self._objects_count, self._objects_session_count(session))
+        dirname = os.path.dirname(path)
+        mkdirp(dirname)
+        with atomically_replaced_file(path, 'wb') as f:
+            f.write(b'%d\n' % count)
+        expired = time.time() - OBJECTS_SESSION_EXPIRY
+        for name in os.listdir(dirname):
+            try:
+                sub = os.path.join(dirname, name)
+                if os.stat(sub).st_mtime < expired:
+                    os.unlink(sub)
+            except FileNotFoundError:
+                pass
 
     @_command
-    def receive_objects_v2(self, junk):
+    def resume_objects(self, session):
+        """Report how many objects of the given receive-objects-v2
+        session have been stored, i.e. where a client that lost its
+        connection should resume sending them."""
         self.init_session()
+        count = self._objects_session_count(session.strip())
+        self.conn.write(b'%d\n' % count)
+        self.conn.ok()
+
+    def _read_objects_data(self, n):
+        buf = self.conn.read(n)
+        if len(buf) != n:
+            raise EOFError('object read: expected %d bytes, got %d\n'
+                           % (n, len(buf)))
+        return buf
+
+    @_command
+    def receive_objects_v2(self, session):
+        self.init_session()
+        session = session.strip() or None
+        if session != self._objects_session:
+            self._objects_session = session
+            self._objects_count = 0
+            if session:
+                self._objects_count = self._objects_session_count(session)
         if self.suspended:
             self.suspended = False
         # FIXME: this goes together with the direct accesses below
         self.repo._ensure_packwriter()
-        suggested = set()
+        storer = _ObjectStorer(self._store_objects)
+        try:
+            self._receive_objects(storer)
+        except (EOFError, ConnectionError) as ex:
+            with pending_raise(ex):
+                session = self._objects_session
+                try:
+                    storer.sync()
+                except Exception:
+                    session = None
+                storer.close()
+                if session:
+                    # Keep what we have so the client can resume
+                    self.repo.finish_writing()
+                    self._save_objects_session()
+                else:
+                    self.repo.abort_writing()
+        except BaseException as ex:
+            with pending_raise(ex):
+                storer.close()
+                self.repo.abort_writing()
+        finally:
+            storer.close()
+
+    def _receive_objects(self, storer):
+        conn = self.conn
+        batch = []
+        batch_bytes = 0
         while 1:
-            ns = self.conn.read(4)
+            if batch and (batch_bytes >= RECEIVE_BATCH_BYTES
+                          or not conn.has_input()):
+                # Don't keep the storer waiting while we do
+                storer.put(batch)
+                batch = []
+                batch_bytes = 0
+            ns = conn.read(4)
             if not ns:
-                self.repo.abort_writing()
-                raise Exception('object read: expected length header, got EOF\n')
+                storer.put(batch)
+                raise EOFError('object read: expected length header, got EOF\n')
             n = struct.unpack('!I', ns)[0]
             #debug2('expecting %d bytes\n' % n)
+            if not n or n == 0xffffffff:
+                storer.put(batch)
+                storer.sync()
             if not n:
                 # FIXME: don't be lazy and count ourselves, or something, at least
                 # don't access self.repo internals
@@ -259,26 +576,43 @@ class Server:
                     % (self.repo._packwriter.count,
                        self.repo._packwriter.count != 1 and "s" or ''))
                 fullpath = self.repo.finish_writing()
+                self._save_objects_session()
                 if fullpath:
                     dir, name = os.path.split(fullpath)
-                    self.conn.write(b'%s.idx\n' % name)
-                self.conn.ok()
+                    conn.write(b'%s.idx\n' % name)
+                conn.ok()
                 return
             elif n == 0xffffffff:
                 debug2('bup server: receive-objects suspending.\n')
                 self.suspended = True
-                self.conn.ok()
+                conn.ok()
                 return
+            elif n < 24:
+                storer.put(batch)
+                raise Exception('object read: length %d is less than the'
+                                ' 24 byte oid and crc header\n' % n)
 
-            shar = self.conn.read(20)
-            crcr = struct.unpack('!I', self.conn.read(4))[0]
-            n -= 20 + 4
-            buf = self.conn.read(n)  # object sizes in bup are reasonably small
+            # The oid, the crc, and the object (sizes in bup are
+            # reasonably small), all at once
+            try:
+                buf = self._read_objects_data(n)
+            except EOFError:
+                storer.put(batch)
+                raise
             #debug2('read %d bytes\n' % n)
-            self._check(n, len(buf), 'object read: expected %d bytes, got %d\n')
+            batch.append(buf)
+            batch_bytes += n
+
+    def _store_objects(self, batch, storer):
+        """Store the received objects, and suggest the idxs the
+        client should have (this runs in the storer's thread)."""
+        suggested = storer.suggested
+        for buf in batch:
+            shar = buf[:20]
             if not self.dumb_server_mode:
                 result = self.repo.exists(shar, want_source=True)
                 if result:
+                    self._objects_count += 1
                     oldpack = result.pack
                     assert(oldpack.endswith(b'.idx'))
                     (dir,name) = os.path.split(oldpack)
@@ -290,11 +624,53 @@ class Server:
                         self.conn.write(b'index %s\n' % name)
                         suggested.add(name)
                     continue
+            crcr = struct.unpack_from('!I', buf, 20)[0]
             # FIXME: figure out the right abstraction for this; or better yet,
             #        make the protocol aware of the object type
-            nw, crc = self.repo._packwriter._raw_write((buf,), sha=shar)
-            self._check(crcr, crc, 'object read: expected crc %d, got %d\n')
-        assert False  # should be unreachable
+            nw, crc = self.repo._packwriter._raw_write((memoryview(buf)[24:],),
+                                                       sha=shar)
+            if crcr != crc:
+                raise Exception('object read: expected crc %d, got %d\n'
+                                % (crcr, crc))
+            self._objects_count += 1
+
+    @_command
+    def missing_objects(self, junk):
+        """Answer batches of object ids (a 4-byte count of at most
+        MISSING_OBJECTS_MAX_BATCH followed by the ids, terminated by a
+        zero count) with a bitmap in which bit i (least significant
+        first) is set if the i'th id is missing from the repository
+        (including the objects received so far).  In dumb server mode,
+        all of them are reported as missing.
+
+        """
+        self.init_session()
+        while True:
+            ns = self.conn.read(4)
+            if len(ns) != 4:
+                raise Exception('missing-objects: expected count, got EOF\n')
+            n = struct.unpack('!I', ns)[0]
+            if not n:
+                break
+            if n > MISSING_OBJECTS_MAX_BATCH:
+                raise Exception('missing-objects: batch of %d ids exceeds %d\n'
+                                % (n, MISSING_OBJECTS_MAX_BATCH))
+            oids = self.conn.read(n * 20)
+            if len(oids) != n * 20:
+                raise Exception('missing-objects: expected %d bytes, got %d\n'
+                                % (n * 20, len(oids)))
+            missing = bytearray((n + 7) // 8)
+            if self.dumb_server_mode:
+                # the client has all our idxs, don't look anything up
+                for i in range(n):
+                    missing[i >> 3] |= 1 << (i & 7)
+            else:
+                exists = self.repo.exists
+                for i in range(n):
+                    if not exists(oids[i * 20:(i + 1) * 20]):
+                        missing[i >> 3] |= 1 << (i & 7)
+            self.conn.write(missing)
+        self.conn.ok()
 
     @_command
     def read_ref(self, refname):
@@ -354,6 +730,141 @@ class Server:
                 self.conn.write(buf)
         self.conn.ok()
 
+    @_command
+    def cat_stream(self, args):
+        # Like cat-batch, but reply to each request as it arrives.
+        # The client asks for a window, and we grant it a number of
+        # outstanding requests and a limit on their total size, which
+        # it must respect, see CAT_STREAM_MAX_REQUEST_BYTES.
+        self.init_session()
+        conn = self.conn
+        window, include_data = vint.recv(conn, 'VV')
+        vint.send(conn, 'VV', max(1, min(window, CAT_STREAM_MAX_REQUESTS)),
+                  CAT_STREAM_MAX_REQUEST_BYTES)
+        while True:
+            ref = read_bvec(conn)
+            if not ref:
+                break
+            oidx, typ, size, it = self.repo.get(ref,
+                                                include_data=bool(include_data))
+            if not oidx:
+                conn.write(b'missing\n')
+                continue
+            conn.write(b'%s %s %d\n' % (oidx, typ, size))
+            if it:
+                for buf in it:
+                    conn.write(buf)
+        conn.ok()
+
+    def _close_walk_have(self):
+        if self._walk_have:
+            self._walk_have, (have, bits, k) = None, self._walk_have
+            if have:
+                have.close()
+
+    def _read_walk_have(self):
+        conn = self.conn
+        kind = read_vuint(conn)
+        if kind == 2:  # the same as last time
+            if not self._walk_have:
+                raise Exception('walk-objects: no previous have-set')
+            return
+        self._close_walk_have()
+        if kind == 0:
+            return
+        if kind != 1:
+            raise Exception('walk-objects: unexpected have-set %d' % kind)
+        n = read_vuint(conn)
+        # Check the header before accepting the size it implies
+        header = conn.read(16) if n >= 16 else b''
+        if len(header) != 16 or header[0:4] != b'BLOM' \
+           or struct.unpack('!I', header[4:8])[0] != bloom.BLOOM_VERSION:
+            raise Exception('walk-objects: invalid have-set')
+        bits, k = struct.unpack('!HH', header[8:12])
+        if k not in (4, 5) or bits > bloom.MAX_BLOOM_BITS[k] \
+           or n != 16 + 2**bits:
+            raise Exception('walk-objects: invalid have-set')
+        # It's as big as the client's bloom filter, don't keep it in RAM
+        with tempfile.TemporaryFile() as f:
+            f.write(header)
+            for blob in chunkyreader(conn, n - 16):
+                f.write(blob)
+            f.flush()
+            have = mmap_read(f, close=False)
+        self._walk_have = (have, bits, k)
+
+    @_command
+    def walk_objects(self, args):
+        """Walk the graphs of the objects reachable from the given
+        roots, and send the ones the client doesn't have, so that it
+        can fetch them all with a single request.
+
+        The client first sends its have-set: 0 for none, 1 followed
+        by the header and the table of a bloom filter for the objects
+        it has, or 2 for the one it sent before.  Then it sends the
+        (binary) oids of the roots, terminated by an empty one.  The
+        roots are always walked, but below them, the objects in the
+        have-set are neither walked nor sent.  Since the filter may
+        have false positives, each of them is reported (WALK_HAVE, oid)
+        so that the client can ask for the ones it doesn't have.  The
+        objects already sent on this connection (as far as a bloom
+        filter of bounded size knows) are reported the same way.
+
+        The others follow in walk_object() order, i.e. children before
+        parents, as (WALK_OBJECT, metadata, oid, pack object), where
+        the pack object is as it'd be stored in a pack file, or as
+        (WALK_MISSING, oid) if they're missing here.  WALK_END ends the
+        response.
+
+        """
+        self.init_session()
+        conn = self.conn
+        self._read_walk_have()
+        roots = []
+        while True:
+            oid = read_bvec(conn)
+            if not oid:
+                break
+            if len(oid) != 20:
+                raise Exception('walk-objects: invalid oid %r' % oid)
+            roots.append(oid)
+        have, bits, k = self._walk_have or (None, None, None)
+        if self._walk_sent is None \
+           or self._walk_sent_count > WALK_SENT_MAX:
+            self._walk_sent = bytearray(16 + 2**WALK_SENT_BITS)
+            self._walk_sent_count = 0
+        sent = self._walk_sent
+        def stop_at(oidx):
+            oid = unhexlify(oidx)
+            if oid == root:
+                return False
+            if bloom.bloom_contains(sent, oid, WALK_SENT_BITS, 5)[0] \
+               or (have and bloom.bloom_contains(have, oid, bits, k)[0]):
+                write_vuint(conn, WALK_HAVE)
+                conn.write(oid)
+                return True
+            return False
+        level = self.repo.compression_level
+        if level is None:
+            level = 1
+        for root in roots:
+            for item in self.repo.walk_object(hexlify(root), stop_at=stop_at,
+                                              include_data=True):
+                if item.data is False:
+                    write_vuint(conn, WALK_MISSING)
+                    conn.write(item.oid)
+                    continue
+                vint.send(conn, 'VV', WALK_OBJECT,
+                          1 if git.walk_item_is_metadata(item) else 0)
+                conn.write(item.oid)
+                write_bvec(conn, b''.join(git._encode_packobj(item.type,
+                                                              item.data,
+                                                              level)))
+                self._walk_sent_count += bloom.bloom_add(sent, item.oid,
+                                                         WALK_SENT_BITS, 5)
+        write_vuint(conn, WALK_END)
+        conn.ok()
+
     @_command
     def refs(self, args):
         limit_to_heads, limit_to_tags = args.split()
@@ -416,6 +927,102 @@ class Server:
             write_resolution(self.conn, res)
         self.conn.ok()
 
+    @_command
+    def diff(self, args):
+        # Compare two directories here, rather than have the client
+        # read every tree (that differs) on both sides.
+        self.init_session()
+        (flags,) = args.split()
+        recursive = bool(int(flags) & 1)
+        ref1, ref2 = read_bvec(self.conn), read_bvec(self.conn)
+        try:
+            for status, path, isdir in self.repo.diff(ref1, ref2, recursive):
+                vint.send(self.conn, 'VssV', DIFF_ENTRY, status, path,
+                          1 if isdir else 0)
+        except vfs.IOError as ex:
+            write_vuint(self.conn, DIFF_ERROR)
+            write_ioerror(self.conn, ex)
+        else:
+            write_vuint(self.conn, DIFF_END)
+        self.conn.ok()
+
+    def _run_multiplexed(self, conn, requests, lock, failed):
+        # Run the requests from the queue on a Server for (a reader
+        # of) our repository until there are no more.  If one fails,
+        # end the response to the multiplex command with the error
+        # right away, since the client's waiting for it.
+        try:
+            backend = lambda repo_dir, server: self.repo.open_reader()
+            with Server(conn, backend, mode=self._mode) as server:
+                server.init_session()
+                while True:
+                    item = requests.get()
+                    if item is None:
+                        return
+                    req_id, cmd, rest, body = item
+                    request = _MultiplexedRequest(conn, lock, failed, req_id,
+                                                  body)
+                    server.conn = request
+                    getattr(server, cmd.replace(b'-', b'_').decode('ascii'))(rest)
+                    request.finish()
+        except BaseException as ex:
+            with lock:
+                if not failed:
+                    write_vuint(conn, 0)
+                    conn.error(str(ex).encode('utf-8', errors='backslashreplace'))
+                    conn.outp.flush()
+                failed.append(ex)
+
+    @_command
+    def multiplex(self, args):
+        # Run the commands the client sends as (id, command line,
+        # body) until it sends id 0, up to MULTIPLEX_WORKERS of them
+        # at once, each with its own view of the repository, and tag
+        # their output with the ids, so that the client can have many
+        # in flight at once.  Their responses may be interleaved, and
+        # arrive in any order.
+        self.init_session()
+        conn = self.conn
+        requests = Queue()
+        lock = Lock()
+        failed = []
+        workers = []
+        try:
+            for i in range(MULTIPLEX_WORKERS):
+                worker = Thread(target=self._run_multiplexed,
+                                args=(conn, requests, lock, failed),
+                                name='bup-multiplex-%d' % i)
+                worker.start()
+                workers.append(worker)
+            while True:
+                req_id = read_vuint(conn)
+                if not req_id:
+                    break
+                line = read_bvec(conn)
+                body = read_bvec(conn)
+                debug1('bup server: multiplexed command %d: %r\n'
+                       % (req_id, line))
+                words = line.split(b' ', 1)
+                cmd = words[0]
+                if cmd not in MULTIPLEX_COMMANDS or cmd not in self._commands:
+                    raise Exception('command cannot be multiplexed: %r\n'
+                                    % line)
+                rest = len(words) > 1 and words[1] or b''
+                if not failed:
+                    requests.put((req_id, cmd, rest, body))
+        except EOFError:
+            if not failed:
+                raise
+        finally:
+            for _ in workers:
+                requests.put(None)
+            for worker in workers:
+                worker.join()
+        if failed:
+            raise failed[0]
+        write_vuint(conn, 0)
+        conn.ok()
+
     @_command
     def config_get(self, args):
         self.init_session()
@@ -495,10 +1102,25 @@ class Server:
                 break
 
             cmdattr = cmd.replace(b'-', b'_').decode('ascii', errors='replace')
-            getattr(self, cmdattr)(rest)
+            try:
+                getattr(self, cmdattr)(rest)
+            except Exception as ex:
+                with pending_raise(ex):
+                    self._report_error(ex)
 
         debug1('bup server: done\n')
 
+    def _report_error(self, ex):
+        # Tell the client why we're giving up, so that it won't take
+        # it for a lost connection, if it's still listening.
+        if isinstance(ex, (EOFError, ConnectionError)):
+            return
+        try:
+            self.conn.error(str(ex).encode('utf-8', errors='backslashreplace'))
+            self.conn.outp.flush()
+        except (OSError, ValueError):
+            pass
+
     def __enter__(self):
         return self
 
@@ -507,6 +1129,10 @@ class Server:
             try:
                 if self.suspended:
                     self.repo.finish_writing()
+                    self._save_objects_session()
             finally:
-                if self.repo:
-                    self.repo.close()
+                try:
+                    self._close_walk_have()
+                finally:
+                    if self.repo:
+                        self.repo.close()
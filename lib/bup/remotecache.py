@@ -0,0 +1,262 @@
+"""Persistent client-side cache for remote repositories.
+
+Objects never change, so the trees, commits, and metadata (.bupm)
+blobs a client reads from a remote repository are kept here by oid.
+Resolutions are kept too: those below a commit by its oid (they
+can't change either), and the others along with a digest of the
+repository's refs, so that they're dropped when any ref changes.
+When the cache grows beyond its size limit, the least recently used
+entries are removed.
+
+New entries and access times are collected in memory and written in
+short transactions, so that several clients can share the cache, and
+when the database is locked by another one for too long, lookups miss
+and the changes are dropped instead of failing.
+
+"""
+
+from io import BytesIO
+import sqlite3, time
+
+from bup import protocol, vfs
+from bup.compat import pending_raise
+from bup.helpers import debug1
+
+
+# Write the access times and new entries after this many changes, or
+# when the new entries exceed this many bytes
+_commit_interval = 1000
+_commit_bytes = 16 << 20
+
+# How long to wait for another client's transaction to finish
+_lock_timeout = 5
+
+def _item_key(item):
+    return type(item).__name__.encode('ascii') + getattr(item, 'oid', b'')
+
+class RemoteCache:
+    def __init__(self, filename, max_size):
+        self.closed = False
+        self.max_size = max_size
+        self._db = sqlite3.connect(filename, timeout=_lock_timeout)
+        self._db.text_factory = bytes
+        self._added = {'objects': {}, 'resolutions': {}}
+        self._touched = {'objects': {}, 'resolutions': {}}
+        self._changes = 0
+        self._added_bytes = 0
+        try:
+            self._db.execute('CREATE TABLE IF NOT EXISTS objects'
+                             ' (oid BLOB PRIMARY KEY, type BLOB NOT NULL,'
+                             '  data BLOB NOT NULL, size INTEGER NOT NULL,'
+                             '  atime INTEGER NOT NULL) WITHOUT ROWID')
+            self._db.execute('CREATE TABLE IF NOT EXISTS resolutions'
+                             ' (key BLOB PRIMARY KEY, refs BLOB,'
+                             '  data BLOB NOT NULL, size INTEGER NOT NULL,'
+                             '  atime INTEGER NOT NULL) WITHOUT ROWID')
+            self._db.commit()
+            self._size = self._total_size()
+        except BaseException as ex:
+            with pending_raise(ex):
+                self._db.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._flush()
+        finally:
+            self._db.close()
+
+    def __del__(self):
+        assert self.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def _total_size(self):
+        size = 0
+        for table in ('objects', 'resolutions'):
+            size += self._db.execute('SELECT COALESCE(SUM(size), 0) FROM %s'
+                                     % table).fetchone()[0]
+        return size
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= _commit_interval \
+           or self._added_bytes >= _commit_bytes:
+            self._flush()
+
+    def _flush(self):
+        """Write the pending entries and access times in a single
+        transaction, and evict entries if the cache is too large.  If
+        the database stays locked, drop them, it's only a cache."""
+        added, touched = self._added, self._touched
+        self._added = {'objects': {}, 'resolutions': {}}
+        self._touched = {'objects': {}, 'resolutions': {}}
+        self._changes = 0
+        self._added_bytes = 0
+        key_columns = {'objects': 'oid', 'resolutions': 'key'}
+        size = self._size
+        try:
+            for table, entries in added.items():
+                for key, values in entries.items():
+                    old = self._db.execute('SELECT size FROM %s WHERE %s = ?'
+                                           % (table, key_columns[table]),
+                                           (key,)).fetchone()
+                    size += values['size'] - (old[0] if old else 0)
+                    columns = (key_columns[table],) + tuple(values.keys())
+                    self._db.execute('INSERT OR REPLACE INTO %s (%s)'
+                                     ' VALUES (%s)'
+                                     % (table, ', '.join(columns),
+                                        ', '.join('?' * len(columns))),
+                                     (key,) + tuple(values.values()))
+            for table, entries in touched.items():
+                self._db.executemany('UPDATE %s SET atime = ? WHERE %s = ?'
+                                     % (table, key_columns[table]),
+                                     [(atime, key)
+                                      for key, atime in entries.items()])
+            self._db.commit()
+            self._size = size
+            if self._size > self.max_size:
+                self._evict()
+        except sqlite3.OperationalError as ex:
+            self._db.rollback()
+            debug1('remote cache: dropping changes (%s)\n' % ex)
+
+    def _add(self, table, key, values, size):
+        values = dict(values, size=size, atime=int(time.time()))
+        self._added[table][key] = values
+        self._added_bytes += size
+        self._changed()
+
+    def _lookup(self, table, key_column, columns, key):
+        """Return the columns of the entry for key, or None if there's
+        none, or the database is locked, and note the access."""
+        values = self._added[table].get(key)
+        if values:
+            return tuple(values[c] for c in columns)
+        try:
+            row = self._db.execute('SELECT %s FROM %s WHERE %s = ?'
+                                   % (', '.join(columns), table, key_column),
+                                   (key,)).fetchone()
+        except sqlite3.OperationalError as ex:
+            debug1('remote cache: %s\n' % ex)
+            return None
+        if not row:
+            return None
+        self._touched[table][key] = int(time.time())
+        self._changed()
+        return row
+
+    def _evict(self):
+        # Drop the least recently used entries until we're within
+        # 90% of the limit, so we don't have to do this every time.
+        target = self.max_size * 9 // 10
+        entries = self._db.execute('SELECT atime, size, 0, oid FROM objects'
+                                   ' UNION ALL'
+                                   ' SELECT atime, size, 1, key FROM resolutions'
+                                   ' ORDER BY atime')
+        victims = ([], [])
+        remaining = self._size
+        for atime, size, table, key in entries:
+            if remaining <= target:
+                break
+            victims[table].append((key,))
+            remaining -= size
+        entries.close()
+        self._db.executemany('DELETE FROM objects WHERE oid = ?', victims[0])
+        self._db.executemany('DELETE FROM resolutions WHERE key = ?',
+                             victims[1])
+        debug1('remote cache: evicted %d entries\n'
+               % (len(victims[0]) + len(victims[1])))
+        self._db.commit()
+        self._size = remaining
+
+    def get_object(self, oid):
+        """Return (type, data) for oid, or None if it's not cached."""
+        return self._lookup('objects', 'oid', ('type', 'data'), oid)
+
+    def add_object(self, oid, typ, data):
+        if len(data) > self.max_size // 10:
+            return
+        self._add('objects', oid, {'type': typ, 'data': data}, len(data))
+
+    def set_refs(self, refs):
+        """Drop the resolutions that depend on refs other than the
+        given digest of the current refs."""
+        added = self._added['resolutions']
+        for key in [k for k, v in added.items()
+                    if v['refs'] is not None and v['refs'] != refs]:
+            del added[key]
+        self._flush()
+        try:
+            self._db.execute('DELETE FROM resolutions'
+                             ' WHERE refs IS NOT NULL AND refs != ?', (refs,))
+            self._db.commit()
+            self._size = self._total_size()
+        except sqlite3.OperationalError as ex:
+            # They won't match the current refs anyway
+            self._db.rollback()
+            debug1('remote cache: %s\n' % ex)
+
+    @staticmethod
+    def _resolution_key(path, parent, want_meta, follow, refs):
+        """Return (key, refs, prefix_len), where the key identifies
+        the resolution of path (relative to parent), and prefix_len is
+        the number of elements of the parent, up to and including its
+        last commit, that are left out of the cached resolution.  When
+        there's no commit, the key (and the refs returned) depend on
+        the refs digest.
+
+        """
+        parent = parent or ()
+        prefix_len = 0
+        for i, (name, item) in enumerate(parent):
+            if isinstance(item, vfs.Commit):
+                prefix_len = i + 1
+        if prefix_len:
+            base = parent[prefix_len - 1][1].coid
+            refs = None
+        elif refs:
+            base = refs
+        else:
+            return None, None, 0
+        rest = b''.join(b'%s\0%s\0' % (name, _item_key(item))
+                        for name, item in parent[prefix_len:])
+        flags = b'%d%d' % (1 if want_meta else 0, 1 if follow else 0)
+        return b'\0'.join((flags, base, rest, path)), refs, prefix_len
+
+    def get_resolution(self, path, parent, want_meta, follow, refs):
+        """Return the cached resolution, or None.  The refs are the
+        digest of the current refs."""
+        key, refs, prefix_len = \
+            self._resolution_key(path, parent, want_meta, follow, refs)
+        if not key:
+            return None
+        row = self._lookup('resolutions', 'key', ('data',), key)
+        if not row:
+            return None
+        prefix = tuple(parent[:prefix_len]) if prefix_len else ()
+        return prefix + protocol.read_resolution(BytesIO(row[0]))
+
+    def add_resolution(self, path, parent, want_meta, follow, refs,
+                       resolution):
+        key, refs, prefix_len = \
+            self._resolution_key(path, parent, want_meta, follow, refs)
+        if not key:
+            return
+        prefix = parent[:prefix_len] if prefix_len else ()
+        # A symlink may have taken the resolution out of the commit
+        if [(n, _item_key(i)) for n, i in resolution[:prefix_len]] \
+           != [(n, _item_key(i)) for n, i in prefix]:
+            return
+        out = BytesIO()
+        protocol.write_resolution(out, resolution[prefix_len:])
+        data = out.getvalue()
+        self._add('resolutions', key, {'refs': refs, 'data': data},
+                  len(data) + len(key))
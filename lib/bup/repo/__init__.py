@@ -68,6 +68,11 @@ _path_rs = br'(/.*)?'
 _url_rx = re.compile(br'%s(?:%s%s)?%s' % (_protocol_rs, _host_rs, _port_rs, _path_rs),
                      re.I)
 
+def is_url(address):
+    """Return true if the address is a URL (e.g. ssh://host/path), as
+    opposed to a path or host:path."""
+    return bool(_url_rx.match(address))
+
 class ParseError(Exception):
     pass
 
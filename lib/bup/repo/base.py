@@ -1,10 +1,13 @@
 
 import random
 from binascii import hexlify, unhexlify
+from errno import ENOTDIR
+from stat import S_ISDIR
 
 from bup import vfs, git
 from bup.compat import pending_raise, bytes_from_byte
 from bup.helpers import debug2
+from bup.io import path_msg
 from bup import git
 
 
@@ -83,6 +86,31 @@ class BaseRepo:
         return vfs.resolve(self, path, parent=parent,
                            want_meta=want_meta, follow=follow)
 
+    def resolve_many(self, paths, want_meta=True, follow=True):
+        """Return a list of what resolve() returns for each of the
+        paths, or the vfs.IOError it raises."""
+        result = []
+        for path in paths:
+            try:
+                result.append(self.resolve(path, want_meta=want_meta,
+                                           follow=follow))
+            except vfs.IOError as ex:
+                result.append(ex)
+        return result
+
+    def diff(self, ref1, ref2, recursive=False):
+        """Yield (status, path, isdir) for the differences between the
+        directories ref1 and ref2 resolve to, see vfs.diff()."""
+        items = []
+        for ref in (ref1, ref2):
+            res = self.resolve(ref, want_meta=False)
+            item = res[-1][1]
+            if item is not None and not S_ISDIR(vfs.item_mode(item)):
+                raise vfs.IOError(ENOTDIR, 'path %s is not a directory'
+                                  % path_msg(ref), terminus=res)
+            items.append(item)
+        return vfs.diff(self, items[0], items[1], recursive)
+
     def _ensure_repo_id(self):
         val = self.config_get(b'bup.repo-id')
         if val is not None:
@@ -220,6 +248,18 @@ class BaseRepo:
         types to retrieve the data for.
         """
 
+    def get_many(self, refs, *, include_data=True):
+        """
+        Yield a tuple of (oidx, type, size, data) for each of the refs,
+        in order, where all but the data are as for get(), and the data
+        is a bytes object, or None when include_data is False (or the
+        ref doesn't exist).  Implementations may consume the refs ahead
+        of the results, e.g. to have several requests in flight.
+        """
+        for ref in refs:
+            oidx, typ, sz, data_it = self.get(ref, include_data=include_data)
+            yield oidx, typ, sz, b''.join(data_it) if data_it else None
+
     @notimplemented
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         """
@@ -236,6 +276,24 @@ class BaseRepo:
         (optional, used only by bup server)
         """
 
+    @notimplemented
+    def open_bloom(self):
+        """
+        Return the bloom filter (a bloom.ShaBloom that the caller must
+        close) for the indexes in this repository, or None if there's
+        no valid one.  It need not cover all of the indexes, see its
+        idxnames.
+        (optional, used by bup server and bup get)
+        """
+
+    @notimplemented
+    def index_oids(self, name):
+        """
+        Return the oids in the given index (name) as a bytes object
+        of concatenated binary (20-byte) oids.
+        (optional, used only by bup server)
+        """
+
     @notimplemented
     def write_commit(self, tree, parent,
                      author, adate_sec, adate_tz,
@@ -9,7 +9,9 @@ types of files
  * idx files (bup.storage.Kind.IDX)
 
 We also cache the idx files locally in unencrypted form, so that we
-can generate midx files or look up if an object already exists.
+can generate midx files or look up if an object already exists, and
+(with bup.separatemeta) the metadata packs in their encrypted form,
+so that browsing the repository doesn't need the storage.
 
 
 The encryption design should have the following properties:
@@ -136,8 +138,6 @@ restored data.
 """
 
 # TODO
-#  * keep metadata packs locally (if split out? configurable?
-#    encrypted?)
 #  * repo config
 #    - stored in repo
 #    - symmetrically encrypted using repokey
@@ -149,15 +149,20 @@ restored data.
 import os
 import struct
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 try:
     import zstandard as zstd
 except ImportError:
     zstd = None
 import json
 import fnmatch
+import tempfile
 from io import BytesIO
 from binascii import hexlify, unhexlify
 from itertools import islice
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Lock
 
 try:
     import libnacl.secret
@@ -165,11 +170,14 @@ try:
 except ImportError:
     libnacl = None
 
-from bup import git, vfs
-from bup.helpers import mkdirp, pending_raise
+from bup import bloom, git, midx, vfs
+from bup.helpers import \
+    (atomically_replaced_file, debug1, mkdirp, pending_raise, progress,
+     qprogress)
 from bup.vint import read_vuint, pack
-from bup.storage import get_storage, FileNotFound, Kind
-from bup.compat import bytes_from_uint
+from bup.storage import \
+    get_storage, FileAlreadyExists, FileModified, FileNotFound, Kind
+from bup.storage.file import FileReader
 from bup.repo import ConfigRepo
 from bup import hashsplit
 
@@ -181,24 +189,31 @@ MAX_ENC_BLOB_VUINT_LEN = len(pack('V', MAX_ENC_BLOB))
 
 NONCE_DATA, NONCE_LEN = 0, 0x80
 
-class EncryptedVuintReader:
-    """
-    Reader for encrypted vuint items.
-    """
-    def __init__(self, file, vuint_cs, szhint):
-        self.file = file
-        self.vuint_cs = tuple(x for x in vuint_cs)
-        self.offs = 0
-        self.szhint = szhint
-
-    def read(self, sz):
-        assert sz == 1
-        v = self.file.read(1, szhint=self.szhint)[0]
-        self.szhint -= 1
-        ret = bytes_from_uint(v ^ self.vuint_cs[self.offs])
-        self.offs += 1
-        assert self.offs < len(self.vuint_cs)
-        return ret
+# get_many() looks up and fetches this many objects at a time
+GET_MANY_BATCH = 256
+
+# Fold the refs journal into the refs snapshot once it has more entries
+REFS_JOURNAL_MAX = 32
+
+# Give up when the refs keep changing while we read or update them
+REFS_READ_ATTEMPTS = 10
+REFS_WRITE_ATTEMPTS = 10
+
+# How many objects a container writing via an executor may have
+# queued before write() waits for the oldest to be written
+MAX_QUEUED_WRITES = 128
+
+# Metadata packs are fetched into the local cache in pieces of this size
+META_FETCH_CHUNK = 1024 * 1024
+
+# When reading objects, start by reading about one blob at a time, and
+# double that (up to READ_AHEAD_MAX) while the reads are sequential, so
+# that e.g. the chunks of a file are fetched in a few larger reads.
+READ_AHEAD_MAX = 4 * 1024 * 1024
+
+def _nonce(kind, offset):
+    assert kind in (NONCE_DATA, NONCE_LEN)
+    return struct.pack('>B15xQ', kind, offset)
 
 class NoneCompressor:
     """
@@ -234,10 +249,15 @@ class EncryptedContainer:
     HEADER, OBJ = range(2)
 
     def __init__(self, repo, storage, name, mode, kind, compression=None,
-                 key=None, idxwriter=None, overwrite=None, compressor='zlib'):
+                 key=None, idxwriter=None, overwrite=None, compressor='zlib',
+                 executor=None):
         self.file = None # for __del__ in case of exceptions
         assert mode in ('r', 'w')
         self.mode = mode
+        self._executor = executor
+        self._compressing = deque()
+        self._encrypting = deque()
+        self._queued = set()
         self._make_compressor = None
         if mode == 'w':
             compdata = get_compression_info(compressor, compression)
@@ -303,10 +323,16 @@ class EncryptedContainer:
                 elif compr == 2:
                     if zstd is None:
                         raise Exception("zstd compression requires the zstandard module")
-                    self._decompress = zstd.ZstdDecompressor().decompress
+                    # decompressors can't be shared between threads
+                    self._decompress = \
+                        lambda data: zstd.ZstdDecompressor().decompress(data)
                 self.box = libnacl.secret.SecretBox(inner_hdr[4:])
                 self._check = None
                 self.offset = self.headerlen
+                self._window = b''
+                self._window_offset = 0
+                self._next_offset = None
+                self._readahead = self._blobsize
             except:
                 self.close()
                 raise
@@ -349,34 +375,49 @@ class EncryptedContainer:
         assert self.overwrite is None
 
     def nonce(self, kind, write=True):
-        assert kind in (NONCE_DATA, NONCE_LEN)
-        nonce = struct.pack('>B15xQ', kind, self.offset)
+        nonce = _nonce(kind, self.offset)
         if write:
             # safety check for nonce reuse
             assert nonce not in self._used_nonces, "nonce reuse!"
             self._used_nonces.add(nonce)
         return nonce
 
+    def _compress(self, objtype, data):
+        objtypeb = struct.pack('B', objtype)
+        z = self._make_compressor(len(objtypeb) + len(data))
+        return z.compress(objtypeb) + z.compress(data) + z.flush()
+
+    def _sequence(self, data):
+        """Assign the next offset (and with it the nonces) to the
+        compressed data, and return (offset, nonces, vuint)."""
+        sz = len(data) + libnacl.crypto_secretbox_MACBYTES
+        assert sz <= MAX_ENC_BLOB
+        vuint = pack('V', sz)
+        offset = self.offset
+        nonces = self.nonce(NONCE_DATA), self.nonce(NONCE_LEN)
+        self.offset += len(vuint) + sz
+        return offset, nonces, vuint
+
+    @staticmethod
+    def _encrypt(box, data, nonces, vuint):
+        # Doesn't touch the container, so it may run in another thread
+        data = box.encrypt(data, nonces[0], pack_nonce=False)[1]
+        encvuint = libnacl.crypto_stream_xor(vuint, nonces[1], box.sk)
+        return encvuint + data
+
     def _write(self, data, dtype, objtype=None):
         assert self.mode == 'w'
         if dtype == self.OBJ:
-            objtypeb = struct.pack('B', objtype)
-            z = self._make_compressor(len(objtypeb) + len(data))
-            data = z.compress(objtypeb) + z.compress(data) + z.flush()
-            data = self.box.encrypt(data, self.nonce(NONCE_DATA),
-                                    pack_nonce=False)[1]
-            assert len(data) <= MAX_ENC_BLOB
-            vuint = pack('V', len(data))
-            encvuint = libnacl.crypto_stream_xor(vuint, self.nonce(NONCE_LEN),
-                                                 self.box.sk)
-            data = encvuint + data
+            data = self._compress(objtype, data)
+            retval, nonces, vuint = self._sequence(data)
+            data = self._encrypt(self.box, data, nonces, vuint)
+        else:
+            retval = self.offset
+            self.offset += len(data)
         self.file.write(data)
-        retval = self.offset
-        self.offset += len(data)
         return retval
 
-    def write(self, objtype, sha, data):
-        offs = self._write(data, self.OBJ, objtype)
+    def _commit(self, sha, objtype, offs):
         if self.idxwriter:
             # Set the crc to the objtype - we cannot copy any objects
             # from one pack file to another without decrypting anyway
@@ -385,13 +426,59 @@ class EncryptedContainer:
             # be useful to have the objtype in case we need to e.g.
             # attempt to recover all commits (if refs are lost) etc.
             self.idxwriter.add(sha, objtype, offs)
-        return offs
+
+    def write(self, objtype, sha, data):
+        """Write the object, and return its offset.  With an executor,
+        the object is only queued, to be compressed and encrypted by
+        the executor, and None is returned."""
+        if not self._executor:
+            offs = self._write(data, self.OBJ, objtype)
+            self._commit(sha, objtype, offs)
+            return offs
+        assert self.mode == 'w'
+        self._compressing.append((sha, objtype,
+                                  self._executor.submit(self._compress,
+                                                        objtype, data)))
+        self._queued.add(sha)
+        self._pump(MAX_QUEUED_WRITES)
+        return None
+
+    def _pump(self, limit):
+        """Move the queued objects along, in order: assign offsets to
+        the compressed ones and have them encrypted, and write out the
+        encrypted ones, until no more than limit objects are queued."""
+        while True:
+            while self._compressing and self._compressing[0][2].done():
+                sha, objtype, job = self._compressing.popleft()
+                offs, nonces, vuint = self._sequence(job.result())
+                job = self._executor.submit(self._encrypt, self.box,
+                                            job.result(), nonces, vuint)
+                self._encrypting.append((sha, objtype, offs, job))
+            while self._encrypting and self._encrypting[0][3].done():
+                sha, objtype, offs, job = self._encrypting.popleft()
+                self.file.write(job.result())
+                self._commit(sha, objtype, offs)
+                self._queued.discard(sha)
+            if len(self._compressing) + len(self._encrypting) <= limit:
+                return
+            if self._encrypting:
+                self._encrypting[0][3].exception()
+            else:
+                self._compressing[0][2].exception()
+
+    def exists(self, sha):
+        """Return true if the object was written to (or queued for)
+        this container."""
+        return sha in self._queued or self.idxwriter.exists(sha)
 
     def finish(self):
         assert self.mode == 'w'
-        self.file.close()
-        self.file = None
-        self._cleanup()
+        self._pump(0)
+        try:
+            self.file.close()
+        finally:
+            self.file = None
+            self._cleanup()
 
     @property
     def size(self):
@@ -409,6 +496,10 @@ class EncryptedContainer:
 
     def _cleanup(self):
         if self.mode == 'w':
+            # anything still queued (after an error) is dropped
+            self._compressing.clear()
+            self._encrypting.clear()
+            self._queued.clear()
             del self.box
         elif self.file is not None:
             self.file.close()
@@ -417,22 +508,87 @@ class EncryptedContainer:
             self.overwrite.close()
             self.overwrite = None
 
-    def read(self, offset=None):
-        assert self.mode == 'r'
-        self.offset = offset or self.headerlen
-        self.file.seek(self.offset)
-        vuint_cs = libnacl.crypto_stream(MAX_ENC_BLOB_VUINT_LEN,
-                                         self.nonce(NONCE_LEN, write=False),
-                                         self.box.sk)
-        sz = read_vuint(EncryptedVuintReader(self.file, vuint_cs, self._blobsize))
+    def _fetch(self, offset, sz, szhint):
+        """Return the sz bytes at offset, from the read-ahead window if
+        they're in it, otherwise read szhint (at least sz) bytes into
+        a new window first."""
+        start = offset - self._window_offset
+        if start >= 0 and start + sz <= len(self._window):
+            return self._window[start:start + sz]
+        szhint = min(max(sz, szhint), self.file.size - offset)
+        self.file.seek(offset)
+        self._window = self.file.read(szhint, szhint=szhint)
+        self._window_offset = offset
+        assert len(self._window) == szhint
+        return self._window[:sz]
+
+    def _read_size(self, offset, szhint):
+        """Return (vuint length, size) of the object at offset."""
+        encvuint = self._fetch(offset,
+                               min(MAX_ENC_BLOB_VUINT_LEN,
+                                   self.file.size - offset),
+                               szhint)
+        vuint = libnacl.crypto_stream_xor(encvuint,
+                                          _nonce(NONCE_LEN, offset),
+                                          self.box.sk)
+        f = BytesIO(vuint)
+        sz = read_vuint(f)
         assert sz <= MAX_ENC_BLOB
-        data = self.file.read(sz)
-        assert len(data) == sz
-        data = self.box.decrypt(data, self.nonce(NONCE_DATA, write=False))
+        return f.tell(), sz
+
+    def _unpack(self, offset, data):
+        # Only uses immutable state, so it may run in another thread;
+        # the nonces are derived from the offset of the whole object
+        data = self.box.decrypt(data, _nonce(NONCE_DATA, offset))
         data = self._decompress(data)
         objtype = struct.unpack('B', data[:1])[0]
         return objtype, data[1:]
 
+    def read(self, offset=None):
+        assert self.mode == 'r'
+        offset = offset or self.headerlen
+        if offset == self._next_offset:
+            self._readahead = min(self._readahead * 2, READ_AHEAD_MAX)
+        else:
+            self._readahead = self._blobsize
+        vlen, sz = self._read_size(offset, self._readahead)
+        data = self._fetch(offset + vlen, sz, self._readahead - vlen)
+        self._next_offset = offset + vlen + sz
+        return self._unpack(offset, data)
+
+    def read_many(self, offsets, executor=None):
+        """Return an iterator of (objtype, data) for the objects at each
+        of the offsets, in order.  Objects close to each other are
+        fetched together, and all of them are fetched before this
+        returns.  If an executor is given, the objects are decrypted
+        and decompressed by it while the caller consumes them."""
+        assert self.mode == 'r'
+        offsets = list(offsets)
+        order = sorted(set(offsets))
+        results = {}
+        end = 0
+        for i, offset in enumerate(order):
+            if offset >= end:
+                # read ahead up to the last of the following objects
+                # that are near enough, assuming it's about a blob
+                last = offset
+                for following in order[i + 1:]:
+                    if following - offset > READ_AHEAD_MAX:
+                        break
+                    last = following
+                end = last + self._blobsize
+            vlen, sz = self._read_size(offset, end - offset)
+            data = self._fetch(offset + vlen, sz, end - offset - vlen)
+            if executor:
+                results[offset] = executor.submit(self._unpack, offset, data)
+            else:
+                results[offset] = self._unpack(offset, data)
+        self._window = b''
+        self._next_offset = None
+        if executor:
+            return (results[offset].result() for offset in offsets)
+        return (results[offset] for offset in offsets)
+
     def close(self):
         assert self.mode == 'r'
         if self.file is None:
@@ -442,6 +598,300 @@ class EncryptedContainer:
         self._cleanup()
 
 
+class _CachedContainer:
+    def __init__(self):
+        self.lock = Lock()
+        self.container = None
+        self.users = 0
+        self.uses = 0
+        self.evicted = False
+
+class ContainerCache:
+    """Keep up to max_size containers open for reading, and when
+    another one is needed, close the least recently used one that
+    isn't in use.  The containers are handed out by use(), which also
+    serializes the threads using the same container."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def _drop(self, name):
+        entry = self._entries.pop(name)
+        entry.evicted = True
+        if not entry.users and entry.container:
+            entry.container.close()
+
+    @contextmanager
+    def use(self, name, open_container):
+        """Yield the (possibly newly opened) container called name,
+        calling open_container() to open it when it isn't cached."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry:
+                self._entries.move_to_end(name)
+                self.hits += 1
+            else:
+                entry = self._entries[name] = _CachedContainer()
+                self.misses += 1
+                for victim in list(self._entries):
+                    if len(self._entries) <= self.max_size:
+                        break
+                    if not self._entries[victim].users and victim != name:
+                        self._drop(victim)
+                        self.evictions += 1
+            entry.users += 1
+            entry.uses += 1
+        try:
+            with entry.lock:
+                if entry.container is None:
+                    try:
+                        entry.container = open_container()
+                    except BaseException as ex:
+                        with pending_raise(ex):
+                            with self._lock:
+                                if self._entries.get(name) is entry:
+                                    del self._entries[name]
+                yield entry.container
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.evicted and not entry.users and entry.container:
+                    entry.container.close()
+
+    def discard(self, name):
+        with self._lock:
+            if name in self._entries:
+                self._drop(name)
+
+    def stats(self):
+        """Return (hits, misses, evictions, {name: uses}) where the
+        uses are those of the containers that are still cached."""
+        with self._lock:
+            return (self.hits, self.misses, self.evictions,
+                    {name: entry.uses for name, entry in self._entries.items()})
+
+    def close(self):
+        with self._lock:
+            for name in list(self._entries):
+                self._drop(name)
+
+
+class CommitGraph:
+    """The (first-parent) commit graph, as far as we've seen it, kept
+    in a local file so that listing revisions doesn't have to fetch
+    and decrypt every commit from the storage.  For each commit it
+    has the tree, the author time and the parents.  Records are
+    appended, each one encrypted with the repokey.  When the file is
+    loaded and has invalid (e.g. torn) or duplicate records, it's
+    rewritten from the valid ones, so that later appends are read
+    correctly again, and once it has more than max_commits, it's
+    started over."""
+    _header = struct.Struct('<I')
+    _fixed = struct.Struct('<20s20sqH')
+    max_commits = 1000000
+
+    def __init__(self, filename, key):
+        self.filename = filename
+        self._box = libnacl.secret.SecretBox(key)
+        self._commits = None
+        self._lock = Lock()
+
+    def _load(self):
+        self._commits = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offs = 0
+        valid = []
+        clean = True
+        while offs < len(data):
+            if offs + self._header.size > len(data):
+                clean = False
+                break
+            sz, = self._header.unpack_from(data, offs)
+            offs += self._header.size
+            if offs + sz > len(data):
+                clean = False
+                break
+            record = data[offs:offs + sz]
+            offs += sz
+            try:
+                plain = self._box.decrypt(record)
+                oid, tree, author_sec, nparents = \
+                    self._fixed.unpack_from(plain)
+            except (ValueError, struct.error):
+                plain = None
+            parents = plain and plain[self._fixed.size:]
+            if not plain or len(parents) != 20 * nparents:
+                debug1('encrypted: ignoring invalid commit-graph record\n')
+                clean = False
+                continue
+            if oid in self._commits:
+                clean = False
+                continue
+            self._commits[oid] = (tree, author_sec,
+                                  tuple(parents[i:i + 20]
+                                        for i in range(0, len(parents), 20)))
+            valid.append(data[offs - sz - self._header.size:offs])
+        if len(self._commits) > self.max_commits:
+            debug1('encrypted: starting over with the commit-graph\n')
+            self._commits = {}
+            valid = []
+            clean = False
+        if not clean:
+            with atomically_replaced_file(self.filename, 'wb') as f:
+                for record in valid:
+                    f.write(record)
+
+    def get(self, oid):
+        """Return (tree, author_sec, parents) for the commit oid, or
+        None if it isn't known."""
+        with self._lock:
+            if self._commits is None:
+                self._load()
+            return self._commits.get(oid)
+
+    def add(self, oid, tree, author_sec, parents):
+        with self._lock:
+            if self._commits is None:
+                self._load()
+            if oid in self._commits:
+                return
+            parents = tuple(parents)
+            record = self._fixed.pack(oid, tree, author_sec, len(parents))
+            record = self._box.encrypt(record + b''.join(parents))
+            # a single (small) write, so concurrent appends don't mix
+            with open(self.filename, 'ab') as f:
+                f.write(self._header.pack(len(record)) + record)
+            self._commits[oid] = (tree, author_sec, parents)
+
+
+class _MirroredWriter:
+    """Write a pack to the storage and to the metadata pack cache."""
+    def __init__(self, cache, name, writer):
+        self.cache = cache
+        self.name = name
+        self.writer = writer
+        fd, self.tmp_filename = tempfile.mkstemp(prefix=b'_tmp_',
+                                                 dir=cache.path)
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.writer.write(data)
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+        try:
+            self.writer.close()
+        except BaseException as ex:
+            with pending_raise(ex):
+                os.unlink(self.tmp_filename)
+        os.rename(self.tmp_filename, os.path.join(self.cache.path, self.name))
+        self.cache.evict(keep=self.name)
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp_filename)
+        self.writer.abort()
+
+
+class MetaPackCache:
+    """Local copies of the metadata packs (see bup.separatemeta), so
+    that walking the trees doesn't have to read from the storage.
+    The packs are kept exactly as stored, i.e. encrypted, are added
+    when they're written or first read, and the least recently used
+    ones are removed when they exceed max_size in total.  This can be
+    passed to EncryptedContainer in place of the storage."""
+    def __init__(self, path, storage, max_size):
+        self.path = path
+        self.storage = storage
+        self.max_size = max_size
+        self._openset = set()
+        self._lock = Lock()
+        mkdirp(path)
+
+    def has(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def get_writer(self, name, kind, overwrite=None):
+        assert kind == Kind.METADATA and overwrite is None
+        return _MirroredWriter(self, name,
+                               self.storage.get_writer(name, kind))
+
+    def get_reader(self, name, kind):
+        try:
+            reader = FileReader(self.path, name, kind, self._openset)
+        except FileNotFound:
+            reader = self._fetch(name, kind)
+            if reader is not None:
+                return reader
+            reader = FileReader(self.path, name, kind, self._openset)
+        # for the eviction
+        os.utime(reader.filename)
+        return reader
+
+    def _fetch(self, name, kind):
+        """Copy the pack from the storage, or return the storage's
+        reader for it if it's too large to be worth it."""
+        remote = self.storage.get_reader(name, kind)
+        if remote.size > self.max_size // 4:
+            return remote
+        try:
+            with atomically_replaced_file(os.path.join(self.path, name),
+                                          'wb') as f:
+                remaining = remote.size
+                while remaining:
+                    data = remote.read(min(remaining, META_FETCH_CHUNK))
+                    if not data:
+                        raise Exception('%s: unexpected end of file'
+                                        % name.decode('ascii'))
+                    f.write(data)
+                    remaining -= len(data)
+        finally:
+            remote.close()
+        self.evict(keep=name)
+        return None
+
+    def evict(self, keep=None):
+        """Remove the least recently used packs (other than keep)
+        until we're within 90% of the limit, if we exceed it."""
+        with self._lock:
+            entries = []
+            total = 0
+            for name in fnmatch.filter(os.listdir(self.path), b'*.encpack'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue # removed by another process
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+            if total <= self.max_size:
+                return
+            target = self.max_size * 9 // 10
+            evicted = 0
+            for mtime, size, name in sorted(entries):
+                if total <= target:
+                    break
+                if name == keep:
+                    continue
+                self.remove((name,))
+                total -= size
+                evicted += 1
+            debug1('encrypted: evicted %d metadata packs\n' % evicted)
+
+    def remove(self, names):
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+
 class EncryptedRepo(ConfigRepo):
     """
     Implement the Repo abstraction, but store the data in an encrypted fashion.
@@ -454,7 +904,9 @@ class EncryptedRepo(ConfigRepo):
         self.meta_fakesha = None
         self.cfg_file = cfg_file
         self.idxlist = None
-        self.ec_cache = {}
+        self.ec_cache = None
+        self.meta_cache = None
+        self._pool = None
         self._in_config_read = False
         self.closed = True
 
@@ -469,7 +921,10 @@ class EncryptedRepo(ConfigRepo):
         if not os.path.isdir(self.cachedir):
             raise Exception("cachedir doesn't exist or isn't a directory - may have to init the repo?")
         self.cfgfile = os.path.join(self.cachedir, b'repo.conf')
+        self.commit_graph = None
+        self._journal_cache = {}
         self._config_loaded = False
+        self._config_cache = {}
 
         self.readkey = None
         self.repokey = None
@@ -483,6 +938,9 @@ class EncryptedRepo(ConfigRepo):
         repokey = self.access_config_get(b'bup.repokey')
         if repokey is not None:
             self.repokey = unhexlify(repokey)
+            self.commit_graph = \
+                CommitGraph(os.path.join(self.cachedir, b'commit-graph'),
+                            self.repokey)
         writekey = self.access_config_get(b'bup.writekey')
         if writekey is not None:
             self.writekey = unhexlify(writekey)
@@ -492,6 +950,21 @@ class EncryptedRepo(ConfigRepo):
             assert self.readkey is not None, "at least one of 'readkey' or 'writekey' is required"
             self.writekey = self.readkey.pk
 
+        self.idx_sync_threads = \
+            self.access_config_get(b'bup.idx-sync-threads', opttype='int')
+        if self.idx_sync_threads is None:
+            self.idx_sync_threads = 8
+        if self.idx_sync_threads < 1:
+            raise Exception('bup.idx-sync-threads must be positive')
+
+        cache_size = self.access_config_get(b'bup.container-cache-size',
+                                            opttype='int')
+        if cache_size is None:
+            cache_size = 200
+        if cache_size < 1:
+            raise Exception('bup.container-cache-size must be positive')
+        self.ec_cache = ContainerCache(cache_size)
+
         self.storage = get_storage(self, create=create)
 
         compressalgo = self.config_get(b'bup.compressalgo')
@@ -509,50 +982,96 @@ class EncryptedRepo(ConfigRepo):
         if self.compression is None:
             self.compression = -1
         self.separatemeta = self.config_get(b'bup.separatemeta', opttype='bool')
-        self.data_written_objs = set()
         if self.separatemeta:
-            self.meta_written_objs = set()
-        else:
-            self.meta_written_objs = self.data_written_objs
+            meta_cache_size = \
+                self.access_config_get(b'bup.metadata-cache-size',
+                                       opttype='int')
+            if meta_cache_size is None:
+                meta_cache_size = 1024 * 1024 * 1024
+            if meta_cache_size < 0:
+                raise Exception('bup.metadata-cache-size must not be negative')
+            if meta_cache_size:
+                self.meta_cache = \
+                    MetaPackCache(os.path.join(self.cachedir, b'metadata'),
+                                  self.storage, meta_cache_size)
 
         self.register_config_types({
             b'bup.separatemeta': 'bool',
             b'bup.compression': 'int',
         })
 
+    def _fetch_idx(self, remote_idx):
+        local_idx = remote_idx.replace(b'.encidx', b'.idx')
+        with self._open_read(remote_idx, Kind.IDX) as ec, \
+             atomically_replaced_file(os.path.join(self.cachedir, local_idx),
+                                      'wb') as f:
+            f.write(ec.read()[1])
+
     def _synchronize_idxes(self):
         if self.idxlist is not None:
             return
-        changes = False
         local_idxes = set(fnmatch.filter(os.listdir(self.cachedir), b'*.idx'))
+        missing = []
         for remote_idx in self.storage.list(Kind.IDX, b'*.encidx'):
             local_idx = remote_idx.replace(b'.encidx', b'.idx')
             if local_idx in local_idxes:
                 local_idxes.remove(local_idx)
             else:
-                with self._open_read(remote_idx, Kind.IDX) as ec, \
-                     open(os.path.join(self.cachedir, local_idx), 'wb') as f:
-                    f.write(ec.read()[1])
-                changes = True
+                missing.append(remote_idx)
+        changes = bool(missing or local_idxes)
         for local_idx in local_idxes:
-            changes = True
             os.unlink(os.path.join(self.cachedir, local_idx))
 
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.idx_sync_threads,
+                                    thread_name_prefix='bup-idx-sync') as pool:
+                jobs = [pool.submit(self._fetch_idx, remote_idx)
+                        for remote_idx in missing]
+                try:
+                    for count, job in enumerate(jobs, 1):
+                        job.result()
+                        qprogress('Synchronizing indexes: %d/%d\r'
+                                  % (count, len(jobs)))
+                    progress('Synchronizing indexes: %d/%d, done.\n'
+                             % (count, len(jobs)))
+                except BaseException:
+                    for job in jobs:
+                        job.cancel()
+                    raise
+
         if changes:
             git.auto_midx(self.cachedir)
 
         self._idx_synced = True
         self.idxlist = git.PackIdxList(self.cachedir)
 
+    def sync_indexes(self):
+        """Bring the local idx cache up to date with the storage."""
+        if self.idxlist is not None:
+            self.idxlist.close()
+            self.idxlist = None
+        self._synchronize_idxes()
+
+    def _get_pool(self):
+        # for the (de)compression and (de)cryption of pack objects
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=os.cpu_count(),
+                                            thread_name_prefix='bup-crypt')
+        return self._pool
+
     def _create_new_pack(self, kind):
         fakesha = libnacl.randombytes(20)
         hexsha = hexlify(fakesha)
-        return fakesha, EncryptedContainer(self, self.storage,
+        storage = self.storage
+        if kind == Kind.METADATA and self.meta_cache is not None:
+            storage = self.meta_cache
+        return fakesha, EncryptedContainer(self, storage,
                                            b'pack-%s.encpack' % hexsha, 'w',
                                            kind, self.compression,
                                            key=self.writekey,
                                            idxwriter=git.PackIdxV2Writer(),
-                                           compressor=self.compressor)
+                                           compressor=self.compressor,
+                                           executor=self._get_pool())
 
     def _ensure_data_writer(self):
         self._synchronize_idxes()
@@ -569,8 +1088,7 @@ class EncryptedRepo(ConfigRepo):
         self._synchronize_idxes()
 
         if self.meta_writer is not None and self.meta_writer.size > self.max_pack_size:
-            self._finish(self.meta_writer, self.meta_fakesha,
-                         meta=(self.meta_writer != self.data_writer))
+            self._finish(self.meta_writer, self.meta_fakesha)
             if self.data_writer == self.meta_writer:
                 self.data_writer = None
             self.meta_writer = None
@@ -584,9 +1102,15 @@ class EncryptedRepo(ConfigRepo):
 
     def close(self):
         self.abort_writing()
-        for ec in self.ec_cache.values():
-            ec.close()
-        self.ec_cache = {}
+        if self.ec_cache is not None:
+            hits, misses, evictions, _ = self.ec_cache.stats()
+            debug1('encrypted: container cache: %d hits, %d misses,'
+                   ' %d evictions\n' % (hits, misses, evictions))
+            self.ec_cache.close()
+            self.ec_cache = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
         if self.storage is not None:
             self.storage.close()
             self.storage = None
@@ -616,19 +1140,167 @@ class EncryptedRepo(ConfigRepo):
         wfile.write(0, None, json.dumps(data).encode('utf-8'))
         wfile.finish()
         # now invalidate our read cache
-        if filename in self.ec_cache:
-            self.ec_cache[filename].close()
-            del self.ec_cache[filename]
+        self.ec_cache.discard(filename)
+
+    def _read_journal_entry(self, name):
+        # entries never change, so each is only read once
+        entry = self._journal_cache.get(name)
+        if entry is None:
+            reader, entry = self._json_read(name)
+            if reader is None:
+                return None # compacted meanwhile
+            reader.close()
+            self._journal_cache[name] = entry
+        return entry
+
+    def _journal_name(self, seq):
+        return b'%s.log.%016x' % (self.refsname, seq)
+
+    def _read_refs(self):
+        """Return (reader, refs, seq, journal) where refs are those of
+        the snapshot (opened with reader, if it exists) updated by the
+        journal entries it doesn't include yet, seq is the number of
+        the next journal entry, and journal the list of the existing
+        entries (including those already folded into the snapshot)."""
+        for attempt in range(REFS_READ_ATTEMPTS):
+            reader, data = self._json_read(self.refsname)
+            try:
+                result = self._replay_journal(data)
+                # A compaction (i.e. snapshot replacement) since we
+                # read the snapshot may have removed entries before we
+                # listed them; then we have to start over.
+                check, check_data = self._json_read(self.refsname)
+                if check:
+                    check.close()
+                if result is not None and check_data == data:
+                    return (reader,) + result
+            except BaseException as ex:
+                with pending_raise(ex):
+                    if reader:
+                        reader.close()
+            if reader:
+                reader.close()
+        raise FileModified(self.refsname)
+
+    def _replay_journal(self, data):
+        """Return (refs, seq, journal) for the snapshot data, or None
+        if a journal entry was removed while reading them."""
+        if 'refs' in data:
+            seq = data['next']
+            refs = self._decode_refs(data['refs'])
+        else:
+            # written before there was a journal
+            seq = 0
+            refs = self._decode_refs(data)
+        journal = sorted(self.storage.list(Kind.REFS,
+                                           self.refsname + b'.log.*'))
+        for name in journal:
+            entry_seq = int(name[len(self.refsname) + 5:], 16)
+            if entry_seq < seq:
+                continue # folded already
+            if entry_seq > seq:
+                # the entry before it was removed by a compaction
+                return None
+            entry = self._read_journal_entry(name)
+            if entry is None:
+                return None
+            refname = unhexlify(entry['ref'])
+            old = entry['old'] and entry['old'].encode('ascii')
+            # can't happen, entries are created exclusively
+            assert refs.get(refname) == old, \
+                'conflicting ref update %s' % name.decode('ascii')
+            if entry['new'] is None:
+                refs.pop(refname, None)
+            else:
+                refs[refname] = entry['new'].encode('ascii')
+            seq += 1
+        return refs, seq, journal
+
+    def _snapshot_next(self):
+        """Return the number of the first journal entry the current
+        snapshot doesn't include."""
+        reader, data = self._json_read(self.refsname)
+        if reader:
+            reader.close()
+        return data['next'] if 'refs' in data else 0
+
+    def _log_ref_change(self, refname, newval, oldval):
+        """Append the change to the refs journal, i.e. store it as a new
+        (small) file, and compact the journal if it's grown too long.
+        Entries are numbered, and each one is created exclusively, so
+        if another one was added concurrently, we check the refs again
+        and retry."""
+        self.finish_writing()
+        target = hexlify(newval) if newval else None
+        took_back = False
+        for attempt in range(REFS_WRITE_ATTEMPTS):
+            reader, refs, seq, journal = self._read_refs()
+            if reader:
+                reader.close()
+            current = refs.get(refname)
+            if took_back and current == target:
+                # our entry was folded in after all (or someone made
+                # the same change)
+                return
+            if oldval and current != hexlify(oldval):
+                raise FileModified(self.refsname)
+            if newval is None and current is None:
+                raise KeyError(refname)
+            name = self._journal_name(seq)
+            entry = {
+                'ref': hexlify(refname).decode('ascii'),
+                'new': hexlify(newval).decode('ascii') if newval else None,
+                'old': current.decode('ascii') if current else None,
+            }
+            try:
+                wfile = EncryptedContainer(self, self.storage, name, 'w',
+                                           Kind.REFS, self.compression,
+                                           key=self.repokey,
+                                           compressor=self.compressor)
+                wfile.write(0, None, json.dumps(entry).encode('utf-8'))
+                wfile.finish()
+            except FileAlreadyExists:
+                debug1('encrypted: ref update %s raced, retrying\n'
+                       % name.decode('ascii'))
+                continue
+            # If someone else took this number, and a compaction
+            # removed their entry since we read the refs, ours would
+            # be ignored as folded already, so take it back and retry.
+            if self._snapshot_next() <= seq:
+                break
+            debug1('encrypted: ref update %s was compacted away, retrying\n'
+                   % name.decode('ascii'))
+            self.storage.delete(Kind.REFS, [name])
+            took_back = True
+        else:
+            raise FileModified(self.refsname)
+        self._journal_cache[name] = entry
+        if len(journal) >= REFS_JOURNAL_MAX:
+            self._compact_refs()
+
+    def _compact_refs(self):
+        """Fold the journal into the snapshot, and then remove the
+        folded entries.  The snapshot has the number of the next
+        entry, so they're ignored until they're removed."""
+        reader, refs, seq, journal = self._read_refs()
+        data = {
+            'refs': self._encode_refs(refs),
+            'next': seq,
+        }
+        try:
+            self._json_write(self.refsname, reader, data)
+        except (FileAlreadyExists, FileModified):
+            # someone else compacted it just now
+            return
+        finally:
+            if reader:
+                reader.close()
+        self.storage.delete(Kind.REFS, journal)
+        for name in journal:
+            self._journal_cache.pop(name, None)
 
     def update_ref(self, refname, newval, oldval):
-        self.finish_writing()
-        reader, refs_data = self._json_read(self.refsname)
-        refs = self._decode_refs(refs_data)
-        if oldval:
-            assert refs[refname] == hexlify(oldval)
-        refs[refname] = hexlify(newval)
-        refs = self._encode_refs(refs)
-        self._json_write(self.refsname, reader, refs)
+        self._log_ref_change(refname, newval, oldval)
 
     def _load_config(self):
         assert not self._in_config_read
@@ -643,6 +1315,7 @@ class EncryptedRepo(ConfigRepo):
         with open(self.cfgfile, 'wb') as f:
             f.write(data)
 
+        self._config_cache = {}
         self._config_loaded = True
         self._in_config_read = False
 
@@ -655,7 +1328,14 @@ class EncryptedRepo(ConfigRepo):
             reader = self._load_config()
             if reader:
                 reader.close()
-        return git.git_config_get(name, cfg_file=self.cfgfile, opttype=opttype)
+        # containers look up the blob size, avoid running git for each
+        try:
+            return self._config_cache[(name, opttype)]
+        except KeyError:
+            pass
+        value = git.git_config_get(name, cfg_file=self.cfgfile, opttype=opttype)
+        self._config_cache[(name, opttype)] = value
+        return value
 
     def config_list(self, values=False):
         if not self._config_loaded:
@@ -694,6 +1374,7 @@ class EncryptedRepo(ConfigRepo):
         reader = self._load_config()
         try:
             git.git_config_write(key, value, cfg_file=self.cfgfile)
+            self._config_cache = {}
             wfile = EncryptedContainer(self, self.storage, b'config', 'w',
                                        Kind.CONFIG, self.compression,
                                        key=self.repokey,
@@ -703,51 +1384,35 @@ class EncryptedRepo(ConfigRepo):
                 wfile.write(0, None, f.read())
             wfile.finish()
             # now invalidate our read cache
-            if b'config' in self.ec_cache:
-                self.ec_cache[b'config'].close()
-                del self.ec_cache[b'config']
+            self.ec_cache.discard(b'config')
         finally:
             if reader:
                 reader.close()
 
     def delete_ref(self, refname, oldval=None):
-        self.finish_writing()
-        reader, refs = self._json_read(self.refsname)
-        if oldval:
-            assert refs[refname] == hexlify(oldval)
-        del refs[refname]
-        refs = self._encode_refs(refs)
-        reffile = EncryptedContainer(self, self.storage, self.refsname, 'w',
-                                     Kind.REFS, self.compression,
-                                     key=self.repokey,
-                                     overwrite=reader,
-                                     compressor=self.compressor)
-        reffile.write(0, None, json.dumps(refs).encode('utf-8'))
-        reffile.finish()
-        # now invalidate our read cache
-        if self.refsname in self.ec_cache:
-            self.ec_cache[self.refsname].close()
-            del self.ec_cache[self.refsname]
+        self._log_ref_change(refname, None, oldval)
 
-    def _open_read(self, name, kind, cache=False):
-        try:
-            return self.ec_cache[name]
-        except KeyError:
-            if kind in (Kind.IDX, Kind.CONFIG, Kind.REFS):
-                key = self.repokey
-            elif kind in (Kind.DATA, Kind.METADATA):
-                key = self.readkey
-            else:
-                assert False
-            result = EncryptedContainer(self, self.storage, name,
-                                        'r', kind, key=key)
-            if cache:
-                if len(self.ec_cache) > 200:
-                    for c in self.ec_cache.values():
-                        c.close()
-                    self.ec_cache = {}
-                self.ec_cache[name] = result
-            return result
+    def _open_read(self, name, kind):
+        if kind in (Kind.IDX, Kind.CONFIG, Kind.REFS):
+            key = self.repokey
+        elif kind in (Kind.DATA, Kind.METADATA):
+            key = self.readkey
+        else:
+            assert False
+        return EncryptedContainer(self, self.storage, name, 'r', kind, key=key)
+
+    def _use_pack(self, name, objtypes=()):
+        # Trees and commits are only stored in metadata packs (when
+        # they're separate), so read the pack via the metadata pack
+        # cache if it has one of those objtypes or is already cached.
+        if self.meta_cache is not None \
+           and (any(t in (1, 2) for t in objtypes) or self.meta_cache.has(name)):
+            return self.ec_cache.use(name, lambda: EncryptedContainer(
+                self, self.meta_cache, name, 'r', Kind.METADATA,
+                key=self.readkey))
+        # Kind.DATA / Kind.METADATA are equivalent here
+        return self.ec_cache.use(name,
+                                 lambda: self._open_read(name, Kind.DATA))
 
     def _json_read(self, filename):
         try:
@@ -765,8 +1430,7 @@ class EncryptedRepo(ConfigRepo):
             return None, {}
 
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
-        reader, refs_data = self._json_read(self.refsname)
-        refs = self._decode_refs(refs_data)
+        reader, refs, seq, journal = self._read_refs()
         if reader:
             reader.close()
         # git pattern matching (in show-ref) matches only full components
@@ -818,16 +1482,32 @@ class EncryptedRepo(ConfigRepo):
             assert len(ref_or_refs) == 1
             ref = ref_or_refs[0]
         while True:
-            commit = git.parse_commit(self.get_data(ref, b'commit'))
+            tree, author_sec, parents = self._commit_info(ref)
             if format is None:
                 yield ref
             else:
                 if format == b'%T %at':
-                    data = BytesIO(b'%s %d\n' % (commit.tree, commit.author_sec))
+                    data = BytesIO(b'%s %d\n' % (hexlify(tree), author_sec))
                 yield (ref, parse(data))
-            if not commit.parents:
+            if not parents:
                 break
-            ref = commit.parents[0]
+            ref = hexlify(parents[0])
+
+    def _commit_info(self, ref):
+        """Return (tree, author_sec, parents) for the commit ref, from
+        the commit graph when possible."""
+        oid = None
+        if len(ref) == 40 and all(x in b'0123456789abcdefABCDEF' for x in ref):
+            oid = unhexlify(ref)
+            info = self.commit_graph.get(oid) if self.commit_graph else None
+            if info:
+                return info
+        commit = git.parse_commit(self.get_data(ref, b'commit'))
+        info = (unhexlify(commit.tree), commit.author_sec,
+                tuple(unhexlify(p) for p in commit.parents))
+        if oid and self.commit_graph:
+            self.commit_graph.add(oid, *info)
+        return info
 
     def is_remote(self):
         # return False so we don't have to implement resolve()
@@ -864,10 +1544,9 @@ class EncryptedRepo(ConfigRepo):
             return_data = include_data
         if need_data:
             assert where.startswith(b'pack-') and where.endswith(b'.idx')
-            where = where.replace(b'.idx', b'.encpack')
-            # Kind.DATA / Kind.METADATA are equivalent here
-            ec = self._open_read(where, Kind.DATA, cache=True)
-            enc_type, data = ec.read(offs)
+            with self._use_pack(where.replace(b'.idx', b'.encpack'),
+                                (res.crc,)) as ec:
+                enc_type, data = ec.read(offs)
             assert enc_type == res.crc, f"corrupt idx/pack for {oidx}"
             sz = len(data)
         else:
@@ -883,6 +1562,56 @@ class EncryptedRepo(ConfigRepo):
                 sz if include_size else None,
                 data_iter)
 
+    def get_many(self, refs, *, include_data=True):
+        if not include_data:
+            yield from super().get_many(refs, include_data=include_data)
+            return
+        self._synchronize_idxes()
+        refs = iter(refs)
+        while True:
+            batch = list(islice(refs, GET_MANY_BATCH))
+            if not batch:
+                break
+            yield from self._get_batch(batch)
+
+    def _get_batch(self, refs):
+        found = []
+        packs = {}
+        objtypes = {}
+        for ref in refs:
+            if len(ref) == 40 and all(x in b'0123456789abcdefABCDEF' for x in ref):
+                oid = unhexlify(ref)
+            else:
+                oid = self.read_ref(ref)
+            res = None
+            if oid is not None:
+                res = self.idxlist.exists(oid, want_source=True,
+                                          want_offset=True, want_crc=True)
+            found.append((oid, res))
+            if res is not None:
+                packs.setdefault(res.pack, []).append(res.offset)
+                objtypes.setdefault(res.pack, set()).add(res.crc)
+        # fetch everything first, so the pool can decrypt the objects
+        # of all the packs while we're yielding them
+        pending = []
+        for where, offsets in packs.items():
+            assert where.startswith(b'pack-') and where.endswith(b'.idx')
+            with self._use_pack(where.replace(b'.idx', b'.encpack'),
+                                objtypes[where]) as ec:
+                pending.append((where, offsets,
+                                ec.read_many(offsets, self._get_pool())))
+        objects = {}
+        for where, offsets, results in pending:
+            objects[where] = dict(zip(offsets, results))
+        for oid, res in found:
+            if res is None:
+                yield None, None, None, None
+                continue
+            enc_type, data = objects[res.pack][res.offset]
+            oidx = hexlify(oid)
+            assert enc_type == res.crc, f"corrupt idx/pack for {oidx}"
+            yield oidx, git._typermap[res.crc], len(data), data
+
     def join(self, ref):
         return vfs.join(self, ref)
 
@@ -891,7 +1620,6 @@ class EncryptedRepo(ConfigRepo):
         if not self.exists(sha):
             self._ensure_data_writer()
             self.data_writer.write(objtype, sha, content)
-            self.data_written_objs.add(sha)
         return sha
 
     def _meta_write(self, objtype, content):
@@ -899,7 +1627,6 @@ class EncryptedRepo(ConfigRepo):
         if not self.exists(sha):
             self._ensure_meta_writer()
             self.meta_writer.write(objtype, sha, content)
-            self.meta_written_objs.add(sha)
         return sha
 
     def write_commit(self, tree, parent,
@@ -910,7 +1637,13 @@ class EncryptedRepo(ConfigRepo):
                                          author, adate_sec, adate_tz,
                                          committer, cdate_sec, cdate_tz,
                                          msg)
-        return self._meta_write(1, content)
+        oid = self._meta_write(1, content)
+        if self.commit_graph:
+            commit = git.parse_commit(content)
+            self.commit_graph.add(oid, unhexlify(commit.tree),
+                                  commit.author_sec,
+                                  [unhexlify(p) for p in commit.parents])
+        return oid
 
     def write_tree(self, shalist):
         content = git.tree_encode(shalist)
@@ -930,16 +1663,56 @@ class EncryptedRepo(ConfigRepo):
             return self._meta_write(git._typemap[type], content)
         return self._data_write(git._typemap[type], content)
 
+    def rewrite(self, oid, type, content, metadata=False):
+        """Write the object to a new pack even if it's in one of the
+        existing packs (that gc is going to remove)."""
+        for writer in (self.data_writer, self.meta_writer):
+            if writer is not None and writer.exists(oid):
+                return
+        if metadata:
+            self._ensure_meta_writer()
+            writer = self.meta_writer
+        else:
+            self._ensure_data_writer()
+            writer = self.data_writer
+        writer.write(git._typemap[type], oid, content)
+
+    def remove_packs(self, idxnames):
+        """Remove the packs with the given (local) idx names, e.g.
+        pack-HASH.idx, from the storage and the cache.  The idx files
+        are removed first, so the objects can't be found in a pack
+        that's gone, and the storage can delete them in batches."""
+        assert self.data_writer is None and self.meta_writer is None
+        idxnames = list(idxnames)
+        for name in idxnames:
+            assert name.startswith(b'pack-') and name.endswith(b'.idx')
+            self.ec_cache.discard(name.replace(b'.idx', b'.encpack'))
+        self.storage.delete(Kind.IDX, [name.replace(b'.idx', b'.encidx')
+                                       for name in idxnames])
+        self.storage.delete(Kind.DATA, [name.replace(b'.idx', b'.encpack')
+                                        for name in idxnames])
+        if self.meta_cache is not None:
+            self.meta_cache.remove(name.replace(b'.idx', b'.encpack')
+                                   for name in idxnames)
+        if self.idxlist is not None:
+            self.idxlist.close()
+            self.idxlist = None
+        midx.clear_midxes(self.cachedir)
+        bloom.clear_bloom(self.cachedir)
+        for name in idxnames:
+            os.unlink(os.path.join(self.cachedir, name))
+        git.auto_midx(self.cachedir)
+
     def exists(self, oid, want_source=False):
         self._synchronize_idxes()
 
-        if oid in self.data_written_objs:
-            return True
-        if self.separatemeta and oid in self.meta_written_objs:
-            return True
+        # the writers know about the objects in the open packs
+        for writer in (self.data_writer, self.meta_writer):
+            if writer is not None and writer.exists(oid):
+                return True
         return self.idxlist.exists(oid, want_source=want_source)
 
-    def _finish(self, writer, fakesha, meta=False):
+    def _finish(self, writer, fakesha):
         hexsha = hexlify(fakesha)
         idxname = os.path.join(self.cachedir, b'pack-%s.idx' % hexsha)
         writer.finish()
@@ -958,21 +1731,14 @@ class EncryptedRepo(ConfigRepo):
         git.auto_midx(self.cachedir)
         self.idxlist.refresh()
 
-        # and clear all the object lists in memory,
-        # they're now in the (new) idxlist
-        if meta:
-            for obj in self.meta_written_objs:
-                assert self.idxlist.exists(obj), "Object from mem cache lost!"
-            self.meta_written_objs.clear()
-        else:
-            for obj in self.data_written_objs:
-                assert self.idxlist.exists(obj), "Object from mem cache lost!"
-            self.data_written_objs.clear()
+        # the objects the writer knew about are now in the (new) idxlist
+        for obj in writer.idxwriter:
+            assert self.idxlist.exists(obj), "Object from idx writer lost!"
 
     def finish_writing(self, run_midx=True):
         have_written = False
         if self.meta_writer != self.data_writer and self.meta_writer is not None:
-            self._finish(self.meta_writer, self.meta_fakesha, meta=True)
+            self._finish(self.meta_writer, self.meta_fakesha)
             self.meta_writer = None
             have_written = True
         if self.data_writer is not None:
@@ -4,7 +4,7 @@ from os.path import realpath
 from functools import partial
 from binascii import hexlify
 
-from bup import git
+from bup import bloom, git
 from bup.repo.base import BaseRepo
 
 
@@ -14,6 +14,7 @@ class LocalRepo(BaseRepo):
                  server=False):
         self.closed = True # until super().__init__()
         self._packwriter = None
+        self._own_cp = None
         self.repo_dir = realpath(repo_dir or git.guess_repo())
         git.check_repo_or_die(repo_dir)
         self.config_write = partial(git.git_config_write, repo_dir=self.repo_dir)
@@ -32,6 +33,22 @@ class LocalRepo(BaseRepo):
             self.objcache_maker = None
             self.run_midx = True
 
+    def open_reader(self):
+        """Return another LocalRepo for the same repository, with its
+        own cat-file process, so that it can be read from another
+        thread while this one is in use."""
+        repo = LocalRepo(self.repo_dir)
+        repo._cp = repo._own_cp = git.CatPipe(self.repo_dir)
+        return repo
+
+    def close(self):
+        try:
+            super(LocalRepo, self).close()
+        finally:
+            if self._own_cp:
+                self._own_cp.close(wait=True)
+                self._own_cp = None
+
     @classmethod
     def create(self, repo_dir=None):
         # FIXME: this is not ideal, we should somehow
@@ -110,6 +127,23 @@ class LocalRepo(BaseRepo):
             send_size(len(idx.map))
             conn.write(idx.map)
 
+    def open_bloom(self):
+        name = git.repo(b'objects/pack/bup.bloom', repo_dir=self.repo_dir)
+        if not os.path.exists(name):
+            return None
+        b = bloom.ShaBloom(name)
+        if not b.valid():
+            b.close()
+            return None
+        return b
+
+    def index_oids(self, name):
+        with git.open_idx(git.repo(b'objects/pack/%s' % name,
+                                   repo_dir=self.repo_dir)) as idx:
+            if isinstance(idx, git.PackIdxV2):
+                return bytes(idx.shatable)
+            return b''.join(idx)
+
     def rev_list_raw(self, refs, fmt):
         """
         Yield chunks of data of the raw rev-list in git format.
@@ -1,6 +1,19 @@
 
+
+from binascii import hexlify, unhexlify
+import binascii, hashlib, os, sqlite3
+
 from bup.repo.base import BaseRepo
-from bup import client
+from bup import client, git, path, vfs
+from bup.helpers import debug1, mkdirp
+from bup.remotecache import RemoteCache
+
+
+# The default size of the client-side cache (see bup.client.cache-size)
+default_cache_size = 256 << 20
+
+# How many .bupm oids to remember (see RemoteRepo._note_meta())
+max_meta_oids = 10000
 
 
 class RemoteRepo(BaseRepo):
@@ -23,21 +36,124 @@ class RemoteRepo(BaseRepo):
         self.send_index = self.client.send_index
         self.join = self.client.join
         self.refs = self.client.refs
-        self.resolve = self.client.resolve
         self._bwlimit = bwlimit
         self._packwriter = None
+        self._cache = None
+        self._meta_oids = {}
+        self._refs_digest = None
+        # It limits the space used here, so it's our setting
+        cache_size = git.git_config_get(b'bup.client.cache-size',
+                                        repo_dir=path.defaultrepo(),
+                                        opttype='int')
+        if cache_size is None:
+            cache_size = default_cache_size
+        if cache_size > 0:
+            mkdirp(self.client.cachedir)
+            try:
+                self._cache = RemoteCache(os.path.join(self.client.cachedir,
+                                                       b'remote-cache.sqlite'),
+                                          cache_size)
+            except sqlite3.OperationalError as ex:
+                # e.g. locked by another client for too long
+                debug1('remote: not using the cache (%s)\n' % ex)
 
     def close(self):
-        super(RemoteRepo, self).close()
-        if self.client:
-            self.client.close()
-            self.client = None
+        try:
+            super(RemoteRepo, self).close()
+        finally:
+            try:
+                if self._cache:
+                    self._cache.close()
+                    self._cache = None
+            finally:
+                if self.client:
+                    self.client.close()
+                    self.client = None
+
+    def _current_refs(self):
+        """Return a digest of the remote refs, which identifies the
+        cached resolutions that depend on them.  It's only fetched
+        once per connection, and again after we change a ref or
+        check_refs() is called."""
+        if self._refs_digest:
+            return self._refs_digest
+        digest = hashlib.sha1()
+        for name, oid in sorted(self.client.refs()):
+            digest.update(b'%s %s\n' % (hexlify(oid), name))
+        digest = hexlify(digest.digest())
+        self._cache.set_refs(digest)
+        self._refs_digest = digest
+        return digest
+
+    def check_refs(self):
+        """Make resolutions that depend on the refs ask for them
+        again, e.g. because someone else may have changed them."""
+        self._refs_digest = None
+
+    def resolve(self, path, parent=None, want_meta=True, follow=True):
+        cache = self._cache
+        if not cache:
+            return self.client.resolve(path, parent=parent,
+                                       want_meta=want_meta, follow=follow)
+        refs = None
+        if not any(isinstance(item, vfs.Commit) for _, item in parent or ()):
+            refs = self._current_refs()
+        res = cache.get_resolution(path, parent, want_meta, follow, refs)
+        if res is None:
+            res = self.client.resolve(path, parent=parent,
+                                      want_meta=want_meta, follow=follow)
+            cache.add_resolution(path, parent, want_meta, follow, refs, res)
+        return res
+
+    def resolve_many(self, paths, want_meta=True, follow=True):
+        # Send the resolutions that aren't cached all at once
+        if len(paths) < 2 or self.client._busy \
+           or b'multiplex' not in self.client._available_commands:
+            return super().resolve_many(paths, want_meta=want_meta,
+                                        follow=follow)
+        cache = self._cache
+        refs = self._current_refs() if cache else None
+        result = [None] * len(paths)
+        with client.MultiplexingClient(self.client) as mc:
+            pending = []
+            for i, path in enumerate(paths):
+                res = cache.get_resolution(path, None, want_meta, follow,
+                                           refs) if cache else None
+                if res is not None:
+                    result[i] = res
+                else:
+                    pending.append((i, mc.submit('resolve', path,
+                                                 want_meta=want_meta,
+                                                 follow=follow)))
+            for i, future in pending:
+                try:
+                    result[i] = res = future.result()
+                except vfs.IOError as ex:
+                    result[i] = ex
+                    continue
+                if cache:
+                    cache.add_resolution(paths[i], None, want_meta, follow,
+                                         refs, res)
+        return result
+
+    def _note_meta(self, typ, data):
+        # Remember the .bupm of the (most recent) trees we see, so we
+        # can cache it when it's read, typically right afterward.
+        if typ == b'tree':
+            i = data.find(b' .bupm\0')
+            if i >= 0:
+                meta_oids = self._meta_oids
+                meta_oids[data[i + 7:i + 27]] = None
+                if len(meta_oids) > max_meta_oids:
+                    del meta_oids[next(iter(meta_oids))]
 
     def update_ref(self, refname, newval, oldval):
         self.finish_writing()
+        self._refs_digest = None
         return self.client.update_ref(refname, newval, oldval)
 
     def delete_ref(self, refname, oldval=None):
+        self._refs_digest = None
         self.client.delete_ref(refname, oldval)
 
     def _ensure_packwriter(self):
@@ -46,7 +162,8 @@ class RemoteRepo(BaseRepo):
                                     compression_level=self.compression_level,
                                     max_pack_size=self.max_pack_size,
                                     max_pack_objects=self.max_pack_objects,
-                                    bwlimit=self._bwlimit)
+                                    bwlimit=self._bwlimit,
+                                    ask_missing=True)
 
     def is_remote(self):
         return True
@@ -57,14 +174,57 @@ class RemoteRepo(BaseRepo):
         # data has been read.  Otherwise we'd be out of sync with the
         # server.
         assert include_data is True # not supported on server yet
+        cache = self._cache
+        if cache and len(ref) == 40:
+            try:
+                hit = cache.get_object(unhexlify(ref))
+            except binascii.Error: # not an oidx
+                hit = None
+            if hit:
+                typ, data = hit
+                self._meta_oids.pop(unhexlify(ref), None)
+                self._note_meta(typ, data)
+                return (ref, typ,
+                        len(data) if include_size else None,
+                        iter((data,)))
         it = self.client.cat(ref)
         oidx, typ, sz = next(it)
         if include_data and not oidx:
             for _ in it: assert False
+        elif cache and (typ in (b'tree', b'commit')
+                        or unhexlify(oidx) in self._meta_oids):
+            # Objects never change, so they can be cached by oid
+            oid = unhexlify(oidx)
+            data = b''.join(it)
+            cache.add_object(oid, typ, data)
+            self._meta_oids.pop(oid, None)
+            self._note_meta(typ, data)
+            it = iter((data,))
         return (oidx, typ,
                 sz if include_size else None,
                 it if (include_data and oidx) else None)
 
+    def get_many(self, refs, *, include_data=True):
+        if b'cat-stream' not in self.client._available_commands:
+            return super().get_many(refs, include_data=include_data)
+        return self.client.cat_stream(refs, include_data=include_data)
+
+    def diff(self, ref1, ref2, recursive=False):
+        if b'diff' not in self.client._available_commands:
+            return super().diff(ref1, ref2, recursive)
+        return self.client.diff(ref1, ref2, recursive)
+
+    def can_walk_objects(self):
+        return b'walk-objects' in self.client._available_commands
+
+    def walk_objects(self, oids, have=None):
+        return self.client.walk_objects(oids, have=have)
+
+    def open_bloom(self):
+        if b'send-bloom' not in self.client._available_commands:
+            return None
+        return self.client.sync_bloom()
+
     def write_commit(self, tree, parent,
                      author, adate_sec, adate_tz,
                      committer, cdate_sec, cdate_tz,
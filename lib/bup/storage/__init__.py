@@ -58,7 +58,7 @@ class BupStorage:
         """
         Return a reader object, i.e. an object that should have (at least)
         .read(sz=None, szhint=None), .seek(absolute_offset) and .close()
-        methods.
+        methods, and a .size attribute with the size of the file.
         For Kind.CONFIG and Kind.REFS, the resulting object can be passed to the
         overwrite parameter of get_writer() to atomically replace the file.
         Raise FileNotFound(name) (with an optional message) if the file
@@ -74,6 +74,13 @@ class BupStorage:
         # but have an empty 'yield' so the function is an iterator
         yield
 
+    def delete(self, kind, names):
+        """
+        Delete the named files of the given kind, with as few requests
+        as the backend allows.  Files that don't exist are ignored.
+        """
+        raise Exception("Deleting files isn't supported by this storage.")
+
     def close(self):
         """
         Close the storage (e.g. connection).
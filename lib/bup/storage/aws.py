@@ -5,13 +5,17 @@ Uses S3 compatible object storage for data, metadata and idx files
 """
 import os
 import sys
+import fcntl
 import fnmatch
 import datetime
+import struct
 import threading
 import queue
+from contextlib import contextmanager
 
-from bup.storage import BupStorage, FileNotFound, Kind
-# FIXME FileAlreadyExists
+from bup.helpers import debug1
+from bup.storage import \
+    BupStorage, FileAlreadyExists, FileModified, FileNotFound, Kind
 
 try:
     import boto3
@@ -138,52 +142,121 @@ class S3Reader:
     def seek(self, offs):
         self.offs = offs
 
+# Write the bitmap of an object's cached blocks after this many new ones
+CACHE_PERSIST_BLOCKS = 256
+
+
+class BlockCache:
+    """The blocks downloaded from S3, shared by all the S3CacheReaders
+    of a storage, and by all the processes using the same cachedir.
+    For each object, the blocks are stored in a sparse "<name>.data"
+    file, and which of them are present in a "<name>.blks" file (its
+    size and the block size, followed by a bitmap of the blocks).
+    Changes to the latter, and evictions, are made while holding the
+    lock on the "cache.lock" file.  When the .data files exceed
+    max_size, the least recently used objects are removed."""
+    def __init__(self, cachedir, blksize, max_size):
+        self.cachedir = cachedir
+        self.blksize = blksize
+        self.max_size = max_size
+        self._lockfile = os.path.join(cachedir, 'cache.lock')
+        self._lock = threading.Lock()
+        self._size = None
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            fd = os.open(self._lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def added(self, size, keep):
+        """Account for size bytes downloaded into the object keep,
+        and evict others if that exceeds the limit."""
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size:
+                    return
+        self.evict(keep)
+
+    def evict(self, keep=None):
+        """Remove the least recently used objects (other than keep)
+        until we're within 90% of the limit, if we exceed it."""
+        with self.locked():
+            # left by older versions
+            for fn in fnmatch.filter(os.listdir(self.cachedir), '*.rngs'):
+                self.remove(fn[:-5])
+            entries = []
+            total = 0
+            for fn in fnmatch.filter(os.listdir(self.cachedir), '*.blks'):
+                name = fn[:-5]
+                try:
+                    mtime = os.stat(os.path.join(self.cachedir, fn)).st_mtime
+                    st = os.stat(os.path.join(self.cachedir, name + '.data'))
+                except FileNotFoundError:
+                    continue
+                # what's actually stored, the files are sparse
+                size = st.st_blocks * 512
+                entries.append((mtime, size, name))
+                total += size
+            if total > self.max_size:
+                target = self.max_size * 9 // 10
+                evicted = 0
+                for mtime, size, name in sorted(entries):
+                    if total <= target:
+                        break
+                    if name == keep:
+                        continue
+                    self.remove(name)
+                    total -= size
+                    evicted += 1
+                debug1('aws: evicted %d objects from the cache\n' % evicted)
+            self._size = total
+
+    def remove(self, name):
+        for suffix in ('.blks', '.data', '.rngs'):
+            try:
+                os.unlink(os.path.join(self.cachedir, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
 class S3CacheReader:
-    # TODO: this class is not concurrency safe
-    # TODO: this class sort of relies on sparse files (at least for efficiency)
-    def __init__(self, storage, name, cachedir, blksize, kind):
+    """Read an object via the BlockCache, downloading (block aligned)
+    what isn't cached yet.  An object's bitmap is only written every
+    CACHE_PERSIST_BLOCKS new blocks and on close(), and re-read when
+    another process changed it.  If the object was evicted meanwhile,
+    we start over with an empty one."""
+    _header = struct.Struct('<QQ')
+
+    def __init__(self, storage, name, cache, kind):
         self._reader = None
         self.storage = storage
         self.name = name
-        self.fn_rngs = os.path.join(cachedir, self.name + '.rngs')
-        self.fn_data = os.path.join(cachedir, self.name + '.data')
+        self.kind = kind
+        self.cache = cache
+        self.blksize = cache.blksize
+        self.fn_blks = os.path.join(cache.cachedir, name + '.blks')
+        self.fn_data = os.path.join(cache.cachedir, name + '.data')
         self.offs = 0
-        self.blksize = blksize
-        self.f_data = None
         self.size = None
-        self.kind = kind
-
-        if not os.path.exists(self.fn_rngs):
-            # unlink data if present, we don't know how valid it is
-            # without having the validity ranges
-            if os.path.exists(self.fn_data):
-                os.unlink(self.fn_data)
-            self.ranges = []
-        else:
-            f_rngs = open(self.fn_rngs, 'r+b')
-            ranges = []
-            for line in f_rngs.readlines():
-                line = line.strip()
-                if line.startswith(b'#size='):
-                    self.size = int(line[6:])
-                    continue
-                if not line or line.startswith(b'#'):
-                    continue
-                start, end = line.split(b'-')
-                start = int(start.strip())
-                end = int(end.strip())
-                ranges.append((start, end))
-            self.ranges = ranges
-            # some things we do rely on ordering
-            self.ranges.sort()
-            if self.ranges:
-                self.f_data = open(self.fn_data, 'r+b')
-
-            f_rngs.close()
-        if not self.size:
-            self.size = self.reader.size
-            # if we didn't have the size cached write it out now
-            self._write_ranges()
+        self.f_data = None
+        self._bitmap = None
+        self._blks_mtime = None
+        self._dirty = 0
+        self._lock = threading.Lock()
+        with cache.locked():
+            self._load()
+        if self._bitmap is None:
+            size = self.reader.size
+            with cache.locked():
+                self._load()
+                if self._bitmap is None:
+                    self._create(size)
 
     @property
     def reader(self):
@@ -191,113 +264,157 @@ class S3CacheReader:
             self._reader = S3Reader(self.storage, self.name, self.kind)
         return self._reader
 
-    def _compress_ranges(self):
-        ranges = []
-        if not self.ranges:
+    def _read_blks(self):
+        """Return (mtime, bitmap) from the .blks file, or None if it
+        doesn't exist or is invalid (e.g. from another block size)."""
+        try:
+            with open(self.fn_blks, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < self._header.size:
+            return None
+        size, blksize = self._header.unpack_from(data)
+        nblocks = (size + blksize - 1) // blksize
+        if blksize != self.blksize or len(data) != self._header.size + (nblocks + 7) // 8:
+            return None
+        if self.size is not None and size != self.size:
+            return None
+        return mtime, size, bytearray(data[self._header.size:])
+
+    def _load(self):
+        # called with the cache locked
+        if os.path.exists(self.fn_blks[:-5] + '.rngs'):
+            # written by an older version
+            self.cache.remove(self.name)
+        blks = self._read_blks()
+        if blks is None:
             return
-        self.ranges.sort()
-        new_start, new_end = None, None
-        for start, end in self.ranges:
-            if new_start is None:
-                new_start, new_end = start, end
-                continue
-            if new_end + 1 == start:
-                new_end = end
-                continue
-            ranges.append((new_start, new_end))
-            new_start, new_end = start, end
-        if new_start is not None:
-            ranges.append((new_start, new_end))
-        self.ranges = ranges
-
-    def _write_data(self, offset, data):
-        assert len(data) > 0
-
-        if self.f_data is None:
-            self.f_data = open(self.fn_data, 'w+b')
-        self.f_data.seek(offset)
-        self.f_data.write(data)
-
-        # update ranges file
-        sz = len(data)
-        self.ranges.append((offset, offset + sz - 1))
-        self._write_ranges()
+        try:
+            self.f_data = open(self.fn_data, 'r+b')
+        except FileNotFoundError:
+            return
+        self._blks_mtime, self.size, self._bitmap = blks
+        # for the eviction
+        os.utime(self.fn_blks)
 
-    def _write_ranges(self):
-        self._compress_ranges()
-        f_rngs = open(self.fn_rngs, 'w+b')
-        f_rngs.write(b'#size=%d\n' % self.size)
-        f_rngs.write(b'\n'.join((b'%d - %d' % i for i in self.ranges)))
-        f_rngs.write(b'\n')
-        f_rngs.close()
+    def _create(self, size):
+        # called with the cache locked
+        if self.f_data is not None:
+            self.f_data.close()
+        self.size = size
+        self.f_data = open(self.fn_data, 'w+b')
+        nblocks = (size + self.blksize - 1) // self.blksize
+        self._bitmap = bytearray((nblocks + 7) // 8)
+        self._dirty = 0
+        self._write_blks()
+
+    def _write_blks(self):
+        with open(self.fn_blks, 'wb') as f:
+            f.write(self._header.pack(self.size, self.blksize))
+            f.write(self._bitmap)
+        self._blks_mtime = os.stat(self.fn_blks).st_mtime_ns
+
+    def _evicted(self):
+        try:
+            st = os.stat(self.fn_data)
+        except FileNotFoundError:
+            return True
+        return st.st_ino != os.fstat(self.f_data.fileno()).st_ino
+
+    def _sync(self, persist):
+        """Merge what other processes cached (if they changed the
+        bitmap), and write ours if persist."""
+        with self.cache.locked():
+            if self._evicted():
+                # what we downloaded is gone with it
+                self.f_data.close()
+                self.f_data = None
+                self._bitmap = None
+                self._dirty = 0
+                self._load()
+                if self._bitmap is None:
+                    self._create(self.size)
+                return
+            blks = self._read_blks()
+            if blks is not None and (persist or blks[0] != self._blks_mtime):
+                for i, byte in enumerate(blks[2]):
+                    self._bitmap[i] |= byte
+                self._blks_mtime = blks[0]
+            if persist or blks is None:
+                self._write_blks()
+                self._dirty = 0
+
+    def _has(self, blk):
+        return self._bitmap[blk >> 3] & (1 << (blk & 7))
+
+    def _download(self, first, end):
+        """Download the blocks from first up to the one containing
+        end - 1, but stop before one that's cached already."""
+        blksize = self.blksize
+        last = min(end - 1, self.size - 1) // blksize
+        blk = first
+        while blk < last and not self._has(blk + 1):
+            blk += 1
+        offs = first * blksize
+        toread = min((blk + 1) * blksize, self.size) - offs
+        self.reader.seek(offs)
+        rdata = self.reader.read(toread)
+        assert len(rdata) == toread
+        os.pwrite(self.f_data.fileno(), rdata, offs)
+        for n in range(first, blk + 1):
+            self._bitmap[n >> 3] |= 1 << (n & 7)
+        self._dirty += blk + 1 - first
+        if self._dirty >= CACHE_PERSIST_BLOCKS:
+            self._sync(persist=True)
+        self.cache.added(toread, self.name)
 
     def read(self, sz=None, szhint=None):
-        data = []
-        beginoffs = self.offs
-        if szhint is None:
-            szhint = sz
-        if szhint > self.size - self.offs:
-            szhint = self.size - self.offs
         if sz is None:
             sz = self.size - self.offs
-        origsz = sz
-        while sz:
-            # find a range that overlaps the start of the needed data (if any)
-            gotcached = False
-            for start, end in self.ranges:
-                if start <= self.offs and self.offs <= end:
-                    self.f_data.seek(self.offs)
-                    rsz = sz
-                    avail = end - self.offs + 1
-                    if rsz > avail:
-                        rsz = avail
-                    rdata = self.f_data.read(rsz)
-                    assert len(rdata) == rsz
-                    data.append(rdata)
-                    sz -= rsz
-                    self.offs += rsz
-                    gotcached = True
-                    break
-            if gotcached:
-                continue
-
-            # read up to szhint from original offset
-            offs = self.offs
-            # round the offset down to a download block
-            blksize = self.blksize
-            offs = blksize * (offs // blksize)
-            # calculate how much was requested (including hint)
-            toread = szhint - (offs - beginoffs)
-            # and round that up to the next blksize too (subject to EOF limit)
-            toread = blksize * ((toread + blksize - 1) // blksize)
-            if offs + toread > self.size:
-                toread = self.size - offs
-            # and download what we calculated, unless we find overlap
-            for start, end in self.ranges:
-                if offs < start < offs + toread:
-                    toread = start - offs
-                    break
-            # grab it from the reader
-            self.reader.seek(offs)
-            rdata = self.reader.read(toread)
-            assert len(rdata) == toread
-            # and store it in the cache - next loop iteration will find it
-            # (this avoids having to worry about szhint specifically here)
-            self._write_data(offs, rdata)
-
-        ret = b''.join(data)
-        assert len(ret) == origsz
-        return ret
+        if szhint is None or szhint < sz:
+            szhint = sz
+        blksize = self.blksize
+        end = min(self.offs + sz, self.size)
+        hint_end = min(self.offs + szhint, self.size)
+        data = []
+        with self._lock:
+            while self.offs < end:
+                blk = self.offs // blksize
+                if not self._has(blk):
+                    # maybe another process has it meanwhile
+                    self._sync(persist=False)
+                if not self._has(blk):
+                    self._download(blk, hint_end)
+                    # we may have started over in _sync()
+                    if not self._has(blk):
+                        continue
+                # read all the cached blocks from here at once
+                last = blk
+                while (last + 1) * blksize < end and self._has(last + 1):
+                    last += 1
+                rsz = min(end, (last + 1) * blksize) - self.offs
+                rdata = os.pread(self.f_data.fileno(), rsz, self.offs)
+                assert len(rdata) == rsz
+                data.append(rdata)
+                self.offs += rsz
+        return b''.join(data)
 
     def seek(self, offs):
         assert offs <= self.size
         self.offs = offs
 
     def close(self):
-        if self.f_data is not None:
-            self.f_data.close()
-        if self._reader:
-            self._reader.close()
+        with self._lock:
+            if self.f_data is not None:
+                if self._dirty:
+                    self._sync(persist=True)
+                self.f_data.close()
+                self.f_data = None
+            if self._reader:
+                self._reader.close()
+                self._reader = None
 
 def _check_exc(e, *codes):
     if not hasattr(e, 'response'):
@@ -445,27 +562,33 @@ class S3Writer:
                     Body=bytes(self.buf),
                     IfMatch=self.overwrite.etag,
                 )
-            except:
-                raise # FIXME
+            except BotoClientError as e:
+                _check_exc(e, 'PreconditionFailed', 'ConditionalRequestConflict')
+                raise FileModified(self.name)
             return
         self._upload_buf()
         self._end_thread()
         storage = self.storage
-        storage.s3.complete_multipart_upload(
-            Bucket=storage.bucket,
-            Key=self.objname,
-            MultipartUpload={
-                'Parts': [
-                    {
-                        'ETag': etag,
-                        'PartNumber': n + 1,
-                    }
-                    for n, etag in enumerate(self.etags)
-                ]
-            },
-            UploadId=self.upload_id,
-            IfNoneMatch='*',
-        )
+        try:
+            storage.s3.complete_multipart_upload(
+                Bucket=storage.bucket,
+                Key=self.objname,
+                MultipartUpload={
+                    'Parts': [
+                        {
+                            'ETag': etag,
+                            'PartNumber': n + 1,
+                        }
+                        for n, etag in enumerate(self.etags)
+                    ]
+                },
+                UploadId=self.upload_id,
+                IfNoneMatch='*',
+            )
+        except BotoClientError as e:
+            _check_exc(e, 'PreconditionFailed', 'ConditionalRequestConflict')
+            self.abort()
+            raise FileAlreadyExists(self.name)
         self.storage = None
         self.etags = None
 
@@ -534,6 +657,15 @@ class AWSStorage(BupStorage):
         if not self.down_blksize:
             raise Exception("downloadBlockSize cannot be zero")
 
+        cache_size = repo.access_config_get(b'bup.aws.cacheSize',
+                                            opttype='int')
+        if cache_size is None:
+            cache_size = 1024 * 1024 * 1024
+        if cache_size <= 0:
+            raise Exception("cacheSize must be positive")
+        self.block_cache = BlockCache(self.cachedir, self.down_blksize,
+                                      cache_size)
+
         class StorageClassConfig:
             def __init__(self):
                 self.small = None
@@ -592,7 +724,7 @@ class AWSStorage(BupStorage):
         name = name.decode('utf-8')
         if not self.cachedir or kind not in (Kind.DATA, Kind.METADATA):
             return S3Reader(self, name, kind)
-        return S3CacheReader(self, name, self.cachedir, self.down_blksize, kind)
+        return S3CacheReader(self, name, self.block_cache, kind)
 
     def list(self, kind, pattern=None):
         prefix = _kind_to_prefix(kind)
@@ -620,5 +752,26 @@ class AWSStorage(BupStorage):
             if token is None:
                 break
 
+    def delete(self, kind, names):
+        keys = [_munge(name.decode('utf-8'), kind) for name in names]
+        errors = []
+        # at most 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            ret = self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+                    'Quiet': True,
+                },
+            )
+            errors.extend(ret.get('Errors', ()))
+        if errors:
+            raise Exception("cannot delete %s: %s"
+                            % (errors[0]['Key'], errors[0].get('Message')))
+        if kind in (Kind.DATA, Kind.METADATA):
+            with self.block_cache.locked():
+                for name in names:
+                    self.block_cache.remove(name.decode('utf-8'))
+
     def close(self):
         super(AWSStorage, self).close()
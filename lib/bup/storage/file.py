@@ -64,16 +64,24 @@ class FileWriter:
         self.openset.remove(self)
         self.f.close()
         self.f = None
-        if self.overwrite:
-            with self._locked():
-                fhash = _hash_f(open(self.filename, 'rb'))
-                if fhash != self.overwrite.fhash:
-                    raise FileModified(self.filename)
-                os.chmod(self.tmp_filename, 0o666 & ~UMASK)
-                os.rename(self.tmp_filename, self.filename)
-        else:
+        try:
             os.chmod(self.tmp_filename, 0o666 & ~UMASK)
-            os.rename(self.tmp_filename, self.filename)
+            if self.overwrite:
+                with self._locked():
+                    fhash = _hash_f(open(self.filename, 'rb'))
+                    if fhash != self.overwrite.fhash:
+                        raise FileModified(self.filename)
+                    os.rename(self.tmp_filename, self.filename)
+            else:
+                # unlike rename(), this fails if someone else created
+                # the file meanwhile
+                try:
+                    os.link(self.tmp_filename, self.filename)
+                except FileExistsError:
+                    raise FileAlreadyExists(self.filename)
+        finally:
+            if os.path.exists(self.tmp_filename):
+                os.unlink(self.tmp_filename)
 
     def abort(self):
         assert self.f is not None
@@ -89,6 +97,7 @@ class FileReader:
         if not os.path.exists(self.filename):
             raise FileNotFound(filename)
         self.f = open(self.filename, 'rb')
+        self.size = os.fstat(self.f.fileno()).st_size
         self.openset = openset
         self.openset.add(self)
         self.kind = kind
@@ -148,6 +157,13 @@ class FileStorage(BupStorage):
         # being a list ...
         yield from fnmatch.filter(os.listdir(self.path), pattern or b'*')
 
+    def delete(self, kind, names):
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
     def close(self):
         super(FileStorage, self).close()
         assert not self.openset, self.openset
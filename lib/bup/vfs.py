@@ -52,6 +52,7 @@ from errno import EINVAL, ELOOP, ENOTDIR
 from itertools import chain, groupby, tee
 from random import randrange
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISLNK, S_ISREG
+from threading import Lock
 from time import localtime, strftime
 import re
 
@@ -112,25 +113,43 @@ def _skip_chunks_before_offset(tree, offset):
         prev_ent = ent
     return [prev_ent]
 
-def _tree_chunks(repo, tree, startofs):
-    "Tree should be a sequence of (name, mode, hash) as per tree_decode()."
+def _tree_chunks(repo, tree, startofs, wanted):
+    """Tree should be a sequence of (name, mode, hash) as per
+    tree_decode().  Only fetch (together) as many of the blobs as are
+    needed to produce the wanted() number of bytes."""
     assert(startofs >= 0)
     # name is the chunk's hex offset in the original file
-    for mode, name, oid in _skip_chunks_before_offset(tree, startofs):
-        ofs = int(name, 16)
-        skipmore = startofs - ofs
-        if skipmore < 0:
-            skipmore = 0
-        it = repo.cat(hexlify(oid))
-        _, obj_t, size = next(it)
-        data = b''.join(it)
+    ents = list(_skip_chunks_before_offset(tree, startofs))
+    i = 0
+    while i < len(ents):
+        mode, name, oid = ents[i]
+        skipmore = max(0, startofs - int(name, 16))
         if S_ISDIR(mode):
+            it = repo.cat(hexlify(oid))
+            _, obj_t, size = next(it)
+            data = b''.join(it)
             assert obj_t == b'tree'
-            for b in _tree_chunks(repo, tree_decode(data), skipmore):
+            for b in _tree_chunks(repo, tree_decode(data), skipmore, wanted):
                 yield b
-        else:
-            assert obj_t == b'blob'
-            yield data[skipmore:]
+            i += 1
+            continue
+        # Fetch the run of blobs up to the next subtree together, but
+        # no further than needed for the bytes the reader wants now.
+        runofs = int(name, 16) + skipmore
+        want = wanted()
+        end = i + 1
+        while end < len(ents) and not S_ISDIR(ents[end][0]) \
+              and int(ents[end][1], 16) - runofs < want:
+            end += 1
+        blobs = repo.get_many(hexlify(ent[2]) for ent in ents[i:end])
+        try:
+            for _, obj_t, size, data in blobs:
+                assert obj_t == b'blob'
+                yield data[skipmore:]
+                skipmore = 0
+        finally:
+            blobs.close()
+        i = end
 
 class _ChunkReader:
     def __init__(self, repo, oid, startofs):
@@ -138,8 +157,10 @@ class _ChunkReader:
         _, obj_t, size = next(it)
         isdir = obj_t == b'tree'
         data = b''.join(it)
+        self._want = 0
         if isdir:
-            self.it = _tree_chunks(repo, tree_decode(data), startofs)
+            self.it = _tree_chunks(repo, tree_decode(data), startofs,
+                                   lambda: self._want)
             self.blob = None
         else:
             self.it = None
@@ -150,6 +171,7 @@ class _ChunkReader:
         out = b''
         while len(out) < size:
             if self.it and not self.blob:
+                self._want = size - len(out)
                 try:
                     self.blob = next(self.it)
                 except StopIteration:
@@ -269,6 +291,8 @@ _tags = Tags(meta=default_dir_mode)
 _cache = {}
 _cache_keys = []
 _cache_max_items = 30000
+# e.g. for the bup server's multiplex workers
+_cache_lock = Lock()
 
 def clear_cache():
     global _cache, _cache_keys
@@ -298,9 +322,13 @@ def cache_get(key):
     return _cache.get(key)
 
 def cache_notice(key, value, overwrite=False):
-    global _cache, _cache_keys, _cache_max_items
     if not is_valid_cache_key(key):
         raise Exception('invalid cache key: ' + repr(key))
+    with _cache_lock:
+        _cache_notice(key, value, overwrite)
+
+def _cache_notice(key, value, overwrite):
+    global _cache, _cache_keys, _cache_max_items
     if key in _cache:
         if overwrite:
             _cache[key] = value
@@ -899,6 +927,138 @@ def contents(repo, item, names=None, want_meta=True):
     else:
         raise Exception('unexpected VFS item ' + str(item))
 
+# A subtree (an "internal" node) of a split tree, at the given level
+# above the leaves, see _split_subtree_items().
+_SplitSubtree = namedtuple('_SplitSubtree', ('level', 'oid'))
+
+def _split_tree_depth(entries):
+    for _, mangled_name, _ in entries:
+        if mangled_name.startswith(b'.bupd.'):
+            return _parse_tree_depth(mangled_name)
+        if mangled_name.endswith(b'.bupd'):
+            return int(mangled_name.split(b'.')[0].decode('ascii'))
+    return None
+
+class _DiffCursor:
+    """Step through the contents of a directory (except '.') in the
+    order contents() yields them without metadata, but offer each
+    subtree of a split tree as a whole (a _SplitSubtree) before
+    expand() reads its contents, so that it can be skipped instead.
+
+    """
+    def __init__(self, repo, item):
+        self._repo = repo
+        self._pending = []  # iterators over what's next, innermost last
+        self.current = None
+        if item is None:
+            return
+        if isinstance(item, real_tree_types):
+            entries = list(tree_decode(_get_tree_object(repo, item.oid)))
+            depth = _split_tree_depth(entries)
+            if depth:
+                self._pending.append(
+                    iter([_SplitSubtree(depth - 1, sub_oid)
+                          for _, mangled_name, sub_oid in entries
+                          if not (mangled_name == b'.bupm'
+                                  or mangled_name.endswith(b'.bupd'))]))
+            else:
+                self._pending.append(_tree_items_except_dot(item.oid, entries))
+        else:
+            self._pending.append(x for x in contents(repo, item,
+                                                     want_meta=False)
+                                 if x[0] != b'.')
+        self.next()
+
+    def next(self):
+        while self._pending:
+            self.current = next(self._pending[-1], None)
+            if self.current is not None:
+                return
+            self._pending.pop()
+        self.current = None
+
+    def expand(self):
+        level, oid = self.current
+        entries = list(tree_decode(_get_tree_object(self._repo, oid)))
+        if level:
+            self._pending.append(iter([_SplitSubtree(level - 1, sub_oid)
+                                       for _, _, sub_oid in entries]))
+        else:
+            self._pending.append(_tree_items_except_dot(oid, entries))
+        self.next()
+
+def _diff_id(item):
+    if isinstance(item, FakeLink):
+        return item.target
+    return getattr(item, 'oid', None)
+
+def diff(repo, left, right, recursive=False, prefix=b''):
+    """Yield (status, path, isdir) for each difference between the
+    directory items left and right (either of which may be None, i.e.
+    empty), where status is b'A' (added), b'D' (deleted) or b'M'
+    (modified), in the order bup diff reports them.  Items with the
+    same oid aren't examined further, including the subtrees of split
+    trees, and files are only compared by oid.
+
+    """
+    def isdir(item):
+        return S_ISDIR(item_mode(item))
+    lc = _DiffCursor(repo, left)
+    rc = _DiffCursor(repo, right)
+    while lc.current is not None or rc.current is not None:
+        l, r = lc.current, rc.current
+        l_split = isinstance(l, _SplitSubtree)
+        r_split = isinstance(r, _SplitSubtree)
+        if l_split and r_split and l.oid == r.oid:
+            lc.next()
+            rc.next()
+            continue
+        if l_split or r_split:
+            # Look inside the larger one(s) until they're aligned
+            if l_split and (not r_split or l.level >= r.level):
+                lc.expand()
+            if r_split and (not l_split or r.level >= l.level):
+                rc.expand()
+            continue
+        if l is None or (r is not None and l[0] > r[0]):
+            name, item = r
+            yield b'A', prefix + name, isdir(item)
+            if recursive and isdir(item):
+                yield from diff(repo, None, item, recursive,
+                                prefix + name + b'/')
+            rc.next()
+        elif r is None or l[0] < r[0]:
+            name, item = l
+            yield b'D', prefix + name, isdir(item)
+            if recursive and isdir(item):
+                yield from diff(repo, item, None, recursive,
+                                prefix + name + b'/')
+            lc.next()
+        else:
+            name, l_item = l
+            r_item = r[1]
+            if _diff_id(l_item) != _diff_id(r_item):
+                path = prefix + name
+                l_dir, r_dir = isdir(l_item), isdir(r_item)
+                if not recursive:
+                    yield b'M', path, l_dir
+                elif l_dir and r_dir:
+                    yield b'M', path, True
+                    yield from diff(repo, l_item, r_item, recursive,
+                                    path + b'/')
+                elif l_dir:
+                    yield from diff(repo, l_item, None, recursive,
+                                    path + b'/')
+                    yield b'M', path, True
+                elif r_dir:
+                    yield b'M', path, True
+                    yield from diff(repo, None, r_item, recursive,
+                                    path + b'/')
+                else:
+                    yield b'M', path, False
+            lc.next()
+            rc.next()
+
 def _resolve_path(repo, path, parent=None, want_meta=True, follow=True):
     cache_key = b'res:%d%d%d:%s\0%s' \
                 % (bool(want_meta), bool(follow), repo.vfs_cache_id,
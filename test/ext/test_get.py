@@ -18,7 +18,7 @@ import bup.path
 dispositions_to_test = ('get',)
 
 if int(environ.get(b'BUP_TEST_LEVEL', b'0')) >= 11:
-    dispositions_to_test += ('get-on', 'get-to')
+    dispositions_to_test += ('get-on', 'get-to', 'get-from')
 
 sys.stdout.flush()
 stdout = byte_stream(sys.stdout)
@@ -224,6 +224,10 @@ def _run_get(disposition, method, what):
         get_cmd = (bup_cmd, b'-d', b'get-dest',
                    b'get', b'-vvct', b'--print-tags', b'-s', b'get-src',
                    b'-r', b'-:' + getcwd() + b'/get-dest')
+    elif disposition == 'get-from':
+        get_cmd = (bup_cmd, b'-d', b'get-dest',
+                   b'get', b'-vvct', b'--print-tags',
+                   b'-s', b'file://' + getcwd() + b'/get-src')
     else:
         raise Exception('error: unexpected get disposition ' + repr(disposition))
     
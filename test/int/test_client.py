@@ -1,8 +1,9 @@
 
-import os, time, random, subprocess, glob
+from binascii import hexlify
+import asyncio, os, struct, time, random, subprocess, glob, types
 import pytest
 
-from bup import client, git, path, repo
+from bup import bloom, client, git, path, protocol, repo, vfs
 from bup.compat import bytes_from_uint, environ
 from buptest import ex
 
@@ -91,6 +92,319 @@ def test_multiple_suggestions(tmpdir):
     assert len(glob.glob(c.cachedir+IDX_PAT)) == 3
 
 
+def test_missing_objects(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    with git.PackWriter() as lw:
+        s1sha = lw.new_blob(s1)
+    with client.Client(bupdir, create=True) as c:
+        s2sha = git.calc_hash(b'blob', s2)
+        assert c.missing_objects([s1sha, s2sha]) == [False, True]
+        with c.new_packwriter(ask_missing=True) as rw:
+            assert rw.new_blob(s1) == s1sha
+            assert rw.new_blob(s2) == s2sha
+            assert rw.exists(s1sha)
+            assert rw.exists(s2sha)
+            # the bloom filter rules out s2, but s1 must wait, and
+            # will never be sent
+            assert rw.count == 1
+            rw.new_blob(s2)
+            # ask while receive-objects-v2 is suspended
+            rw.breakpoint()
+            rw.new_blob(s3)
+            rw.new_blob(s1)
+            rw._write_pending()
+            assert c.missing_objects([s1sha, s2sha]) == [False, False]
+            assert rw.count == 1
+        # only the idxs of the two new packs were received
+        assert len(glob.glob(c.cachedir+IDX_PAT)) == 2
+        for idx in glob.glob(c.cachedir+IDX_PAT):
+            with git.open_idx(idx) as ix:
+                assert len(ix) == 1
+                assert not ix.exists(s1sha)
+
+
+def test_missing_objects_batches(tmpdir, capfd):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    with git.PackWriter() as lw:
+        s1sha = lw.new_blob(s1)
+    limit = protocol.MISSING_OBJECTS_MAX_BATCH
+    oids = [git.calc_hash(b'blob', b'%d' % i) for i in range(limit + 1)]
+    oids[limit - 1] = oids[-1] = s1sha
+    with client.Client(bupdir, create=True) as c:
+        # split across batches the server accepts
+        missing = c.missing_objects(oids)
+        assert len(missing) == limit + 1
+        assert [i for i, x in enumerate(missing) if not x] == [limit - 1, limit]
+    # larger batches are refused before reading the ids
+    with pytest.raises(client.ClientError), \
+         client.Client(bupdir) as c:
+        c.conn.write(b'missing-objects\n')
+        c.conn.write(struct.pack('!I', limit + 1))
+        c.conn.write(s1sha)
+        c.check_ok()
+    err = capfd.readouterr().err
+    assert 'batch of %d ids exceeds' % (limit + 1) in err
+
+
+def test_short_object_rejected(tmpdir, capfd):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    with pytest.raises(client.ClientError), \
+         client.Client(bupdir, create=True) as c:
+        c.conn.write(b'receive-objects-v2\n')
+        c.conn.write(struct.pack('!I', 10) + b'x' * 10)
+        c.check_ok()
+    err = capfd.readouterr().err
+    assert 'length 10 is less than the 24 byte oid and crc header' in err
+
+
+def test_bloom_sync(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    with git.PackWriter() as lw:
+        s1sha = lw.new_blob(s1)
+        # so that the bloom filter is larger than an update
+        for i in range(1000):
+            lw.new_blob(b'%d' % i)
+    with client.Client(bupdir, create=True) as c:
+        bloomname = c.cachedir + b'/server.bloom'
+        with c.sync_bloom() as b:
+            assert b.exists(s1sha)
+            assert len(b.idxnames) == 1
+        ino = os.stat(bloomname).st_ino
+    # not covered by the server's bloom, and the client only needs this
+    with git.PackWriter(run_midx=False) as lw:
+        s2sha = lw.new_blob(s2)
+    with client.Client(bupdir) as c:
+        with c.sync_bloom() as b:
+            assert b.exists(s1sha)
+            assert b.exists(s2sha)
+            assert len(b.idxnames) == 2
+        assert os.stat(bloomname).st_ino == ino
+        with c.new_packwriter(ask_missing=True) as rw:
+            s3sha = rw.new_blob(s3)
+            # sent right away since the bloom rules it out
+            assert rw.count == 1
+            rw.new_blob(s1)
+            rw.new_blob(s2)
+            assert rw.count == 1
+        assert len(glob.glob(c.cachedir+IDX_PAT)) == 1
+    with git.PackIdxList(bupdir + b'/objects/pack') as pi:
+        assert pi.exists(s3sha)
+        assert len(pi) == 1003
+
+
+def test_cat_stream(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i for i in range(1000)]
+    with git.PackWriter() as lw:
+        oidxs = [hexlify(lw.new_blob(b)) for b in blobs]
+        lw.new_blob(s1)
+    missing = hexlify(git.calc_hash(b'blob', s2))
+    s1oidx = hexlify(git.calc_hash(b'blob', s1))
+    with client.Client(bupdir, create=True) as c:
+        refs = oidxs[:10] + [missing, s1oidx] + oidxs[10:]
+        expected = [(x, b'blob', len(b), b) for x, b in zip(oidxs, blobs)]
+        expected[10:10] = [(None, None, None, None),
+                           (s1oidx, b'blob', len(s1), s1)]
+        # more refs than the window, consumed lazily
+        assert list(c.cat_stream(iter(refs), window=7)) == expected
+        assert not c._busy
+        assert list(c.cat_stream(refs, include_data=False)) \
+            == [x[:3] + (None,) for x in expected]
+        # other commands suspend the stream, which resumes afterward
+        result = []
+        for i, item in enumerate(c.cat_stream(refs, window=100)):
+            result.append(item)
+            if i % 300 == 1:
+                assert c.read_ref(b'refs/heads/x') is None
+        assert result == expected
+        # abandoning the stream finishes the command
+        it = c.cat_stream(refs)
+        assert next(it) == expected[0]
+        it.close()
+        assert not c._busy
+        assert c.read_ref(b'refs/heads/x') is None
+
+
+def test_async_client(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i * 10000 for i in range(50)]
+    with git.PackWriter() as lw:
+        oids = [lw.new_blob(b) for b in blobs]
+        tree = lw.new_tree([(0o100644, b'%d' % i, oid)
+                            for i, oid in enumerate(oids)])
+        commit = lw.new_commit(tree, None, b'a <a@b>', 1, 0,
+                               b'a <a@b>', 1, 0, b'msg')
+    git.update_ref(b'refs/heads/main', commit, None, repo_dir=bupdir)
+    missing = hexlify(git.calc_hash(b'blob', s2))
+
+    async def run(c):
+        async with client.AsyncClient(c) as ac:
+            cats = [ac.cat(hexlify(oid)) for oid in oids]
+            resolutions = [ac.resolve(b'/main/latest/%d' % i)
+                           for i in range(len(oids))]
+            results = await asyncio.gather(ac.refs(), ac.rev_list(b'main'),
+                                           ac.read_ref(b'refs/heads/main'),
+                                           ac.cat(missing), *cats,
+                                           *resolutions)
+            with pytest.raises(vfs.IOError):
+                await ac.resolve(b'/main/latest/0/x')
+        return results
+
+    with client.Client(bupdir, create=True) as c:
+        results = asyncio.run(run(c))
+        refs, revs, ref, nothing = results[:4]
+        assert refs == list(c.refs())
+        assert revs == [hexlify(commit)]
+        assert ref == commit
+        assert nothing == (None, None, None, None)
+        cats = results[4:4 + len(oids)]
+        assert cats == [(hexlify(oid), b'blob', len(b), b)
+                        for oid, b in zip(oids, blobs)]
+        resolutions = results[4 + len(oids):]
+        assert resolutions == [c.resolve(b'/main/latest/%d' % i)
+                               for i in range(len(oids))]
+        # the client's usable again
+        assert not c._busy
+        assert c.read_ref(b'refs/heads/main') == commit
+
+        with client.MultiplexingClient(c) as mc:
+            futures = [mc.submit('cat', hexlify(oid)) for oid in oids]
+            assert [f.result()[3] for f in futures] == blobs
+            assert list(mc.cat(hexlify(oids[1]))) \
+                == [(hexlify(oids[1]), b'blob', len(blobs[1])), blobs[1]]
+            assert list(mc.cat(missing)) == [(None, None, None)]
+            assert list(mc.refs()) == refs
+            assert list(mc.rev_list(b'main')) == revs
+            assert mc.read_ref(b'refs/heads/x') is None
+            assert mc.resolve(b'/main/latest/1') == resolutions[1]
+        assert c.read_ref(b'refs/heads/main') == commit
+
+
+def test_walk_objects(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir + b'/repo'
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i for i in range(10)]
+    with git.PackWriter() as lw:
+        oids = [lw.new_blob(b) for b in blobs]
+        tree = lw.new_tree([(0o100644, b'%d' % i, oid)
+                            for i, oid in enumerate(oids)])
+        top = lw.new_tree([(0o40000, b'sub', tree),
+                           (0o100644, b'x', oids[0])])
+    missing = git.calc_hash(b'blob', s2)
+    have_name = tmpdir + b'/have.bloom'
+    with bloom.create(have_name, expected=100) as have:
+        have.add(b''.join(oids[:3] + [top]))
+    with client.Client(bupdir, create=True) as c, \
+         bloom.ShaBloom(have_name) as have:
+        result = list(c.walk_objects([top], have=have))
+        assert not c._busy
+        # the root's sent regardless, children first
+        kind, oid, typ, data, meta = result[-1]
+        assert (kind, oid, typ, meta) == (protocol.WALK_OBJECT, top, b'tree',
+                                          True)
+        got = {oid: (kind, typ, data, meta)
+               for kind, oid, typ, data, meta in result[:-1]}
+        for i, oid in enumerate(oids):
+            if i < 3:
+                assert got[oid] == (protocol.WALK_HAVE, None, None, None)
+            else:
+                assert got[oid] == (protocol.WALK_OBJECT, b'blob', blobs[i],
+                                    False)
+        assert got[tree][:2] == (protocol.WALK_OBJECT, b'tree')
+        assert len(got) == 11
+        # below the roots, what's been sent is reported like what the
+        # have-set contains, and the roots are always sent (e.g. after
+        # a false positive)
+        result = list(c.walk_objects([tree, oids[0], missing], have=have))
+        assert sorted(result[:10]) \
+            == sorted((protocol.WALK_HAVE, oid, None, None, None)
+                      for oid in oids)
+        assert result[10:] \
+            == [(protocol.WALK_OBJECT, tree, b'tree', got[tree][2], True),
+                (protocol.WALK_OBJECT, oids[0], b'blob', blobs[0], False),
+                (protocol.WALK_MISSING, missing, None, None, None)]
+        assert c._walk_have
+        assert [x[:2] for x in c.walk_objects([oids[1]])] \
+            == [(protocol.WALK_OBJECT, oids[1])]
+    # the size of the have-set must match its header, and is checked
+    # before the server reads (and spools) it
+    with pytest.raises(client.ClientError), client.Client(bupdir) as c:
+        c.conn.write(b'walk-objects\n')
+        protocol.write_vuint(c.conn, 1)
+        protocol.write_vuint(c.conn, 1 << 40)
+        c.conn.write(b'BLOM' + struct.pack('!IHHI', bloom.BLOOM_VERSION,
+                                           10, 5, 0))
+        try:
+            err = c.check_ok()
+        except client.ClientError as ex:
+            err = ex
+        assert 'invalid have-set' in str(err)
+
+
+def test_resume_objects(tmpdir, monkeypatch):
+    monkeypatch.setattr(client, 'reconnect_delay', 0)
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i * 100 for i in range(500)]
+    with client.Client(bupdir, create=True) as c, \
+         c.new_packwriter(ask_missing=True) as rw:
+        def send(blobs):
+            for blob in blobs:
+                rw.new_blob(blob)
+            rw._write_pending()
+            c.conn.outp.flush()
+        send(blobs[:100])
+        rw.breakpoint()
+        send(blobs[100:200])
+        # the server keeps what it received when the connection drops
+        with open(os.devnull, 'wb') as devnull:
+            os.dup2(devnull.fileno(), c.pin.fileno())
+        c.p.wait()
+        send(blobs[200:300])
+        # ... but not when it's killed
+        c.p.kill()
+        c.p.wait()
+        send(blobs[300:400])
+        send(blobs[400:])
+    # the first pack, the one the server kept, and the rest
+    assert len(glob.glob(bupdir + b'/objects/pack' + IDX_PAT)) == 3
+    sessions = glob.glob(bupdir + b'/bup-sessions/*')
+    assert len(sessions) == 1
+    with open(sessions[0], 'rb') as f:
+        assert f.read() == b'500\n'
+    with git.PackIdxList(bupdir + b'/objects/pack') as pi:
+        for blob in blobs:
+            assert pi.exists(git.calc_hash(b'blob', blob))
+        assert len(pi) == 500
+
+
+def test_server_error_not_resumed(tmpdir, monkeypatch):
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    resumed = []
+    def resume_objects(self):
+        resumed.append(1)
+        raise client.ConnectionLost('not expected')
+    monkeypatch.setattr(client.Client, 'resume_objects', resume_objects)
+    # the server rejects objects with a bad crc
+    monkeypatch.setattr(client, 'zlib',
+                        types.SimpleNamespace(crc32=lambda data, crc=0: 0))
+    with pytest.raises(client.ClientError, match='exit code'), \
+         client.Client(bupdir, create=True) as c:
+        with pytest.raises(client.ClientError, match='expected crc') as exinfo, \
+             c.new_packwriter() as rw:
+            rw.new_blob(s1)
+            rw.breakpoint()
+    assert not isinstance(exinfo.value, client.ConnectionLost)
+    assert resumed == []
+
+
 @pytest.mark.parametrize("dumb_mode", ('file', 'config'))
 def test_dumb_client_server(dumb_mode, tmpdir):
     environ[b'BUP_DIR'] = bupdir = tmpdir
@@ -0,0 +1,35 @@
+
+import os, signal
+
+from wvpytest import *
+
+from bup.cmd.daemon import _WriterSlots
+
+
+def _in_child(fn):
+    pid = os.fork()
+    if not pid:
+        try:
+            os._exit(fn())
+        finally:
+            os._exit(2)
+    return os.waitpid(pid, 0)[1]
+
+def test_writer_slots():
+    slots = _WriterSlots(1)
+    try:
+        # a worker that dies while writing doesn't keep its slot
+        def die_writing():
+            slots.acquire()
+            os.kill(os.getpid(), signal.SIGKILL)
+        wvpasseq(signal.SIGKILL, _in_child(die_writing))
+        wvpass(slots.acquire(block=False))
+        # the slot we now hold isn't available to other workers
+        def try_acquire():
+            slots._held = None  # forget the slot inherited from the parent
+            return 0 if slots.acquire(block=False) else 1
+        wvpasseq(1 << 8, _in_child(try_acquire))
+        slots.release()
+        wvpasseq(0, _in_child(try_acquire))
+    finally:
+        slots.remove()
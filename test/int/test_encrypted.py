@@ -1,12 +1,14 @@
 
+import fnmatch
 import os
 import struct
+import time
 from contextlib import contextmanager
 import pytest
 
 from wvpytest import *
 
-from bup import storage
+from bup import git, storage
 from bup.storage import Kind
 from bup.repo import ConfigRepo, encrypted
 
@@ -85,6 +87,257 @@ def test_encrypted_container(tmpdir):
         # this does some extra checks - do it explicitly
         store.close()
 
+def test_encrypted_container_read_ahead(tmpdir, monkeypatch):
+    libnacl = pytest.importorskip('libnacl')
+    from concurrent.futures import ThreadPoolExecutor
+    from bup.storage.file import FileReader
+    with create_test_config(tmpdir) as store:
+        secret = libnacl.public.SecretKey()
+
+        class BlobBitsRepo:
+            def config_get(self, name, opttype):
+                return 13
+        repo = BlobBitsRepo()
+
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'w', Kind.DATA,
+                                         compression=1, key=secret.pk)
+        objects = {}
+        for i in range(200):
+            # some incompressible, and some bigger than the read-ahead
+            data = os.urandom(i * 100) if i % 3 else b'%d' % i * 1000
+            if i % 50 == 49:
+                data = os.urandom(encrypted.READ_AHEAD_MAX + 1000)
+            objects[p.write(3, None, data)] = data
+        p.finish()
+
+        reads = []
+        orig_read = FileReader.read
+        def read(self, sz=None, szhint=None):
+            reads.append(sz)
+            return orig_read(self, sz, szhint)
+        monkeypatch.setattr(FileReader, 'read', read)
+
+        offsets = list(objects)
+        with encrypted.EncryptedContainer(repo, store, b'test.pack', 'r',
+                                          Kind.DATA, key=secret) as p:
+            del reads[:]
+            for offset in offsets:
+                wvpasseq((3, objects[offset]), p.read(offset))
+            # the sequential reads are merged
+            wvpass(len(reads) < 20)
+            for offset in reversed(offsets):
+                wvpasseq((3, objects[offset]), p.read(offset))
+            wanted = offsets[::-3] + offsets[:10]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for pool in (None, executor):
+                    del reads[:]
+                    wvpasseq([(3, objects[offset]) for offset in wanted],
+                             list(p.read_many(iter(wanted), pool)))
+                    wvpass(len(reads) < 20)
+
+def test_encrypted_container_executor(tmpdir):
+    libnacl = pytest.importorskip('libnacl')
+    from concurrent.futures import ThreadPoolExecutor
+    with create_test_config(tmpdir) as store:
+        secret = libnacl.public.SecretKey()
+
+        class BlobBitsRepo:
+            def config_get(self, name, opttype):
+                return 13
+        repo = BlobBitsRepo()
+
+        class IdxWriter:
+            def __init__(self):
+                self.objects = []
+            def add(self, sha, objtype, offs):
+                self.objects.append((sha, objtype, offs))
+            def exists(self, sha):
+                return sha in (obj[0] for obj in self.objects)
+
+        objects = [(b'%020d' % i,
+                    os.urandom(i * 37) if i % 2 else b'%d' % i * 500)
+                   for i in range(500)]
+        idxwriters = []
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for name, pool in ((b'sync.pack', None), (b'async.pack', executor)):
+                idxwriter = IdxWriter()
+                p = encrypted.EncryptedContainer(repo, store, name, 'w',
+                                                 Kind.DATA, compression=6,
+                                                 key=secret.pk,
+                                                 idxwriter=idxwriter,
+                                                 executor=pool)
+                for sha, data in objects:
+                    p.write(3, sha, data)
+                    wvpass(p.exists(sha))
+                p.finish()
+                idxwriters.append(idxwriter)
+        # the objects were written in order, and to the same place
+        wvpasseq(idxwriters[0].objects, idxwriters[1].objects)
+        wvpasseq([sha for sha, data in objects],
+                 [obj[0] for obj in idxwriters[1].objects])
+        wvpasseq(os.path.getsize(os.path.join(tmpdir, b'repo', b'sync.pack')),
+                 os.path.getsize(os.path.join(tmpdir, b'repo', b'async.pack')))
+        with encrypted.EncryptedContainer(repo, store, b'async.pack', 'r',
+                                          Kind.DATA, key=secret) as p:
+            for (sha, data), (_, objtype, offs) in zip(objects,
+                                                       idxwriters[1].objects):
+                wvpasseq((3, data), p.read(offs))
+
+def test_container_cache():
+    from threading import Thread
+    class Container:
+        def __init__(self, name):
+            self.name = name
+            self.closed = False
+        def close(self):
+            assert not self.closed
+            self.closed = True
+    opened = []
+    def opener(name):
+        def open_container():
+            opened.append(Container(name))
+            return opened[-1]
+        return open_container
+
+    cache = encrypted.ContainerCache(3)
+    for name in (b'a', b'b', b'c', b'a', b'd'):
+        with cache.use(name, opener(name)) as c:
+            wvpasseq(name, c.name)
+    # b was the least recently used
+    wvpasseq([b'a', b'b', b'c', b'd'], [c.name for c in opened])
+    wvpasseq([False, True, False, False], [c.closed for c in opened])
+    wvpasseq((1, 4, 1, {b'a': 2, b'c': 1, b'd': 1}), cache.stats())
+
+    # containers in use are neither evicted nor closed until released
+    with cache.use(b'c', opener(b'c')) as c:
+        for name in (b'e', b'f', b'g'):
+            with cache.use(name, opener(name)):
+                pass
+        wvpass(not c.closed)
+        cache.discard(b'c')
+        wvpass(not c.closed)
+    wvpass(c.closed)
+
+    # failures to open aren't cached
+    def broken():
+        raise FileNotFoundError()
+    with pytest.raises(FileNotFoundError):
+        with cache.use(b'x', broken):
+            pass
+    wvpasseq(None, cache.stats()[3].get(b'x'))
+
+    users = []
+    def use(name):
+        for i in range(200):
+            with cache.use(name, opener(name)) as c:
+                users.append(c)
+                wvpasseq([c], [u for u in users if u is c])
+                users.remove(c)
+    threads = [Thread(target=use, args=(b'%d' % (i % 5),)) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cache.close()
+    wvpass(all(c.closed for c in opened))
+
+def test_commit_graph(tmpdir):
+    libnacl = pytest.importorskip('libnacl')
+    fn = os.path.join(tmpdir, b'commit-graph')
+    key = libnacl.utils.salsa_key()
+    oid = lambda i: b'%020d' % i
+    graph = encrypted.CommitGraph(fn, key)
+    wvpasseq(None, graph.get(oid(1)))
+    graph.add(oid(1), oid(100), 1000, ())
+    graph.add(oid(2), oid(200), -1, (oid(1), oid(3)))
+    graph.add(oid(2), oid(666), 0, ())
+    wvpasseq((oid(200), -1, (oid(1), oid(3))), graph.get(oid(2)))
+
+    # a record encrypted with a different key
+    box = libnacl.secret.SecretBox(libnacl.utils.salsa_key())
+    record = box.encrypt(encrypted.CommitGraph._fixed.pack(oid(3), oid(300),
+                                                           3, 0))
+    with open(fn, 'ab') as f:
+        f.write(encrypted.CommitGraph._header.pack(len(record)) + record)
+    graph.add(oid(4), oid(400), 4, (oid(2),))
+    with open(fn, 'ab') as f:
+        f.write(b'\xff\0\0\0truncated')
+    graph = encrypted.CommitGraph(fn, key)
+    wvpasseq((oid(100), 1000, ()), graph.get(oid(1)))
+    wvpasseq((oid(200), -1, (oid(1), oid(3))), graph.get(oid(2)))
+    wvpasseq(None, graph.get(oid(3)))
+    wvpasseq((oid(400), 4, (oid(2),)), graph.get(oid(4)))
+    # nothing's stored in the clear
+    with open(fn, 'rb') as f:
+        wvpass(oid(400) not in f.read())
+
+    # the invalid records were dropped, so appends are read again
+    size = os.path.getsize(fn)
+    graph.add(oid(5), oid(500), 5, ())
+    with open(fn, 'ab') as f:
+        f.write(b'\x10\0')
+    graph = encrypted.CommitGraph(fn, key)
+    wvpasseq((oid(500), 5, ()), graph.get(oid(5)))
+    graph.add(oid(6), oid(600), 6, ())
+    wvpasseq((oid(600), 6, ()), encrypted.CommitGraph(fn, key).get(oid(6)))
+    # as are duplicates
+    encrypted.CommitGraph(fn, key).add(oid(7), oid(700), 7, ())
+    graph.add(oid(7), oid(700), 7, ())
+    grown = os.path.getsize(fn)
+    wvpasseq((oid(700), 7, ()), encrypted.CommitGraph(fn, key).get(oid(7)))
+    wvpass(os.path.getsize(fn) < grown)
+    # and it starts over once it's too large
+    graph = encrypted.CommitGraph(fn, key)
+    graph.max_commits = 3
+    wvpasseq(None, graph.get(oid(1)))
+    wvpass(os.path.getsize(fn) < size)
+
+def test_meta_pack_cache(tmpdir):
+    pytest.importorskip('libnacl')
+    with create_test_config(tmpdir) as store:
+        path = os.path.join(tmpdir, b'metadata')
+        cache = encrypted.MetaPackCache(path, store, 1000)
+        def write(name, data, dest):
+            w = dest.get_writer(name, Kind.METADATA)
+            w.write(data)
+            w.close()
+        def local(name):
+            return os.path.exists(os.path.join(path, name))
+        def read(name):
+            r = cache.get_reader(name, Kind.METADATA)
+            try:
+                return r.read()
+            finally:
+                r.close()
+
+        # written to both
+        write(b'a.encpack', b'a' * 220, cache)
+        wvpass(local(b'a.encpack'))
+        r = store.get_reader(b'a.encpack', Kind.METADATA)
+        wvpasseq(b'a' * 220, r.read())
+        r.close()
+        # fetched when first read
+        write(b'b.encpack', b'b' * 220, store)
+        wvpass(not local(b'b.encpack'))
+        wvpasseq(b'b' * 220, read(b'b.encpack'))
+        wvpass(local(b'b.encpack'))
+        # too large to be worth it
+        write(b'c.encpack', b'c' * 300, store)
+        wvpasseq(b'c' * 300, read(b'c.encpack'))
+        wvpass(not local(b'c.encpack'))
+
+        os.utime(os.path.join(path, b'a.encpack'), (0, 0))
+        os.utime(os.path.join(path, b'b.encpack'), (1, 1))
+        wvpasseq(b'a' * 220, read(b'a.encpack'))
+        for name in (b'd', b'e', b'f'):
+            write(name + b'.encpack', name * 220, cache)
+        # b was the least recently used
+        wvpasseq([b'a', b'd', b'e', b'f'],
+                 [name for name in (b'a', b'b', b'd', b'e', b'f')
+                  if local(name + b'.encpack')])
+        cache.remove([b'a.encpack', b'b.encpack'])
+        wvpass(not local(b'a.encpack'))
+
 def test_basic_encrypted_repo(tmpdir):
     pytest.importorskip('libnacl')
     with create_test_config(tmpdir) as store:
@@ -93,3 +346,81 @@ def test_basic_encrypted_repo(tmpdir):
 
         for i in range(100):
             open(os.path.join(src, b'%d' % i), 'wb').write(b'%d' % i)
+
+def _encrypted_repo_config(tmpdir, extra=b''):
+    libnacl = pytest.importorskip('libnacl')
+    import libnacl.public, libnacl.secret
+    pair = libnacl.public.SecretKey()
+    cfgfile = os.path.join(tmpdir, b'enc.conf')
+    with open(cfgfile, 'wb') as cfg:
+        cfg.write(b'[bup]\n'
+                  b'  type = Encrypted\n'
+                  b'  storage = File\n'
+                  b'  path = %s\n'
+                  b'  cachedir = %s\n'
+                  b'  repokey = %s\n'
+                  b'  readkey = %s\n'
+                  b'  writekey = %s\n'
+                  % (os.path.join(tmpdir, b'enc-repo'),
+                     os.path.join(tmpdir, b'enc-cache'),
+                     libnacl.secret.SecretBox().hex_sk(),
+                     pair.hex_sk(), pair.hex_pk()))
+        cfg.write(extra)
+    os.mkdir(os.path.join(tmpdir, b'enc-repo'))
+    return cfgfile
+
+def test_idx_sync(tmpdir, monkeypatch):
+    cfgfile = _encrypted_repo_config(tmpdir, b'  idx-sync-threads = 1\n')
+    cachedir = os.path.join(tmpdir, b'enc-cache')
+    oids = []
+    with encrypted.EncryptedRepo(cfgfile, create=True) as repo:
+        for i in range(5):
+            oids.append(repo.write_data(b'%d' % i * 1000))
+            repo.finish_writing()
+    local_idxes = lambda: fnmatch.filter(os.listdir(cachedir), b'*.idx')
+    names = local_idxes()
+    wvpasseq(5, len(names))
+    for name in os.listdir(cachedir):
+        if name.endswith((b'.idx', b'.midx')):
+            os.unlink(os.path.join(cachedir, name))
+
+    # when one fetch fails, the rest are cancelled, and nothing
+    # partial is left behind
+    fetched = []
+    orig_replaced_file = encrypted.atomically_replaced_file
+    @contextmanager
+    def replaced_file(name, mode):
+        fetched.append(name)
+        with orig_replaced_file(name, mode) as f:
+            if len(fetched) == 1:
+                f.write(b'partial')
+                raise Exception('fetch failed')
+            time.sleep(0.2)
+            yield f
+    monkeypatch.setattr(encrypted, 'atomically_replaced_file', replaced_file)
+    with encrypted.EncryptedRepo(cfgfile) as repo:
+        with pytest.raises(Exception, match='fetch failed'):
+            repo.sync_indexes()
+    wvpass(len(fetched) <= 2)
+    wvpass(not fnmatch.filter(os.listdir(cachedir), b'*.idx-*'))
+    wvpass(os.path.basename(fetched[0]) not in local_idxes())
+    monkeypatch.undo()
+
+    # otherwise they're all fetched, and the midx is rebuilt once
+    midx_runs = []
+    orig_auto_midx = git.auto_midx
+    def auto_midx(objdir):
+        midx_runs.append(objdir)
+        orig_auto_midx(objdir)
+    monkeypatch.setattr(git, 'auto_midx', auto_midx)
+    with encrypted.EncryptedRepo(cfgfile) as repo:
+        repo.sync_indexes()
+        wvpasseq(sorted(names), sorted(local_idxes()))
+        wvpasseq([cachedir], midx_runs)
+        for oid in oids:
+            wvpass(repo.exists(oid))
+
+def test_idx_sync_threads_config(tmpdir):
+    cfgfile = _encrypted_repo_config(tmpdir, b'  idx-sync-threads = 0\n')
+    with pytest.raises(Exception, match='idx-sync-threads must be positive'):
+        encrypted.EncryptedRepo(cfgfile, create=True)
@@ -3,13 +3,13 @@ import sys
 from binascii import hexlify, unhexlify
 from subprocess import check_call
 from functools import partial
-import struct, os
+import glob, struct, os
 import pytest
 
 from wvpytest import *
 
 from bup import git, path
-from bup.compat import bytes_from_byte, environ
+from bup.compat import bytes_from_byte, bytes_from_uint, environ
 from bup.helpers import OBJECT_EXISTS, localtime, log, mkdirp, readpipe
 
 
@@ -169,6 +169,43 @@ def test_packs(tmpdir):
         WVFAIL(r.exists(b'\0'*20))
 
 
+@pytest.mark.parametrize('write_behind', [False, True])
+@pytest.mark.parametrize('group_sync', [False, True])
+def test_pack_writer_modes(tmpdir, write_behind, group_sync):
+    environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    packdir = git.repo(b'objects/pack', repo_dir=bupdir)
+
+    hashes = []
+    with git.PackWriter(max_pack_objects=100, write_behind=write_behind,
+                        group_sync=group_sync) as w:
+        for i in range(250):
+            hashes.append(w.new_blob(b'%d' % i))
+        # the finished packs must be found whether published or not
+        for h in hashes:
+            WVPASS(w.exists(h))
+        WVPASSEQ(w.new_blob(b'5'), hashes[5])
+        idxs = [x for x in os.listdir(packdir) if x.endswith(b'.idx')]
+        WVPASSEQ(len(idxs), 0 if group_sync else 2)
+        w.close()
+    idxs = [x for x in os.listdir(packdir) if x.endswith(b'.idx')]
+    WVPASSEQ(len(idxs), 3)
+    WVPASSEQ(glob.glob(bupdir + b'/objects/pack-tmp-*'), [])
+    exc(b'git', b'--git-dir', bupdir, b'fsck', b'--strict')
+    with git.PackIdxList(packdir) as r:
+        for h in hashes:
+            WVPASS(r.exists(h))
+
+    with git.PackWriter(max_pack_objects=100, write_behind=write_behind,
+                        group_sync=group_sync) as w:
+        for i in range(250):
+            w.new_blob(b'aborted %d' % i)
+        w.abort()
+    idxs = [x for x in os.listdir(packdir) if x.endswith(b'.idx')]
+    WVPASSEQ(len(idxs), 3 if group_sync else 5)
+    WVPASSEQ(glob.glob(bupdir + b'/objects/pack-tmp-*'), [])
+
+
 def test_pack_name_lookup(tmpdir):
     environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
     git.init_repo(bupdir)
@@ -215,6 +252,32 @@ def test_long_index(tmpdir):
         WVPASSEQ(i.find_offset(obj3_bin), 0xff)
 
 
+def test_idx_writer(tmpdir):
+    idx = git.PackIdxV2Writer()
+    shas = [os.urandom(20) for i in range(5000)]
+    for i, sha in enumerate(shas):
+        WVFAIL(idx.exists(sha))
+        idx.add(sha, i, 12 + 100 * i)
+        WVPASS(idx.exists(sha))
+    # duplicates are kept, but don't confuse the lookups
+    idx.add(shas[7], 7, 12 + 100 * 5000)
+    WVPASSEQ(idx.count, 5001)
+    WVPASSEQ(list(idx)[:5000], shas)
+    for sha in shas:
+        WVPASS(idx.exists(sha))
+    WVFAIL(idx.exists(b'\0' * 20))
+
+    name = tmpdir + b'/tmp.idx'
+    idx.write(name, b'\1' * 20)
+    with git.open_idx(name) as i:
+        WVPASSEQ(len(i), 5001)
+        WVPASSEQ(list(i), sorted(shas + [shas[7]]))
+        for n, sha in enumerate(shas):
+            if n != 7:
+                WVPASSEQ(i.find_offset(sha), 12 + 100 * n)
+        WVPASSEQ(i.exists(shas[42], want_offset=True, want_crc=True).crc, 42)
+
+
 def test_check_repo_or_die(tmpdir):
     environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
     orig_cwd = os.getcwd()
@@ -558,6 +621,63 @@ def test_midx_close(tmpdir):
             # check that we don't have it open anymore
             WVPASSEQ(False, b'deleted' in fn)
 
+def test_sha_lookup(tmpdir):
+    shas = [os.urandom(20) for i in range(2000)]
+    # some that can't be told apart by their first word
+    shas.extend(b'\x42\0\0\x01' + os.urandom(16) for i in range(50))
+    shas.extend(bytes(19) + bytes_from_uint(i) for i in range(50))
+    idx = git.PackIdxV2Writer()
+    for i, sha in enumerate(shas):
+        idx.add(sha, i, 12 + i)
+    packbin = b'\1' * 20
+    idx.write(b'%s/pack-%s.idx' % (tmpdir, hexlify(packbin)), packbin)
+    idx = git.PackIdxV2Writer()
+    missing = [os.urandom(20) for i in range(1000)]
+    for i, sha in enumerate(missing):
+        idx.add(sha, i, 12 + i)
+    packbin = b'\2' * 20
+    idx.write(b'%s/pack-%s.idx' % (tmpdir, hexlify(packbin)), packbin)
+    missing.extend([b'\x42\0\0\x01' + bytes(16), bytes(19) + b'\xff',
+                    b'\xff' * 20])
+    with git.open_idx(b'%s/pack-%s.idx' % (tmpdir, hexlify(b'\1' * 20))) as ix:
+        for i, sha in enumerate(shas):
+            WVPASSEQ(ix.find_offset(sha), 12 + i)
+        for sha in missing:
+            WVPASSEQ(ix.find_offset(sha), None)
+    exc(bup_exe, b'midx', b'-f', b'--dir', tmpdir)
+    midxs = glob.glob(tmpdir + b'/*.midx')
+    WVPASSEQ(len(midxs), 1)
+    with git.open_midx(midxs[0]) as mx:
+        for sha in shas:
+            WVPASSEQ(mx.exists(sha, want_source=True).pack,
+                     b'pack-%s.idx' % hexlify(b'\1' * 20))
+        for sha in missing[:-3]:
+            WVPASS(mx.exists(sha))
+        for sha in missing[-3:]:
+            WVPASSEQ(mx.exists(sha), None)
+
+
+def test_idx_list_open_limits(tmpdir):
+    for i in range(10):
+        _create_idx(tmpdir, i)
+    idxsize = os.stat(glob.glob(tmpdir + b'/*.idx')[0]).st_size
+    with git.PackIdxList(tmpdir, max_open=3) as l:
+        # nothing is opened up front
+        WVPASSEQ(len(l), 10 * 255)
+        WVPASSEQ(len(l._mapped_idxs), 0)
+        for i in range(10):
+            for s in (0, 254):
+                WVPASS(l.exists(struct.pack('18xBB', i, s)))
+            WVPASS(len(l._mapped_idxs) <= 3)
+        WVPASSEQ(len(l._mapped_idxs), 3)
+        WVFAIL(l.exists(struct.pack('18xBB', 10, 0)))
+        WVPASSEQ(len(list(l)), 10 * 255)
+    with git.PackIdxList(tmpdir, max_mapped=2 * idxsize) as l:
+        for i in range(10):
+            WVPASS(l.exists(struct.pack('18xBB', i, 7)))
+            WVPASS(l._mapped_size <= 2 * idxsize)
+        WVPASSEQ(len(l._mapped_idxs), 2)
+
 def test_config(tmpdir):
     cfg_file = os.path.join(os.path.dirname(__file__), 'sample.conf')
     no_such_file = os.path.join(os.path.dirname(__file__), 'nosuch.conf')
@@ -1,6 +1,7 @@
 
+from io import BytesIO
 from time import tzset
-import os, os.path, re, subprocess
+import os, os.path, re, socket, subprocess, threading
 from bup import helpers
 
 from wvpytest import *
@@ -13,7 +14,8 @@ except ImportError:
     hypothesis = False
 
 from bup.compat import bytes_from_byte, bytes_from_uint, environ
-from bup.helpers import (atomically_replaced_file, batchpipe, detect_fakeroot,
+from bup.helpers import (Conn, DemuxConn, MuxWriter,
+                         atomically_replaced_file, batchpipe, detect_fakeroot,
                          grafted_path_components, parse_num,
                          path_components, readpipe, stripped_path_components,
                          shstr,
@@ -236,6 +238,83 @@ def test_valid_save_name():
     WVFAIL(valid(b'.bar/baz'))
     WVFAIL(valid(b'foo/.bar/baz'))
 
+def _check_conn_reads(conn, lines, blob):
+    for line in lines:
+        WVPASSEQ(line, conn.readline())
+        WVPASS(conn.has_input())
+    # larger than the buffer, read (mostly) straight into ours
+    buf = bytearray(len(blob))
+    WVPASSEQ(len(blob), conn.readinto(buf))
+    WVPASSEQ(blob, buf)
+    WVPASSEQ(b'x' * 3, conn.read(3))
+    WVPASSEQ(b'x' * 100000 + b'\n', conn.readline())  # grows the buffer
+    WVPASSEQ(b'tail', conn.read(10))
+    WVPASSEQ(b'', conn.read(10))
+    WVPASSEQ(b'', conn.readline())
+
+def _conn_input(lines, blob):
+    return b''.join(lines) + blob + b'x' * 100003 + b'\ntail'
+
+def test_conn():
+    lines = [b'%d\n' % (i * i) for i in range(2000)]
+    blob = os.urandom(helpers.CONN_BUFFER_SIZE * 3 + 7)
+    with open(os.devnull, 'wb') as devnull, \
+         Conn(BytesIO(_conn_input(lines, blob)), devnull) as conn:
+        _check_conn_reads(conn, lines, blob)
+
+def test_demux_conn():
+    lines = [b'%d\n' % (i * i) for i in range(2000)]
+    blob = os.urandom(helpers.CONN_BUFFER_SIZE * 3 + 7)
+    data = _conn_input(lines, blob)
+    ours, theirs = socket.socketpair()
+    def send():
+        with theirs, MuxWriter(theirs.fileno()) as out:
+            for i in range(0, len(data), 12345):
+                out.write(data[i:i + 12345])
+                if i == 12345:
+                    out.write_stderr(b'demux test: stderr packet\n')
+    sender = threading.Thread(target=send)
+    sender.start()
+    try:
+        with ours, open(os.devnull, 'wb') as devnull, \
+             DemuxConn(ours.fileno(), devnull) as conn:
+            _check_conn_reads(conn, lines, blob)
+            WVPASS(conn.closed)
+            WVFAIL(conn.has_input())
+    finally:
+        sender.join()
+
+def test_mux_writer_threads():
+    # e.g. the server suggesting idxs from the storer thread while
+    # the connection's reads flush the output
+    ours, theirs = socket.socketpair()
+    def send(out, n):
+        for i in range(2000):
+            out.write(b'%d %d\n' % (n, i))
+            if i % 7 == n:
+                out.flush()
+    def sender():
+        with theirs, MuxWriter(theirs.fileno()) as out:
+            threads = [threading.Thread(target=send, args=(out, n))
+                       for n in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    main = threading.Thread(target=sender)
+    main.start()
+    try:
+        with ours, open(os.devnull, 'wb') as devnull, \
+             DemuxConn(ours.fileno(), devnull) as conn:
+            seen = [[] for n in range(4)]
+            for i in range(4 * 2000):
+                n, i = conn.readline().split()
+                seen[int(n)].append(int(i))
+            WVPASSEQ([list(range(2000))] * 4, seen)
+            WVPASSEQ(b'', conn.readline())
+    finally:
+        main.join()
+
 if hypothesis:
     _echopath = os.path.join(os.path.dirname(__file__), '..', 'bin', 'echo.sh')
 
@@ -1,5 +1,6 @@
 
 from io import BytesIO
+from threading import Lock
 import sys
 
 from wvpytest import *
@@ -14,3 +15,51 @@ def test_item_read_write():
     print('stream:', repr(stream.getvalue()), stream.tell(), file=sys.stderr)
     stream.seek(0)
     wvpasseq(x, protocol.read_item(stream))
+
+def test_object_storer():
+    stored = []
+    def store(batch, storer):
+        for x in batch:
+            if x == b'bad':
+                raise Exception('cannot store ' + repr(x))
+            stored.append(x)
+    storer = protocol._ObjectStorer(store)
+    try:
+        for i in range(100):
+            storer.put([b'%d' % i, b'%d' % (i + 100)])
+        storer.put([])
+        storer.sync()
+        wvpasseq(200, len(stored))
+        wvpasseq([b'0', b'100', b'1', b'101'], stored[:4])
+        storer.put([b'bad', b'x'])
+        with pytest.raises(Exception, match='cannot store'):
+            storer.sync()
+        # the rest is dropped
+        with pytest.raises(Exception, match='cannot store'):
+            storer.put([b'y'])
+        wvpasseq(200, len(stored))
+    finally:
+        storer.close()
+
+def test_multiplexed_request_chunks():
+    class Out(BytesIO):
+        outp = property(lambda self: self)
+    out = Out()
+    request = protocol._MultiplexedRequest(out, Lock(), [], 7,
+                                           b'body\n')
+    wvpasseq(b'body\n', request.readline())
+    size = protocol.MULTIPLEX_CHUNK_SIZE
+    data = [b'x' * 10, b'y' * (3 * size), b'z' * (size - 1), b'w']
+    for x in data:
+        request.write(x)
+    # full chunks are sent right away, without collecting the rest
+    wvpasseq(4 * size, len(out.getvalue()) - 4 * 4)
+    request.finish()
+    out.seek(0)
+    chunks = []
+    while out.tell() < len(out.getvalue()):
+        wvpasseq(7, protocol.read_vuint(out))
+        chunks.append(protocol.read_bvec(out))
+    wvpasseq(b'', chunks[-1])
+    wvpasseq([size] * 4 + [10], [len(x) for x in chunks[:-1]])
+    wvpasseq(b''.join(data), b''.join(chunks))
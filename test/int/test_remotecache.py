@@ -0,0 +1,151 @@
+
+from binascii import hexlify
+from itertools import chain
+import os, sqlite3
+
+from wvpytest import *
+
+from bup import client, git, path, remotecache, vfs
+from bup.compat import environ
+from bup.remotecache import RemoteCache
+from bup.repo import make_repo
+from buptest import ex
+
+
+bup_path = path.exe()
+
+def test_object_eviction(tmpdir):
+    fn = tmpdir + b'/cache.sqlite'
+    oid = lambda i: b'%020d' % i
+    with RemoteCache(fn, 10000) as cache:
+        for i in range(10):
+            cache.add_object(oid(i), b'blob', b'%02d' % i * 500)
+        cache._flush()
+        cache._db.execute('UPDATE objects SET atime = 0')
+        # recently used
+        wvpasseq((b'blob', b'09' * 500), cache.get_object(oid(9)))
+        for i in range(10, 15):
+            cache.add_object(oid(i), b'blob', b'%02d' % i * 500)
+        # too big to be worth it
+        cache.add_object(b'x' * 20, b'blob', b'x' * 2000)
+    with RemoteCache(fn, 10000) as cache:
+        wvpasseq(9000, cache._size)
+        present = [i for i in range(15) if cache.get_object(oid(i))]
+        wvpasseq(9, len(present))
+        wvpasseq(list(range(9, 15)), present[-6:])
+        wvpasseq(None, cache.get_object(b'x' * 20))
+
+def test_shared_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(remotecache, '_lock_timeout', 0.1)
+    fn = tmpdir + b'/cache.sqlite'
+    oid = lambda i: b'%020d' % i
+    with RemoteCache(fn, 10000) as a, RemoteCache(fn, 10000) as b:
+        a.add_object(oid(1), b'blob', b'1' * 10)
+        a._flush()
+        # a hit doesn't keep a transaction open, so others can write
+        wvpasseq((b'blob', b'1' * 10), a.get_object(oid(1)))
+        b.add_object(oid(2), b'blob', b'2' * 10)
+        b._flush()
+        wvpasseq((b'blob', b'2' * 10), a.get_object(oid(2)))
+        # while another client holds the lock, lookups miss and
+        # changes are dropped
+        locker = sqlite3.connect(fn)
+        try:
+            locker.execute('BEGIN EXCLUSIVE')
+            wvpasseq(None, b.get_object(oid(1)))
+            b.add_object(oid(3), b'blob', b'3' * 10)
+            b._flush()
+        finally:
+            locker.rollback()
+            locker.close()
+        wvpasseq((b'blob', b'1' * 10), b.get_object(oid(1)))
+        wvpasseq(None, b.get_object(oid(3)))
+
+def test_remote_cache(tmpdir, monkeypatch):
+    environ[b'GIT_DIR'] = environ[b'BUP_DIR'] = bup_dir = tmpdir + b'/bup'
+    src = tmpdir + b'/src'
+    os.makedirs(src + b'/dir')
+    with open(src + b'/dir/file', 'wb') as f:
+        f.write(b'canary\n')
+    ex((bup_path, b'init'))
+    ex((bup_path, b'index', src))
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', src))
+
+    resolutions = []
+    orig_resolve = client.Client.resolve
+    def resolve(self, path, *args, **kwargs):
+        resolutions.append(path)
+        return orig_resolve(self, path, *args, **kwargs)
+    monkeypatch.setattr(client.Client, 'resolve', resolve)
+
+    def file_info(repo):
+        vfs.clear_cache()
+        res = repo.resolve(b'/test/latest/dir/file')
+        commit = repo.resolve(b'/test/latest')
+        wvpasseq(commit, res[:3])
+        # relative to the commit
+        wvpasseq(res, repo.resolve(b'dir/file', parent=commit))
+        wvpasseq([b'.', b'dir'],
+                 [name for name, item in vfs.contents(repo, commit[-1][1])])
+        return commit, res
+
+    with make_repo(bup_dir) as repo:
+        old_commit, old_res = file_info(repo)
+        wvpasseq(3, len(resolutions))
+        wvpasseq(b'canary\n', repo.get_data(hexlify(old_res[-1][1].oid),
+                                            b'blob'))
+    with make_repo(bup_dir) as repo:
+        wvpasseq((old_commit, old_res), file_info(repo))
+        wvpasseq(3, len(resolutions))
+        # the commit's tree and its .bupm were cached
+        cache = repo._cache
+        typ, tree = cache.get_object(old_commit[-1][1].oid)
+        wvpasseq(b'tree', typ)
+        bupm = [oid for mode, name, oid in git.tree_decode(tree)
+                if name == b'.bupm']
+        wvpasseq(1, len(bupm))
+        wvpasseq(b'blob', cache.get_object(bupm[0])[0])
+        # and then no longer needs to be remembered
+        wvpass(bupm[0] not in repo._meta_oids)
+
+    with open(src + b'/dir/file', 'wb') as f:
+        f.write(b'changed\n')
+    ex((bup_path, b'index', src))
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', src))
+    with make_repo(bup_dir) as repo:
+        commit, res = file_info(repo)
+        wvpassne(old_res[-1][1].oid, res[-1][1].oid)
+        wvpasseq(6, len(resolutions))
+        # but what's below the old commit remains valid
+        wvpasseq(old_res, repo.resolve(b'dir/file', parent=old_commit))
+        wvpasseq(6, len(resolutions))
+
+        # the refs are only listed once per connection, or when asked
+        # to check them again
+        orig_refs = repo.client.refs
+        listed = []
+        def refs():
+            listed.append(1)
+            return chain(orig_refs(), ((b'refs/heads/other', b'x' * 20),))
+        repo.client.refs = refs
+        wvpasseq(res, repo.resolve(b'/test/latest/dir/file'))
+        wvpasseq(6, len(resolutions))
+        wvpasseq([], listed)
+        repo.check_refs()
+        wvpasseq(res, repo.resolve(b'/test/latest/dir/file'))
+        wvpasseq(res, repo.resolve(b'/test/latest/dir/file'))
+        wvpasseq(7, len(resolutions))
+        wvpasseq([1], listed)
+
+def test_cache_size_is_local(tmpdir):
+    environ[b'GIT_DIR'] = environ[b'BUP_DIR'] = bup_dir = tmpdir + b'/bup'
+    ex((bup_path, b'init'))
+    # the server's setting doesn't matter
+    git.git_config_write(b'bup.client.cache-size', b'0', repo_dir=bup_dir)
+    environ[b'BUP_DIR'] = local = tmpdir + b'/local'
+    ex((bup_path, b'init'))
+    with make_repo(bup_dir) as repo:
+        wvpass(repo._cache)
+    git.git_config_write(b'bup.client.cache-size', b'0', repo_dir=local)
+    with make_repo(bup_dir) as repo:
+        wvpasseq(None, repo._cache)
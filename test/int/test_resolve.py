@@ -8,7 +8,7 @@ from time import localtime, strftime
 
 from wvpytest import *
 
-from bup import git, path, vfs
+from bup import client, git, path, vfs
 from bup.compat import environ
 from bup.repo import LocalRepo, make_repo
 from buptest import ex, exo
@@ -305,4 +305,43 @@ def test_remote_resolve_loop(tmpdir):
     prep_and_test_repo(tmpdir,
                        lambda x: make_repo(x), _test_resolve_loop)
 
+def _test_resolve_many(repo, tmpdir):
+    data_path = tmpdir + b'/src'
+    os.makedirs(data_path + b'/dir')
+    symlink(b'loop', data_path + b'/loop')
+    for i in range(20):
+        with open(data_path + b'/dir/%d' % i, 'wb') as f:
+            f.write(b'%d' % i)
+    ex((bup_path, b'index', b'-v', data_path))
+    ex((bup_path, b'save', b'-tvvn', b'test', b'--strip', data_path))
+    paths = [b'/test/latest/dir/%d' % i for i in range(20)]
+    paths += [b'/test/latest/loop', b'/test/latest/dir/x',
+              b'/test/latest/dir/0/x']
+    vfs.clear_cache()
+    res = repo.resolve_many(paths)
+    vfs.clear_cache()
+    for path, got in zip(paths[:20], res):
+        wvpasseq(repo.resolve(path), got)
+    # the failures are returned (in place)
+    wvpasseq(ELOOP, res[-3].errno)
+    wvpasseq(None, res[-2][-1][1])
+    wvpasseq(ENOTDIR, res[-1].errno)
+    wvpasseq(b'loop', repo.resolve_many(paths[-3:-2], follow=False)[0][-1][0])
+
+def test_local_resolve_many(tmpdir):
+    prep_and_test_repo(tmpdir,
+                       lambda x: LocalRepo(x), _test_resolve_many)
+
+def test_remote_resolve_many(tmpdir, monkeypatch):
+    # the resolutions are multiplexed
+    resolved = []
+    orig_resolve = client.AsyncClient.resolve
+    async def resolve(self, path, *args, **kwargs):
+        resolved.append(path)
+        return await orig_resolve(self, path, *args, **kwargs)
+    monkeypatch.setattr(client.AsyncClient, 'resolve', resolve)
+    prep_and_test_repo(tmpdir,
+                       lambda x: make_repo(x), _test_resolve_many)
+    wvpasseq(23, len(resolved))
+
 # FIXME: add tests for the want_meta=False cases.
@@ -1,10 +1,13 @@
 
 import os
 from contextlib import contextmanager
+from io import BytesIO
+from threading import Thread
 
 from wvpytest import *
 
 from bup.storage import Kind, FileAlreadyExists, FileNotFound, get_storage
+from bup.storage import aws
 from bup.repo import ConfigRepo
 
 
@@ -111,3 +114,77 @@ def test_storage_packs(tmpdir):
             rd = store.get_reader(filename, kind)
             wvpasseq(rd.read(), b'a' * 100)
             rd.close()
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+    def head_object(self, Bucket, Key):
+        return {'ETag': 'etag', 'ContentLength': len(self.objects[Key])}
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(x) for x in Range[len('bytes='):].split('-'))
+        self.requests.append((Key, start, end))
+        return {'ContentRange': 'bytes %d-%d/%d'
+                % (start, end, len(self.objects[Key])),
+                'Body': BytesIO(self.objects[Key][start:end + 1])}
+
+def test_aws_block_cache(tmpdir):
+    cachedir = os.path.join(tmpdir, b'cache').decode('ascii')
+    os.mkdir(cachedir)
+    class Storage:
+        bucket = 'test'
+        s3 = FakeS3({'data/a': os.urandom(10000), 'data/b': os.urandom(10000),
+                     'data/c': os.urandom(10000)})
+    requests = Storage.s3.requests
+    objects = Storage.s3.objects
+    cache = aws.BlockCache(cachedir, 1000, 25000)
+    def reader(name):
+        return aws.S3CacheReader(Storage, name, cache, Kind.DATA)
+
+    rd = reader('a')
+    rd.seek(1500)
+    wvpasseq(objects['data/a'][1500:1600], rd.read(100, szhint=1000))
+    # block aligned, including the hint
+    wvpasseq([('data/a', 1000, 2999)], requests)
+    rd.seek(2500)
+    wvpasseq(objects['data/a'][2500:4500], rd.read(2000))
+    # only what wasn't cached
+    wvpasseq(('data/a', 3000, 4999), requests[-1])
+    rd.close()
+
+    # the blocks are persisted, and shared with other readers
+    del requests[:]
+    rd = reader('a')
+    rd2 = reader('a')
+    rd2.seek(9000)
+    wvpasseq(objects['data/a'][9000:], rd2.read())
+    rd.seek(1000)
+    wvpasseq(objects['data/a'][1000:5000], rd.read(4000))
+    wvpasseq([('data/a', 9000, 9999)], requests)
+    rd.seek(8500)
+    wvpasseq(objects['data/a'][8500:], rd.read(1500))
+    wvpasseq(2, len(requests))
+    rd.close()
+    rd2.close()
+
+    # concurrent reads
+    def read_all(name):
+        rd = reader(name)
+        for offs in range(0, 10000, 700):
+            rd.seek(offs)
+            wvpasseq(objects['data/' + name][offs:offs + 700], rd.read(700))
+        rd.close()
+    threads = [Thread(target=read_all, args=(name,))
+               for name in ('b', 'c', 'b', 'c')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # a, the least recently used, was evicted meanwhile
+    wvpass(not os.path.exists(os.path.join(cachedir, 'a.data')))
+    for name in ('b', 'c'):
+        wvpass(os.path.exists(os.path.join(cachedir, name + '.data')))
+    del requests[:]
+    read_all('a')
+    wvpasseq(10, len(requests))
@@ -293,6 +293,39 @@ def test_read_and_seek(tmpdir):
                                       b'%s/%d' % (data_path, size),
                                       read_sizes)
 
+def test_read_fetches_only_needed_chunks(tmpdir):
+    bup_dir = tmpdir + b'/bup'
+    environ[b'GIT_DIR'] = bup_dir
+    environ[b'BUP_DIR'] = bup_dir
+    git.repodir = bup_dir
+    data_path = tmpdir + b'/src'
+    os.mkdir(data_path)
+    size = 2 * 1024 * 1024
+    write_sized_random_content(data_path, size, 42)
+    ex((bup_path, b'init'))
+    ex((bup_path, b'index', b'-v', data_path))
+    ex((bup_path, b'save', b'-tvvn', b'test', b'--strip', data_path))
+    with open(b'%s/%d' % (data_path, size), 'rb') as f:
+        expected = f.read()
+    with LocalRepo() as repo:
+        requested = []
+        orig_get_many = repo.get_many
+        def get_many(refs, **kwargs):
+            refs = list(refs)
+            requested.append(len(refs))
+            return orig_get_many(refs, **kwargs)
+        repo.get_many = get_many
+        _, item = vfs.resolve(repo, b'/test/latest/%d' % size)[-1]
+        with vfs.fopen(repo, item) as f:
+            wvpasseq(expected[:100], f.read(100))
+            wvpasseq([1], requested)
+            f.seek(size // 2)
+            wvpasseq(expected[size // 2:size // 2 + 100], f.read(100))
+            wvpasseq(1, requested[-1])
+            wvpasseq(expected[size // 2 + 100:], f.read())
+            # the rest was fetched in runs, not chunk by chunk
+            assert max(requested) > 1
+
 def test_contents_with_mismatched_bupm_git_ordering(tmpdir):
     bup_dir = tmpdir + b'/bup'
     environ[b'GIT_DIR'] = bup_dir
@@ -380,3 +413,68 @@ def test_tree_depth_parsing():
         with pytest.raises(Exception) as exinfo:
             vfs._parse_tree_depth(x)
         assert 'Could not parse split tree depth' in str(exinfo.value)
+
+def test_diff(tmpdir):
+    bup_dir = tmpdir + b'/bup'
+    environ[b'GIT_DIR'] = bup_dir
+    environ[b'BUP_DIR'] = bup_dir
+    git.repodir = bup_dir
+    src = tmpdir + b'/src'
+    def write(name, data):
+        with open(src + b'/' + name, 'wb') as f:
+            f.write(data)
+    os.makedirs(src + b'/big')
+    os.makedirs(src + b'/sub/gone')
+    # random names, so the tree's split into many subtrees
+    rng = Random(42)
+    names = sorted(b'%032x' % rng.getrandbits(128) for i in range(3000))
+    for name in names:
+        write(b'big/' + name, name)
+    write(b'sub/file', b'file')
+    write(b'sub/gone/x', b'x')
+    write(b'same', b'same')
+    ex((bup_path, b'init'))
+    ex((b'git', b'config', b'bup.split.trees', b'1'))
+    ex((bup_path, b'index', src))
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', src))
+    write(b'big/' + names[1500], b'changed')
+    os.unlink(src + b'/big/' + names[10])
+    write(b'big/' + names[2000] + b'x', b'new')
+    write(b'sub/file', b'changed')
+    ex((b'rm', b'-r', src + b'/sub/gone'))
+    os.makedirs(src + b'/sub/new')
+    ex((bup_path, b'index', src))
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', src))
+
+    with LocalRepo() as repo:
+        res = vfs.resolve(repo, b'/test')
+        saves = sorted(x[0] for x in vfs.contents(repo, res[-1][1]))
+        old, new = (b'/test/' + x for x in saves[1:3])
+        wvpasseq([(b'M', b'big', True), (b'M', b'sub', True)],
+                 list(repo.diff(old, new)))
+        cats = []
+        orig_cat = repo.cat
+        def cat(ref):
+            cats.append(ref)
+            return orig_cat(ref)
+        repo.cat = cat
+        wvpasseq([(b'M', b'big', True),
+                  (b'D', b'big/' + names[10], False),
+                  (b'M', b'big/' + names[1500], False),
+                  (b'A', b'big/' + names[2000] + b'x', False),
+                  (b'M', b'sub', True),
+                  (b'M', b'sub/file', False),
+                  (b'D', b'sub/gone', True),
+                  (b'D', b'sub/gone/x', False),
+                  (b'A', b'sub/new', True)],
+                 list(repo.diff(old, new, recursive=True)))
+        # only the subtrees of the split tree that differ were read
+        subtrees = exo((b'git', b'ls-tree', b'test:big')).out.splitlines()
+        subtrees = [x for x in subtrees
+                    if b' tree ' in x and not x.endswith(b'\t.bupm')]
+        print('diff read', len(cats), 'objects, with', len(subtrees),
+              'subtrees in big/', file=stderr)
+        assert len(cats) < len(subtrees)
+        wvpasseq([], list(repo.diff(old, old, recursive=True)))
+        with pytest.raises(vfs.IOError):
+            repo.diff(old, new + b'/same')
@@ -0,0 +1,3 @@
+commit='62d2e7d67cdb82f8599ad47f5853559e30c852f1'
+date='2026-10-19 10:23:31 +0000'
+modified=False
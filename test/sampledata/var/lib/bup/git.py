@@ -0,0 +1,1628 @@
+"""Git interaction library.
+bup repositories are in Git format. This library allows us to
+interact with the Git data structures.
+"""
+
+import os, sys, zlib, subprocess, struct, stat, re, glob
+from array import array
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from contextlib import ExitStack
+from itertools import islice
+from shutil import rmtree
+
+from bup import _helpers, hashsplit, path, midx, bloom, xstat
+from bup.compat import (bytes_from_byte, bytes_from_uint,
+                        environ,
+                        pending_raise)
+from bup.io import path_msg
+from bup.helpers import (EXIT_FAILURE,
+                         OBJECT_EXISTS,
+                         ObjectLocation,
+                         Sha1, add_error, chunkyreader, debug1,
+                         exo,
+                         fdatasync,
+                         finalized,
+                         log,
+                         merge_dict,
+                         merge_iter,
+                         mmap_read, mmap_readwrite,
+                         nullcontext_if_not,
+                         progress, qprogress, stat_if_exists,
+                         quote,
+                         temp_dir,
+                         unlink,
+                         suspend_progress,
+                         utc_offset_str)
+from bup.midx import open_midx
+
+
+verbose = 0
+
+_typemap =  {b'blob': 3, b'tree': 2, b'commit': 1, b'tag': 4}
+_typermap = {v: k for k, v in _typemap.items()}
+
+
+_total_searches = 0
+_total_steps = 0
+
+
+class GitError(Exception):
+    pass
+
+
+def _gitenv(repo_dir):
+    # This is not always used, i.e. sometimes we just use --git-dir
+    return merge_dict(environ, {b'GIT_DIR': os.path.abspath(repo_dir)})
+
+def _git_wait(cmd, p):
+    rv = p.wait()
+    if rv != 0:
+        raise GitError('%r returned %d' % (cmd, rv))
+
+def _git_exo(cmd, **kwargs):
+    kwargs['check'] = False
+    result = exo(cmd, **kwargs)
+    _, _, proc = result
+    if proc.returncode != 0:
+        raise GitError('%r returned %d' % (cmd, proc.returncode))
+    return result
+
+def repo_cfg_file(repo_dir, cfg_file):
+    assert not (repo_dir and cfg_file), "repo_dir and cfg_file cannot both be used"
+    assert repo_dir or cfg_file, "repo_dir or cfg_file must be used"
+    if cfg_file:
+        return cfg_file
+    return os.path.join(repo_dir, b'config')
+
+def git_config_get(option, repo_dir=None, opttype=None, cfg_file=None):
+    cfg_file = repo_cfg_file(repo_dir, cfg_file)
+    cmd = [b'git', b'config', b'--file', cfg_file, b'--null']
+    if opttype == 'int':
+        cmd.extend([b'--int'])
+    elif opttype == 'path':
+        # git didn't learn --type=path until a later
+        # release than we require, but anyway it only
+        # does the equivalent of os.path.expanduser()
+        # so just do that below
+        pass
+    else:
+        assert opttype in ('bool', None)
+    cmd.extend([b'--get', option])
+    env=None
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+    # with --null, git writes out a trailing \0 after the value
+    r = p.stdout.read()[:-1]
+    rc = p.wait()
+    if rc == 0:
+        if opttype == 'int':
+            return int(r)
+        elif opttype == 'bool': # any positive int is true for git --bool
+            if not r:
+                return None
+            if r in (b'0', b'false'):
+                return False
+            if r in (b'1', b'true'):
+                return True
+            raise GitError(f'{cmd!r} returned invalid boolean value {r}')
+        elif opttype == 'path':
+            # special case, if empty return as such, so that
+            # our code elsewhere can tell
+            if not r:
+                return r
+            # expand user, to simulate git
+            r = os.path.expanduser(r)
+            # and make it an absolute path, so that paths in
+            # the config file can be given as relative and then
+            # are relative to the dir the config file lives in
+            d = repo_dir
+            if not d:
+                d = os.path.dirname(cfg_file)
+            return os.path.join(os.path.abspath(d), r)
+        return r
+    if rc == 1:
+        return None
+    raise GitError('%r returned %d' % (cmd, rc))
+
+def git_config_check(option, value, opttype):
+    assert opttype is not None
+    with temp_dir(prefix=b'conftest') as tmpdir:
+        cfg_file = os.path.join(tmpdir, b'test.conf')
+        git_config_write(option, value, cfg_file=cfg_file)
+        try:
+            git_config_get(option, cfg_file=cfg_file, opttype=opttype)
+            return True
+        except GitError:
+            return False
+
+def git_config_write(option, value, repo_dir=None, cfg_file=None):
+    cfg_file = repo_cfg_file(repo_dir, cfg_file)
+    cmd = [b'git', b'config']
+    cmd.extend([b'--file', cfg_file])
+    if value is None:
+        cmd.append(b'--unset')
+    cmd.append(option)
+    if value is not None:
+        cmd.append(value)
+    env = None
+    if repo_dir:
+        env = _gitenv(repo_dir=repo_dir)
+    p = subprocess.Popen(cmd, env=env)
+    rc = p.wait()
+    if rc != 0:
+        raise GitError('%r returned %d' % (cmd, rc))
+
+def git_config_list(values=False, repo_dir=None, cfg_file=None):
+    cfg_file = repo_cfg_file(repo_dir, cfg_file)
+    cmd = [b'git', b'config']
+    cmd.extend([b'--list', b'--null'])
+    cmd.extend([b'--file', cfg_file])
+    env = None
+    if repo_dir:
+        env = _gitenv(repo_dir=repo_dir)
+    p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE)
+    # assume this will fit in memory
+    output = p.stdout.read()
+    items = output.split(b'\0')
+    for item in items[:-1]:
+        key, value = item.split(b'\n', 1)
+        if values:
+            yield key, value
+        else:
+            yield key
+    rc = p.wait()
+    if rc != 0:
+        raise GitError('%r returned %d' % (cmd, rc))
+
+def parse_tz_offset(s):
+    """UTC offset in seconds."""
+    tz_off = (int(s[1:3]) * 60 * 60) + (int(s[3:5]) * 60)
+    if bytes_from_byte(s[0]) == b'-':
+        return - tz_off
+    return tz_off
+
+def parse_commit_gpgsig(sig):
+    """Return the original signature bytes.
+
+    i.e. with the "gpgsig " header and the leading space character on
+    each continuation line removed.
+
+    """
+    if not sig:
+        return None
+    assert sig.startswith(b'gpgsig ')
+    sig = sig[7:]
+    return sig.replace(b'\n ', b'\n')
+
+# FIXME: derived from http://git.rsbx.net/Documents/Git_Data_Formats.txt
+# Make sure that's authoritative.
+
+# See also
+# https://github.com/git/git/blob/master/Documentation/technical/signature-format.txt
+# The continuation lines have only one leading space.
+
+_start_end_char = br'[^ .,:;<>"\'\0\n]'
+_content_char = br'[^\0\n<>]'
+_safe_str_rx = br'(?:%s{1,2}|(?:%s%s*%s))' \
+    % (_start_end_char,
+       _start_end_char, _content_char, _start_end_char)
+_tz_rx = br'[-+]\d\d[0-5]\d'
+_parent_rx = br'(?:parent [abcdefABCDEF0123456789]{40}\n)'
+# Assumes every following line starting with a space is part of the
+# mergetag.  Is there a formal commit blob spec?
+_mergetag_rx = br'(?:\nmergetag object [abcdefABCDEF0123456789]{40}(?:\n [^\0\n]*)*)'
+_commit_rx = re.compile(br'''tree (?P<tree>[abcdefABCDEF0123456789]{40})
+(?P<parents>%s*)author (?P<author_name>%s) <(?P<author_mail>%s)> (?P<asec>\d+) (?P<atz>%s)
+committer (?P<committer_name>%s) <(?P<committer_mail>%s)> (?P<csec>\d+) (?P<ctz>%s)(?P<mergetag>%s?)
+(?P<gpgsig>gpgsig .*\n(?: .*\n)*)?
+(?P<message>(?:.|\n)*)''' % (_parent_rx,
+                             _safe_str_rx, _safe_str_rx, _tz_rx,
+                             _safe_str_rx, _safe_str_rx, _tz_rx,
+                             _mergetag_rx))
+_parent_hash_rx = re.compile(br'\s*parent ([abcdefABCDEF0123456789]{40})\s*')
+
+# Note that the author_sec and committer_sec values are (UTC) epoch
+# seconds, and for now the mergetag is not included.
+CommitInfo = namedtuple('CommitInfo', ['tree', 'parents',
+                                       'author_name', 'author_mail',
+                                       'author_sec', 'author_offset',
+                                       'committer_name', 'committer_mail',
+                                       'committer_sec', 'committer_offset',
+                                       'gpgsig',
+                                       'message'])
+
+def parse_commit(content):
+    commit_match = re.match(_commit_rx, content)
+    if not commit_match:
+        raise Exception('cannot parse commit %r' % content)
+    matches = commit_match.groupdict()
+    return CommitInfo(tree=matches['tree'],
+                      parents=re.findall(_parent_hash_rx, matches['parents']),
+                      author_name=matches['author_name'],
+                      author_mail=matches['author_mail'],
+                      author_sec=int(matches['asec']),
+                      author_offset=parse_tz_offset(matches['atz']),
+                      committer_name=matches['committer_name'],
+                      committer_mail=matches['committer_mail'],
+                      committer_sec=int(matches['csec']),
+                      committer_offset=parse_tz_offset(matches['ctz']),
+                      gpgsig=parse_commit_gpgsig(matches['gpgsig']),
+                      message=matches['message'])
+
+
+def _local_git_date_str(epoch_sec):
+    return b'%d %s' % (epoch_sec, utc_offset_str(epoch_sec))
+
+
+def _git_date_str(epoch_sec, tz_offset_sec):
+    offs =  tz_offset_sec // 60
+    return b'%d %s%02d%02d' \
+        % (epoch_sec,
+           b'+' if offs >= 0 else b'-',
+           abs(offs) // 60,
+           abs(offs) % 60)
+
+
+def repo(sub=b'', repo_dir=None):
+    """Get the path to the git repository or one of its subdirectories."""
+    assert repo_dir
+
+    # If there's a .git subdirectory, then the actual repo is in there.
+    gd = os.path.join(repo_dir, b'.git')
+    if os.path.exists(gd):
+        repo_dir = gd
+
+    return os.path.join(repo_dir, sub)
+
+
+_shorten_hash_rx = \
+    re.compile(br'([^0-9a-z]|\b)([0-9a-z]{7})[0-9a-z]{33}([^0-9a-z]|\b)')
+
+def shorten_hash(s):
+    return _shorten_hash_rx.sub(br'\1\2*\3', s)
+
+
+def repo_rel(path):
+    full = os.path.abspath(path)
+    # this is only used for printing, so we don't mind if there's
+    # no real repo and we might be guessing wrong...
+    fullrepo = os.path.abspath(repo(b'', repo_dir=guess_repo()))
+    if not fullrepo.endswith(b'/'):
+        fullrepo += b'/'
+    if full.startswith(fullrepo):
+        path = full[len(fullrepo):]
+    if path.startswith(b'index-cache/'):
+        path = path[len(b'index-cache/'):]
+    return shorten_hash(path)
+
+
+def auto_midx(objdir):
+    with suspend_progress():
+        args = [path.exe(), b'midx', b'--auto', b'--dir', objdir]
+        try:
+            rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
+        except OSError as e:
+            # make sure 'args' gets printed to help with debugging
+            add_error('%r: exception: %s' % (args, e))
+            raise
+        if rv:
+            add_error('%r: returned %d' % (args, rv))
+
+        args = [path.exe(), b'bloom', b'--dir', objdir]
+        try:
+            rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
+        except OSError as e:
+            # make sure 'args' gets printed to help with debugging
+            add_error('%r: exception: %s' % (args, e))
+            raise
+        if rv:
+            add_error('%r: returned %d' % (args, rv))
+
+
+def mangle_name(name, mode, gitmode):
+    """Mangle a file name to present an abstract name for segmented files.
+    Mangled file names will have the ".bup" extension added to them. If a
+    file's name already ends with ".bup", a ".bupl" extension is added to
+    disambiguate normal files from segmented ones.
+    """
+    if stat.S_ISREG(mode) and not stat.S_ISREG(gitmode):
+        assert(stat.S_ISDIR(gitmode))
+        return name + b'.bup'
+    elif name.endswith(b'.bup') or name[:-1].endswith(b'.bup'):
+        return name + b'.bupl'
+    else:
+        return name
+
+
+(BUP_NORMAL, BUP_CHUNKED) = (0, 1) # must match bup._helpers
+from bup._helpers import demangle_name
+
+def calc_hash(type, content):
+    """Calculate some content's hash in the Git fashion."""
+    header = b'%s %d\0' % (type, len(content))
+    sum = Sha1(header)
+    sum.update(content)
+    return sum.digest()
+
+
+def shalist_item_sort_key(ent):
+    (mode, name, id) = ent
+    assert(mode+0 == mode)
+    if stat.S_ISDIR(mode):
+        return name + b'/'
+    else:
+        return name
+
+
+def tree_encode(shalist):
+    """Generate a git tree object from (mode,name,hash) tuples."""
+    shalist = sorted(shalist, key = shalist_item_sort_key)
+    l = []
+    for (mode,name,bin) in shalist:
+        assert(mode)
+        assert(mode+0 == mode)
+        assert(name)
+        assert(len(bin) == 20)
+        s = b'%o %s\0%s' % (mode,name,bin)
+        assert not s.startswith(b'0'), 'git trees do not allow 0-padded octal'
+        l.append(s)
+    return b''.join(l)
+
+
+from bup._helpers import _tree_decode
+def tree_decode(buf):
+    return iter(_tree_decode(buf))
+
+def _encode_packobj(type, content, compression_level=1):
+    if compression_level not in range(-1, 10):
+        raise ValueError('invalid compression level %s' % compression_level)
+    szout = b''
+    sz = len(content)
+    szbits = (sz & 0x0f) | (_typemap[type]<<4)
+    sz >>= 4
+    while 1:
+        if sz: szbits |= 0x80
+        szout += bytes_from_uint(szbits)
+        if not sz:
+            break
+        szbits = sz & 0x7f
+        sz >>= 7
+    z = zlib.compressobj(compression_level)
+    yield szout
+    yield z.compress(content)
+    yield z.flush()
+
+
+def _decode_packobj(buf):
+    tp, offs, sz = _helpers.decode_hdr(buf)
+    yield (tp, sz)
+    it = zlib.decompressobj()
+    chunksz = 512
+    while True:
+        d = it.decompress(buf[offs:offs+chunksz])
+        if d:
+            yield d
+        offs += chunksz
+        if it.unused_data or not buf[offs:]:
+            break
+    d = it.flush()
+    if d:
+        yield d
+
+
+class PackIdx:
+    def find_offset(self, hash):
+        """Get the offset of an object inside the index file."""
+        idx = self._idx_from_hash(hash)
+        if idx != None:
+            return self._ofs_from_idx(idx)
+        return None
+
+    def exists(self, hash, want_source=False, want_offset=False, want_crc=False):
+        """Return an ObjectLocation if the object exists in this
+           index, otherwise None."""
+        if not hash:
+            return None
+        idx = self._idx_from_hash(hash)
+        if idx is not None:
+            if want_source or want_offset:
+                ret = ObjectLocation(None, None, None)
+                if want_source:
+                    ret.pack = os.path.basename(self.name)
+                if want_offset:
+                    ret.offset = self._ofs_from_idx(idx)
+                if want_crc:
+                    ret.crc = self._crc_from_idx(idx)
+                return ret
+            return OBJECT_EXISTS
+        return None
+
+    def _idx_from_hash(self, hash):
+        global _total_searches, _total_steps
+        _total_searches += 1
+        assert(len(hash) == 20)
+        b1 = hash[0]
+        start = self.fanout[b1-1] # range -1..254
+        end = self.fanout[b1] # range 0..255
+        want = hash
+        _total_steps += 1  # lookup table is a step
+        while start < end:
+            _total_steps += 1
+            mid = start + (end - start) // 2
+            v = self._idx_to_hash(mid)
+            if v < want:
+                start = mid+1
+            elif v > want:
+                end = mid
+            else: # got it!
+                return mid
+        return None
+
+
+class PackIdxV1(PackIdx):
+    """Object representation of a Git pack index (version 1) file."""
+    def __init__(self, filename, f):
+        super().__init__()
+        self.closed = False
+        self.name = filename
+        self.idxnames = [self.name]
+        self.map = mmap_read(f)
+        # Min size for 'L' is 4, which is sufficient for struct's '!I'
+        self.fanout = array('L', struct.unpack('!256I', self.map))
+        self.fanout.append(0)  # entry "-1"
+        self.nsha = self.fanout[255]
+        self.sha_ofs = 256 * 4
+        # Avoid slicing shatable for individual hashes (very high overhead)
+        assert self.nsha
+        self.shatable = \
+            memoryview(self.map)[self.sha_ofs:self.sha_ofs + self.nsha * 24]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def __len__(self):
+        return int(self.nsha)  # int() from long for python 2
+
+    def _ofs_from_idx(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        ofs = self.sha_ofs + idx * 24
+        return struct.unpack_from('!I', self.map, offset=ofs)[0]
+
+    def _crc_from_idx(self, idx):
+        assert False, "not supported in pack idx v1"
+
+    def _idx_to_hash(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        ofs = self.sha_ofs + idx * 24 + 4
+        return self.map[ofs : ofs + 20]
+
+    def __iter__(self):
+        start = self.sha_ofs + 4
+        for ofs in range(start, start + 24 * self.nsha, 24):
+            yield self.map[ofs : ofs + 20]
+
+    def oid_offsets_and_idxs(self):
+        end = self.sha_ofs + self.nsha * 24
+        for i, ofs in enumerate(range(self.sha_ofs, end, 24)):
+            yield struct.unpack_from('!I', self.map, offset=ofs)[0], i
+
+    def close(self):
+        self.closed = True
+        if self.map is not None:
+            self.shatable = None
+            self.map.close()
+            self.map = None
+
+    def __del__(self):
+        assert self.closed
+
+
+class PackIdxV2(PackIdx):
+    """Object representation of a Git pack index (version 2) file."""
+    def __init__(self, filename, f):
+        super().__init__()
+        self.closed = False
+        self.name = filename
+        self.idxnames = [self.name]
+        self.map = mmap_read(f)
+        assert self.map[0:8] == b'\377tOc\0\0\0\2'
+        # Min size for 'L' is 4, which is sufficient for struct's '!I'
+        self.fanout = array('L', struct.unpack_from('!256I', self.map, offset=8))
+        self.fanout.append(0)
+        self.nsha = self.fanout[255]
+        self.sha_ofs = 8 + 256*4
+        self.crctable_ofs = self.sha_ofs + self.nsha * 20
+        self.ofstable_ofs = self.crctable_ofs + self.nsha * 4
+        self.ofs64table_ofs = self.ofstable_ofs + self.nsha * 4
+        # Avoid slicing this for individual hashes (very high overhead)
+        assert self.nsha
+        self.shatable = \
+            memoryview(self.map)[self.sha_ofs:self.sha_ofs + self.nsha * 20]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def __len__(self):
+        return int(self.nsha)  # int() from long for python 2
+
+    def _oid_ofs_from_ofs32_ofs(self, ofs32_ofs):
+        ofs32 = struct.unpack_from('!I', self.map, offset=ofs32_ofs)[0]
+        if ofs32 & 0x80000000:
+            ofs64_i = ofs32 & 0x7fffffff
+            ofs64_ofs = self.ofs64table_ofs + ofs64_i * 8
+            return struct.unpack_from('!Q', self.map, offset=ofs64_ofs)[0]
+        return ofs32
+
+    def _ofs_from_idx(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        ofs32_ofs = self.ofstable_ofs + idx * 4
+        return self._oid_ofs_from_ofs32_ofs(ofs32_ofs)
+
+    def _crc_from_idx(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        crc_ofs = self.crctable_ofs + idx * 4
+        return struct.unpack_from('!I', self.map, offset=crc_ofs)[0]
+
+    def _idx_to_hash(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        ofs = self.sha_ofs + idx * 20
+        return self.map[ofs : ofs + 20]
+
+    def __iter__(self):
+        start = self.sha_ofs
+        for ofs in range(start, start + 20 * self.nsha, 20):
+            yield self.map[ofs : ofs + 20]
+
+    def close(self):
+        self.closed = True
+        if self.map is not None:
+            self.shatable = None
+            self.map.close()
+            self.map = None
+
+    def oid_offsets_and_idxs(self):
+        end = self.ofstable_ofs + self.nsha * 4
+        for i, ofs32_ofs in enumerate(range(self.ofstable_ofs, end, 4)):
+            yield self._oid_ofs_from_ofs32_ofs(ofs32_ofs), i
+
+    def __del__(self):
+        assert self.closed
+
+
+_mpi_count = 0
+class PackIdxList:
+    def __init__(self, dir, ignore_midx=False):
+        global _mpi_count
+        # Q: was this also intended to prevent opening multiple repos?
+        assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
+        _mpi_count += 1
+        self.open = True
+        self.dir = dir
+        self.also = set()
+        self.packs = []
+        self.do_bloom = False
+        self.bloom = None
+        self.ignore_midx = ignore_midx
+        try:
+            self.refresh()
+        except BaseException as ex:
+            with pending_raise(ex):
+                self.close()
+
+    def close(self):
+        global _mpi_count
+        if not self.open:
+            assert _mpi_count == 0
+            return
+        _mpi_count -= 1
+        assert _mpi_count == 0
+        self.also = None
+        self.bloom, bloom = None, self.bloom
+        self.packs, packs = None, self.packs
+        self.open = False
+        with ExitStack() as stack:
+            for pack in packs:
+                stack.enter_context(pack)
+            if bloom:
+                bloom.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def __del__(self):
+        assert not self.open
+
+    def __iter__(self):
+        return iter(idxmerge(self.packs))
+
+    def __len__(self):
+        return sum(len(pack) for pack in self.packs)
+
+    def exists(self, hash, want_source=False, want_offset=False, want_crc=False):
+        """Return an ObjectLocation if the object exists in this
+           index, otherwise None."""
+        global _total_searches
+        _total_searches += 1
+        if hash in self.also:
+            return True
+        if self.do_bloom and self.bloom:
+            if self.bloom.exists(hash):
+                self.do_bloom = False
+            else:
+                _total_searches -= 1  # was counted by bloom
+                return None
+        for i in range(len(self.packs)):
+            p = self.packs[i]
+            get_src = want_source
+            if isinstance(p, midx.PackMidx):
+                get_src = want_source or want_offset or want_crc
+                # cannot retrieve directly, look up in src idx
+                get_ofs = False
+                get_crc = False
+            else:
+                get_src = want_source
+                get_ofs = want_offset
+                get_crc = want_crc
+            _total_searches -= 1  # will be incremented by sub-pack
+            ret = p.exists(hash, want_source=get_src, want_offset=get_ofs, want_crc=get_crc)
+            if ret:
+                # reorder so most recently used packs are searched first
+                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                if (want_offset and ret.offset is None) or (want_crc and ret.crc is None):
+                    with open_idx(os.path.join(self.dir, ret.pack)) as np:
+                        ret = np.exists(hash, want_source=want_source,
+                                        want_offset=want_offset,
+                                        want_crc=want_crc)
+                    assert ret
+                return ret
+        self.do_bloom = True
+        return None
+
+    def close_temps(self):
+        '''
+        Close all the temporary files (bloom/midx) so that you can safely call
+        auto_midx() without potentially deleting files that are open/mapped.
+        Note that you should call refresh() again afterwards to reload any new
+        ones, otherwise performance will suffer.
+        '''
+        if self.bloom is not None:
+            self.bloom.close()
+            self.bloom = None
+        for ix in list(self.packs):
+            if not isinstance(ix, midx.PackMidx):
+                continue
+            ix.close()
+            self.packs.remove(ix)
+
+    def refresh(self, skip_midx = False):
+        """Refresh the index list.
+        This method verifies if .midx files were superseded (e.g. all of its
+        contents are in another, bigger .midx file) and removes the superseded
+        files.
+
+        If skip_midx is True, all work on .midx files will be skipped and .midx
+        files will be removed from the list.
+
+        The instance variable 'ignore_midx' can force this function to
+        always act as if skip_midx was True.
+        """
+        if self.bloom is not None:
+            self.bloom.close()
+        self.bloom = None # Always reopen the bloom as it may have been relaced
+        self.do_bloom = False
+        skip_midx = skip_midx or self.ignore_midx
+        d = dict((p.name, p) for p in self.packs
+                 if not skip_midx or not isinstance(p, midx.PackMidx))
+        if os.path.exists(self.dir):
+            if not skip_midx:
+                midxl = []
+                midxes = set(glob.glob(os.path.join(self.dir, b'*.midx')))
+                # remove any *.midx files from our list that no longer exist
+                for ix in list(d.values()):
+                    if not isinstance(ix, midx.PackMidx):
+                        continue
+                    if ix.name in midxes:
+                        continue
+                    # remove the midx
+                    del d[ix.name]
+                    ix.close()
+                    self.packs.remove(ix)
+                for ix in self.packs:
+                    if isinstance(ix, midx.PackMidx):
+                        for name in ix.idxnames:
+                            d[os.path.join(self.dir, name)] = ix
+                for full in midxes:
+                    if not d.get(full):
+                        mx, missing = None, None
+                        try:
+                            mx = open_midx(full, ignore_missing=False)
+                        except midx.MissingIdxs as ex:
+                            missing = ex.paths
+                        if not missing:
+                            if mx: midxl.append(mx)
+                        else:
+                            mxd, mxf = os.path.split(full)
+                            for n in missing:
+                                log(('warning: index %s missing\n'
+                                     '  used by %s\n')
+                                    % (path_msg(n), path_msg(mxf)))
+                            unlink(full)
+                midxl.sort(key=lambda ix:
+                           (-len(ix), -xstat.stat(ix.name).st_mtime))
+                for ix in midxl:
+                    any_needed = False
+                    for sub in ix.idxnames:
+                        found = d.get(os.path.join(self.dir, sub))
+                        if not found or isinstance(found, PackIdx):
+                            # doesn't exist, or exists but not in a midx
+                            any_needed = True
+                            break
+                    if any_needed:
+                        d[ix.name] = ix
+                        for name in ix.idxnames:
+                            d[os.path.join(self.dir, name)] = ix
+                    else:
+                        debug1('midx: removing redundant: %s\n'
+                               % path_msg(os.path.basename(ix.name)))
+                        ix.close()
+                        unlink(ix.name)
+            for full in glob.glob(os.path.join(self.dir, b'*.idx')):
+                if not d.get(full):
+                    try:
+                        ix = open_idx(full)
+                    except GitError as e:
+                        add_error(e)
+                        continue
+                    d[full] = ix
+            bfull = os.path.join(self.dir, b'bup.bloom')
+            new_packs = set(d.values())
+            for p in self.packs:
+                if not p in new_packs:
+                    p.close()
+            new_packs = list(new_packs)
+            new_packs.sort(reverse=True, key=lambda x: len(x))
+            self.packs = new_packs
+            if self.bloom is None and os.path.exists(bfull):
+                self.bloom = bloom.ShaBloom(bfull)
+            try:
+                if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
+                    self.do_bloom = True
+                else:
+                    if self.bloom:
+                        self.bloom, bloom_tmp = None, self.bloom
+                        bloom_tmp.close()
+            except BaseException as ex:
+                with pending_raise(ex):
+                    if self.bloom:
+                        self.bloom.close()
+
+        debug1('PackIdxList: using %d index%s.\n'
+            % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
+
+    def add(self, hash):
+        """Insert an additional object in the list."""
+        self.also.add(hash)
+
+
+def open_idx(filename):
+    if not filename.endswith(b'.idx'): # why is this enforced *here*?
+        raise GitError('pack idx filenames must end with .idx')
+    f = open(filename, 'rb')
+    with ExitStack() as contexts:
+        contexts.enter_context(f)
+        header = f.read(8)
+        if header[0:4] == b'\377tOc':
+            version = struct.unpack('!I', header[4:8])[0]
+            if version == 2:
+                contexts.pop_all()
+                return PackIdxV2(filename, f)
+            else:
+                raise GitError('%s: expected idx file version 2, got %d'
+                               % (path_msg(filename), version))
+        elif len(header) == 8 and header[0:4] < b'\377tOc':
+            contexts.pop_all()
+            return PackIdxV1(filename, f)
+        else:
+            raise GitError('%s: unrecognized idx file header'
+                           % path_msg(filename))
+
+
+def open_object_idx(filename):
+    if filename.endswith(b'.idx'):
+        return open_idx(filename)
+    elif filename.endswith(b'.midx'):
+        return open_midx(filename)
+    else:
+        raise GitError('pack index filenames must end with .idx or .midx')
+
+
+def idxmerge(idxlist, final_progress=True):
+    """Generate a list of all the objects reachable in a PackIdxList."""
+    def pfunc(count, total):
+        qprogress('Reading indexes: %.2f%% (%d/%d)\r'
+                  % (count*100.0/total, count, total))
+    def pfinal(count, total):
+        if final_progress:
+            progress('Reading indexes: %.2f%% (%d/%d), done.\n'
+                     % (100, total, total))
+    return merge_iter(idxlist, 10024, pfunc, pfinal)
+
+
+def create_commit_blob(tree, parent,
+                       author, adate_sec, adate_tz,
+                       committer, cdate_sec, cdate_tz,
+                       msg):
+    if adate_tz is not None:
+        adate_str = _git_date_str(adate_sec, adate_tz)
+    else:
+        adate_str = _local_git_date_str(adate_sec)
+    if cdate_tz is not None:
+        cdate_str = _git_date_str(cdate_sec, cdate_tz)
+    else:
+        cdate_str = _local_git_date_str(cdate_sec)
+    l = []
+    if tree: l.append(b'tree %s' % hexlify(tree))
+    if parent: l.append(b'parent %s' % hexlify(parent))
+    if author: l.append(b'author %s %s' % (author, adate_str))
+    if committer: l.append(b'committer %s %s' % (committer, cdate_str))
+    l.append(b'')
+    l.append(msg)
+    return b'\n'.join(l)
+
+def _make_objcache(repo_dir):
+    return PackIdxList(repo(b'objects/pack', repo_dir=repo_dir))
+
+# bup-gc assumes that it can disable all PackWriter activities
+# (bloom/midx/cache) via the constructor and close() arguments.
+
+class PackWriter:
+    """Writes Git objects inside a pack file."""
+    def __init__(self, objcache_maker=None, compression_level=None,
+                 run_midx=True, on_pack_finish=None,
+                 max_pack_size=None, max_pack_objects=None, repo_dir=None):
+        self.closed = False
+        # In the case of a PackWriter_Remote instance we shouldn't _require_ a
+        # local repo (hence guess_repo()), but for backward compatibility reasons
+        # have to look up the packSizeLimit in a local repo (if it exists)...
+        self.repo_dir = repo_dir or guess_repo()
+        self.file = None
+        self.parentfd = None
+        self.count = 0
+        self.outbytes = 0
+        self.tmpdir = None
+        self.idx = None
+        self.objcache_maker = objcache_maker or _make_objcache
+        self.objcache = None
+        if compression_level is None:
+            compression_level = 1
+        self.compression_level = compression_level
+        self.run_midx=run_midx
+        self.on_pack_finish = on_pack_finish
+        if not max_pack_size:
+            max_pack_size = git_config_get(b'pack.packSizeLimit',
+                                           repo_dir=self.repo_dir,
+                                           opttype='int')
+            if not max_pack_size:
+                # larger packs slow down pruning
+                max_pack_size = 1000 * 1000 * 1000
+        self.max_pack_size = max_pack_size
+        # cache memory usage is about 83 bytes per object
+        self.max_pack_objects = max_pack_objects if max_pack_objects \
+                                else max(1, self.max_pack_size // 5000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with pending_raise(value, rethrow=False):
+            self.close()
+
+    def _open(self):
+        if not self.file:
+            with ExitStack() as err_stack:
+                objdir = dir = os.path.join(self.repo_dir, b'objects')
+                self.tmpdir = err_stack.enter_context(temp_dir(dir=objdir, prefix=b'pack-tmp-'))
+                self.file = err_stack.enter_context(open(self.tmpdir + b'/pack', 'w+b'))
+                self.parentfd = err_stack.enter_context(finalized(os.open(objdir, os.O_RDONLY),
+                                                                  lambda x: os.close(x)))
+                self.file.write(b'PACK\0\0\0\2\0\0\0\0')
+                self.idx = PackIdxV2Writer()
+                err_stack.pop_all()
+
+    def _raw_write(self, datalist, sha):
+        self._open()
+        f = self.file
+        # in case we get interrupted (eg. KeyboardInterrupt), it's best if
+        # the file never has a *partial* blob.  So let's make sure it's
+        # all-or-nothing.  (The blob shouldn't be very big anyway, thanks
+        # to our hashsplit algorithm.)  f.write() does its own buffering,
+        # but that's okay because we'll flush it in _end().
+        oneblob = b''.join(datalist)
+        try:
+            f.write(oneblob)
+        except IOError as e:
+            raise GitError(e) from e
+        nw = len(oneblob)
+        crc = zlib.crc32(oneblob) & 0xffffffff
+        self._update_idx(sha, crc, nw)
+        self.outbytes += nw
+        self.count += 1
+        return nw, crc
+
+    def _update_idx(self, sha, crc, size):
+        assert(sha)
+        if self.idx:
+            self.idx.add(sha, crc, self.file.tell() - size)
+
+    def _write(self, sha, type, content):
+        if verbose:
+            log('>')
+        assert sha
+        size, crc = self._raw_write(_encode_packobj(type, content,
+                                                    self.compression_level),
+                                    sha=sha)
+        if self.outbytes >= self.max_pack_size \
+           or self.count >= self.max_pack_objects:
+            self.breakpoint()
+        return sha
+
+    def _require_objcache(self):
+        if self.objcache is None:
+            self.objcache = self.objcache_maker(self.repo_dir)
+        if self.objcache is None:
+            raise GitError(
+                    "PackWriter not opened or can't check exists w/o objcache")
+
+    def exists(self, id, want_source=False):
+        """Return non-empty if an object is found in the object cache."""
+        self._require_objcache()
+        return self.objcache.exists(id, want_source=want_source)
+
+    def just_write(self, sha, type, content):
+        """Write an object to the pack file without checking for duplication."""
+        self._write(sha, type, content)
+        # If nothing else, gc doesn't have/want an objcache
+        if self.objcache is not None:
+            self.objcache.add(sha)
+
+    def maybe_write(self, type, content):
+        """Write an object to the pack file if not present and return its id."""
+        sha = calc_hash(type, content)
+        if not self.exists(sha):
+            self._require_objcache()
+            self.just_write(sha, type, content)
+        return sha
+
+    def new_blob(self, blob):
+        """Create a blob object in the pack with the supplied content."""
+        return self.maybe_write(b'blob', blob)
+
+    def new_tree(self, shalist):
+        """Create a tree object in the pack."""
+        content = tree_encode(shalist)
+        return self.maybe_write(b'tree', content)
+
+    def new_commit(self, tree, parent,
+                   author, adate_sec, adate_tz,
+                   committer, cdate_sec, cdate_tz,
+                   msg):
+        """Create a commit object in the pack.  The date_sec values must be
+        epoch-seconds, and if a tz is None, the local timezone is assumed."""
+        content = create_commit_blob(tree, parent,
+                                     author, adate_sec, adate_tz,
+                                     committer, cdate_sec, cdate_tz,
+                                     msg)
+        return self.maybe_write(b'commit', content)
+
+    def _end(self, abort=False):
+        # Ignores run_midx during abort
+        self.tmpdir, tmpdir = None, self.tmpdir
+        self.parentfd, pfd, = None, self.parentfd
+        self.file, f = None, self.file
+        self.idx, idx = None, self.idx
+        try:
+            with nullcontext_if_not(self.objcache), \
+                 finalized(pfd, lambda x: x is not None and os.close(x)), \
+                 nullcontext_if_not(f):
+                if abort or not f:
+                    return None
+
+                # update object count
+                f.seek(8)
+                cp = struct.pack('!i', self.count)
+                assert len(cp) == 4
+                f.write(cp)
+
+                # calculate the pack sha1sum
+                f.seek(0)
+                sum = Sha1()
+                for b in chunkyreader(f):
+                    sum.update(b)
+                packbin = sum.digest()
+                f.write(packbin)
+                f.flush()
+                fdatasync(f.fileno())
+                f.close()
+
+                idx.write(tmpdir + b'/idx', packbin)
+                nameprefix = os.path.join(self.repo_dir,
+                                          b'objects/pack/pack-' +  hexlify(packbin))
+                os.rename(tmpdir + b'/pack', nameprefix + b'.pack')
+                os.rename(tmpdir + b'/idx', nameprefix + b'.idx')
+                os.fsync(pfd)
+                if self.on_pack_finish:
+                    self.on_pack_finish(nameprefix)
+                if self.run_midx:
+                    auto_midx(os.path.join(self.repo_dir, b'objects/pack'))
+                return nameprefix
+        finally:
+            if tmpdir:
+                rmtree(tmpdir)
+            # Must be last -- some of the code above depends on it
+            self.objcache = None
+
+    def abort(self):
+        """Remove the pack file from disk."""
+        self.closed = True
+        self._end(abort=True)
+
+    def breakpoint(self):
+        """Clear byte and object counts and return the last processed id."""
+        id = self._end()
+        self.outbytes = self.count = 0
+        return id
+
+    def close(self):
+        """Close the pack file and move it to its definitive path."""
+        self.closed = True
+        return self._end()
+
+    def __del__(self):
+        assert self.closed
+
+
+class PackIdxV2Writer:
+    def __init__(self):
+        self.idx = list(list() for i in range(256))
+        self.count = 0
+
+    def add(self, sha, crc, offs):
+        assert(sha)
+        self.count += 1
+        self.idx[sha[0]].append((sha, crc, offs))
+
+    def write(self, filename, packbin):
+        ofs64_count = 0
+        for section in self.idx:
+            for entry in section:
+                if entry[2] >= 2**31:
+                    ofs64_count += 1
+
+        # Length: header + fan-out + shas-and-crcs + overflow-offsets
+        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        idx_map = None
+        idx_f = open(filename, 'w+b')
+        try:
+            idx_f.truncate(index_len)
+            fdatasync(idx_f.fileno())
+            idx_map = mmap_readwrite(idx_f, close=False)
+            try:
+                count = _helpers.write_idx(filename, idx_map, self.idx,
+                                           self.count)
+                assert(count == self.count)
+                idx_map.flush()
+            finally:
+                idx_map.close()
+        finally:
+            idx_f.close()
+
+        idx_f = open(filename, 'a+b')
+        try:
+            idx_f.write(packbin)
+            idx_f.seek(0)
+            idx_sum = Sha1()
+            b = idx_f.read(8 + 4*256)
+            idx_sum.update(b)
+
+            for b in chunkyreader(idx_f, 20 * self.count):
+                idx_sum.update(b)
+
+            for b in chunkyreader(idx_f):
+                idx_sum.update(b)
+            idx_f.write(idx_sum.digest())
+            fdatasync(idx_f.fileno())
+        finally:
+            idx_f.close()
+
+
+def list_refs(patterns=None, repo_dir=None,
+              limit_to_heads=False, limit_to_tags=False):
+    """Yield (refname, hash) tuples for all repository refs unless
+    patterns are specified.  In that case, only include tuples for
+    refs matching those patterns (cf. git-show-ref(1)).  The limits
+    restrict the result items to refs/heads or refs/tags.  If both
+    limits are specified, items from both sources will be included.
+
+    """
+    argv = [b'git', b'show-ref']
+    if limit_to_heads:
+        argv.append(b'--heads')
+    if limit_to_tags:
+        argv.append(b'--tags')
+    argv.append(b'--')
+    if patterns:
+        argv.extend(patterns)
+    p = subprocess.Popen(argv, env=_gitenv(repo_dir), stdout=subprocess.PIPE,
+                         close_fds=True)
+    out = p.stdout.read().strip()
+    rv = p.wait()  # not fatal
+    if rv:
+        assert(not out)
+    if out:
+        for d in out.split(b'\n'):
+            sha, name = d.split(b' ', 1)
+            yield name, unhexlify(sha)
+
+
+def read_ref(refname, repo_dir = None):
+    """Get the commit id of the most recent commit made on a given ref."""
+    refs = list_refs(patterns=[refname], repo_dir=repo_dir, limit_to_heads=True)
+    l = tuple(islice(refs, 2))
+    if l:
+        assert(len(l) == 1)
+        return l[0][1]
+    else:
+        return None
+
+
+def rev_list_invocation(ref_or_refs, format=None):
+    if isinstance(ref_or_refs, bytes):
+        refs = (ref_or_refs,)
+    else:
+        refs = ref_or_refs
+    argv = [b'git', b'rev-list']
+
+    if format:
+        argv.append(b'--pretty=format:' + format)
+    for ref in refs:
+        assert not ref.startswith(b'-')
+        argv.append(ref)
+    argv.append(b'--')
+    return argv
+
+
+def rev_list(ref_or_refs, parse=None, format=None, repo_dir=None):
+    """Yield information about commits as per "git rev-list".  If a format
+    is not provided, yield one hex hash at a time.  If a format is
+    provided, pass it to rev-list and call parse(git_stdout) for each
+    commit with the stream positioned just after the rev-list "commit
+    HASH" header line.  When a format is provided yield (oidx,
+    parse(git_stdout)) for each commit.
+
+    """
+    assert bool(parse) == bool(format)
+    p = subprocess.Popen(rev_list_invocation(ref_or_refs,
+                                             format=format),
+                         env=_gitenv(repo_dir),
+                         stdout = subprocess.PIPE,
+                         close_fds=True)
+    if not format:
+        for line in p.stdout:
+            yield line.strip()
+    else:
+        line = p.stdout.readline()
+        while line:
+            s = line.strip()
+            if not s.startswith(b'commit '):
+                raise Exception('unexpected line ' + repr(s))
+            s = s[7:]
+            assert len(s) == 40
+            yield s, parse(p.stdout)
+            line = p.stdout.readline()
+
+    rv = p.wait()  # not fatal
+    if rv:
+        raise GitError('git rev-list returned error %d' % rv)
+
+
+def update_ref(refname, newval, oldval, repo_dir=None):
+    """Update a repository reference.
+
+    oldval must be either a sha1 or None (for an entirely new ref)
+    """
+    if not oldval:
+        oldarg = [b'']
+    else:
+        oldarg = [hexlify(oldval)]
+    assert refname.startswith(b'refs/heads/') \
+        or refname.startswith(b'refs/tags/')
+    cmd = [b'git', b'update-ref', refname, hexlify(newval)] + oldarg
+    p = subprocess.Popen(cmd, env=_gitenv(repo_dir), close_fds=True)
+    _git_wait(b' '.join(quote(x) for x in cmd), p)
+
+
+def delete_ref(refname, oldvalue=None, repo_dir=None):
+    """Delete a repository reference (see git update-ref(1))."""
+    assert refname.startswith(b'refs/')
+    oldvalue = [] if not oldvalue else [oldvalue]
+    cmd = [b'git', b'update-ref', b'-d', refname] + oldvalue
+    p = subprocess.Popen(cmd, env=_gitenv(repo_dir), close_fds=True)
+    _git_wait(b' '.join(quote(x) for x in cmd), p)
+
+
+def guess_repo():
+    """Return the global repodir or BUP_DIR when either is set, or ~/.bup.
+    Usually, if you are interacting with a bup repository, you would
+    not be calling this function but using check_repo_or_die().
+
+    """
+    return path.defaultrepo()
+
+
+def init_repo(path=None):
+    """Create the Git bare repository for bup in a given path."""
+    repodir = path or guess_repo()
+    d = repo(repo_dir=repodir)  # appends a / to the path
+    parent = os.path.dirname(os.path.dirname(d))
+    if parent and not os.path.exists(parent):
+        raise GitError('parent directory "%s" does not exist\n'
+                       % path_msg(parent))
+    if os.path.exists(d) and not os.path.isdir(os.path.join(d, b'.')):
+        raise GitError('"%s" exists but is not a directory\n' % path_msg(d))
+    p = subprocess.Popen([ b'git', b'--bare',
+                           # arbitrary default branch name to suppress git msg.
+                           b'-c', b'init.defaultBranch=main', b'init'],
+                         stdout=sys.stderr,
+                         env=_gitenv(repodir),
+                         close_fds=True)
+    _git_wait('git init', p)
+    # Force the index version configuration in order to ensure bup works
+    # regardless of the version of the installed Git binary.
+    p = subprocess.Popen([b'git', b'config', b'pack.indexVersion', '2'],
+                         stdout=sys.stderr, env=_gitenv(repodir), close_fds=True)
+    _git_wait('git config', p)
+    # Enable the reflog
+    p = subprocess.Popen([b'git', b'config', b'core.logAllRefUpdates', b'true'],
+                         stdout=sys.stderr, env=_gitenv(repodir), close_fds=True)
+    _git_wait('git config', p)
+
+
+def check_repo_or_die(path):
+    """Check to see if a bup repository probably exists, and abort if not."""
+    repodir = path or guess_repo()
+    top = repo(repo_dir=repodir)
+    pst = stat_if_exists(top + b'/objects/pack')
+    if pst and stat.S_ISDIR(pst.st_mode):
+        return
+    if not pst:
+        top_st = stat_if_exists(top)
+        if not top_st:
+            log('error: repository %r does not exist (see "bup help init")\n'
+                % top)
+            sys.exit(15)
+    log('error: %s is not a repository\n' % path_msg(top))
+    sys.exit(14)
+
+
+def is_suitable_git(ver_str):
+    if not ver_str.startswith(b'git version '):
+        return 'unrecognized'
+    ver_str = ver_str[len(b'git version '):]
+    if ver_str.startswith(b'0.'):
+        return 'insufficient'
+    if ver_str.startswith(b'1.'):
+        if re.match(br'1\.[01234567]rc', ver_str):
+            return 'insufficient'
+        if re.match(br'1\.[0123456]\.', ver_str):
+            return 'insufficient'
+        if re.match(br'1\.7\.[01]($|\.)', ver_str):
+            return 'insufficient'
+        if re.match(br'1\.7\.2-rc', ver_str):
+            return 'insufficient'
+        return 'suitable'
+    if re.match(br'[0-9]+(\.|$)?', ver_str):
+        return 'suitable'
+    sys.exit(13)
+
+_git_great = None
+
+def require_suitable_git(ver_str=None):
+    """Raise GitError if the version of git isn't suitable.
+
+    Rely on ver_str when provided, rather than invoking the git in the
+    path.
+
+    """
+    global _git_great
+    if _git_great is not None:
+        return
+    if environ.get(b'BUP_GIT_VERSION_IS_FINE', b'').lower() \
+       in (b'yes', b'true', b'1'):
+        _git_great = True
+        return
+    if not ver_str:
+        ver_str, _, _ = _git_exo([b'git', b'--version'])
+    status = is_suitable_git(ver_str)
+    if status == 'unrecognized':
+        raise GitError('Unexpected git --version output: %r' % ver_str)
+    if status == 'insufficient':
+        log('error: git version must be at least 1.7.2\n')
+        sys.exit(EXIT_FAILURE)
+    if status == 'suitable':
+        _git_great = True
+        return
+    assert False
+
+
+class CatPipe:
+    """Link to 'git cat-file' that is used to retrieve blob data."""
+    def __init__(self, repo_dir = None):
+        require_suitable_git()
+        self.repo_dir = repo_dir
+        self.p = self.pcheck = self.inprogress = None
+
+        # probe for cat-file --batch-command
+        tmp = subprocess.Popen([b'git', b'cat-file', b'--batch-command'],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               close_fds=True,
+                               env=_gitenv(self.repo_dir))
+        tmp.wait();
+        self.have_batch_command = tmp.returncode == 0
+
+    def close(self, wait=False):
+        self.p, p = None, self.p
+        self.pcheck, pcheck = None, self.pcheck
+        self.inprogress = None
+        if p:
+            try:
+                p.stdout.close()
+            finally:
+                p.stdin.close()
+        if pcheck and pcheck != p:
+            try:
+                pcheck.stdout.close()
+            finally:
+                pcheck.stdin.close()
+        if wait:
+            if p: p.wait()
+            if pcheck: pcheck.wait()
+            if p and p.returncode:
+                return p.returncode
+            if pcheck and pcheck.returncode:
+                return pcheck.returncode
+            return 0
+        return None
+
+    def restart(self):
+        self.close()
+        self.p = subprocess.Popen([b'git', b'cat-file',
+                                  b'--batch-command' if self.have_batch_command else b'--batch'],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  close_fds = True,
+                                  bufsize = 4096,
+                                  env=_gitenv(self.repo_dir))
+
+    def _open_check(self):
+        if self.pcheck is not None: return
+        if self.have_batch_command:
+            self.pcheck = self.p
+            return
+        self.pcheck = subprocess.Popen([b'git', b'cat-file', b'--batch-check'],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       close_fds = True,
+                                       bufsize = 4096,
+                                       env=_gitenv(self.repo_dir))
+
+    def get(self, ref, include_data=True):
+        """Yield (oidx, type, size), followed by the data referred to by ref.
+        If ref does not exist, only yield (None, None, None).
+
+        """
+        if not self.p or self.p.poll() != None:
+            self.restart()
+        assert(self.p)
+        poll_result = self.p.poll()
+        assert(poll_result == None)
+        if self.inprogress:
+            log('get: opening %r while %r is open\n' % (ref, self.inprogress))
+        assert(not self.inprogress)
+        assert ref.find(b'\n') < 0
+        assert ref.find(b'\r') < 0
+        assert not ref.startswith(b'-')
+        self.inprogress = ref
+        if include_data:
+            p = self.p
+            if self.have_batch_command:
+                p.stdin.write(b'contents ')
+        else:
+            self._open_check()
+            p = self.pcheck
+            if self.have_batch_command:
+                p.stdin.write(b'info ')
+        p.stdin.write(ref + b'\n')
+        p.stdin.flush()
+        hdr = p.stdout.readline()
+        if not hdr:
+            raise GitError('unexpected cat-file EOF (last request: %r, exit: %s)'
+                           % (ref, p.poll() or 'none'))
+        if hdr.endswith(b' missing\n'):
+            self.inprogress = None
+            yield None, None, None
+            return
+        info = hdr.split(b' ')
+        if len(info) != 3 or len(info[0]) != 40:
+            raise GitError('expected object (id, type, size), got %r' % info)
+        oidx, typ, size = info
+
+        if not include_data:
+            self.inprogress = None
+            yield oidx, typ, size
+            return
+
+        size = int(size)
+        try:
+            it = chunkyreader(p.stdout, size)
+            yield oidx, typ, size
+            for blob in chunkyreader(p.stdout, size):
+                yield blob
+            readline_result = p.stdout.readline()
+            assert readline_result == b'\n'
+            self.inprogress = None
+        except Exception as ex:
+            with pending_raise(ex):
+                self.close()
+
+
+_cp = {}
+
+def cp(repo_dir):
+    """Create a CatPipe object or reuse the already existing one."""
+    global _cp
+    repo_dir = os.path.abspath(repo_dir)
+    cp = _cp.get(repo_dir)
+    if not cp:
+        cp = CatPipe(repo_dir)
+        _cp[repo_dir] = cp
+    return cp
+
+
+def close_catpipes():
+    # FIXME: chain exceptions
+    while _cp:
+        _, cp = _cp.popitem()
+        cp.close(wait=True)
+
+
+class MissingObject(KeyError):
+    __slots__ = 'oid',
+    def __init__(self, oid):
+        self.oid = oid
+        KeyError.__init__(self, f'object {hexlify(oid)!r} is missing')
+
+class WalkItem:
+    # The path is the mangled path, and if an item represents a fragment
+    # of a chunked file, the chunk_path will be the chunked subtree path
+    # for the chunk, i.e. ['', '2d3115e', ...].  The top-level path for a
+    # chunked file will have a chunk_path of [''].  So some chunk subtree
+    # of the file '/foo/bar/baz' might look like this:
+    #
+    #   item.path = ['foo', 'bar', 'baz.bup']
+    #   item.chunk_path = ['', '2d3115e', '016b097']
+    #   item.type = 'tree'
+    #   ...
+    __slots__ = 'oid', 'type', 'mode', 'path', 'chunk_path', 'data'
+    def __init__(self, *, oid, type, mode, path, chunk_path, data):
+        self.oid = oid
+        self.type = type
+        self.mode = mode
+        self.path = path
+        self.chunk_path = chunk_path
+        self.data = data
+
+def walk_object(repo, oidx, *, stop_at=None, include_data=None,
+                oid_exists=None):
+    """Yield everything reachable from oidx via get_ref (which must
+    behave like CatPipe get) as a WalkItem, stopping whenever
+    stop_at(oidx) returns logically true.  Set the data field to False
+    when the object is missing, or None if the object exists but
+    include_data is logically false.  Missing blobs may not be noticed
+    unless include_data is logically true or oid_exists(oid) is
+    provided.  Yield items depth first, post-order, i.e. parents after
+    children.
+
+    """
+
+    # Maintain the pending stack on the heap to avoid stack overflow
+    pending = [(oidx, [], [], None, None)]
+    while len(pending):
+        if isinstance(pending[-1], WalkItem):
+            yield pending.pop()
+            continue
+
+        oidx, parent_path, chunk_path, mode, exp_typ = pending.pop()
+        if stop_at and stop_at(oidx):
+            continue
+
+        oid = unhexlify(oidx)
+
+        if (not include_data) and mode and exp_typ == b'blob':
+            # If the object is a "regular file", then it's a leaf in
+            # the graph, so we can skip reading the data if the caller
+            # hasn't requested it.
+            yield WalkItem(oid=oid, type=b'blob',
+                           chunk_path=chunk_path, path=parent_path,
+                           mode=mode,
+                           data=bool(oid_exists(oid)) if oid_exists else None)
+            continue
+
+        get_oidx, typ, _, item_it = repo.get(oidx, include_data=include_data or (b'commit', b'tree'))
+        if not get_oidx:
+            yield WalkItem(oid=unhexlify(oidx), type=exp_typ,
+                           chunk_path=chunk_path, path=parent_path,
+                           mode=mode, data=False)
+            continue
+        if typ not in (b'blob', b'commit', b'tree'):
+            raise Exception('unexpected repository object type %r' % typ)
+        if exp_typ and typ != exp_typ:
+            raise Exception(f'{oidx.decode("ascii")} object type {typ} != {exp_typ}')
+
+        # FIXME: set the mode based on the type when the mode is None
+        if typ == b'blob' and not include_data:
+            assert item_it is None
+            data = None
+        else:
+            data = b''.join(item_it)
+
+        item = WalkItem(oid=oid, type=typ,
+                        chunk_path=chunk_path, path=parent_path,
+                        mode=mode,
+                        data=(data if include_data else None))
+
+        if typ == b'blob':
+            yield item
+        elif typ == b'commit':
+            pending.append(item)
+            commit_items = parse_commit(data)
+            # For now, all paths are rooted at the "nearest" commit
+            for pid in commit_items.parents:
+                pending.append((pid, [], [], mode, b'commit'))
+            pending.append((commit_items.tree, [oidx], [],
+                            hashsplit.GIT_MODE_TREE, b'tree'))
+        elif typ == b'tree':
+            pending.append(item)
+            for mode, name, ent_id in tree_decode(data):
+                demangled, bup_type = demangle_name(name, mode)
+                if chunk_path:
+                    sub_path = parent_path
+                    sub_chunk_path = chunk_path + [name]
+                else:
+                    sub_path = parent_path + [name]
+                    if bup_type == BUP_CHUNKED:
+                        sub_chunk_path = [b'']
+                    else:
+                        sub_chunk_path = chunk_path
+                pending.append((hexlify(ent_id), sub_path, sub_chunk_path,
+                                mode,
+                                b'tree' if stat.S_ISDIR(mode) else b'blob'))
@@ -0,0 +1,3 @@
+commit='$Format:%H$'
+date='$Format:%ci$'
+modified=False
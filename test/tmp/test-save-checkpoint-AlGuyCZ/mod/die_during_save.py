@@ -0,0 +1,13 @@
+
+import os
+import bup.cmd.save
+
+saved = []
+
+def test_save_checkpoint_die(name):
+    saved.append(name)
+    if len(saved) == 2:
+        os._exit(99)
+
+bup.cmd.save.before_saving_regular_file = test_save_checkpoint_die
+
@@ -0,0 +1,13 @@
+
+import os, time
+import bup.cmd.save
+
+def test_save_data_race_pause_save(name):
+    if name == b'/root/package/test/tmp/test-save-data-race-20s7eAi/save/data':
+        with open('/root/package/test/tmp/test-save-data-race-20s7eAi/waiting-to-save', 'w') as f:
+             pass
+        while os.path.exists('/root/package/test/tmp/test-save-data-race-20s7eAi/block-save'):
+           time.sleep(0.01)
+
+bup.cmd.save.before_saving_regular_file = test_save_data_race_pause_save
+
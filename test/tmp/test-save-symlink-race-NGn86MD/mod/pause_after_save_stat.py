@@ -0,0 +1,15 @@
+
+import os, time
+import bup.cmd.save
+
+import sys
+
+def test_save_symlink_race_pause_save(name):
+    if name == b'/root/package/test/tmp/test-save-symlink-race-NGn86MD/save/link':
+        with open('/root/package/test/tmp/test-save-symlink-race-NGn86MD/waiting-after-save-stat', 'w') as f:
+             pass
+        while os.path.exists('/root/package/test/tmp/test-save-symlink-race-NGn86MD/block-save'):
+           time.sleep(0.01)
+
+bup.cmd.save.after_nondir_metadata_stat = test_save_symlink_race_pause_save
+